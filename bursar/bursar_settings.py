@@ -7,7 +7,24 @@ from django.conf import settings
 
 working_bursar_settings = {
     'STORE_CREDIT_NUMBERS' : False,
-    'CURRENCY' : '$' # Use a '_' for force a space
+    'CURRENCY' : '$', # Use a '_' for force a space
+    'CIPHER' : 'blowfish',
+    'HTTP_CONNECT_TIMEOUT' : 10,
+    'HTTP_READ_TIMEOUT' : 60,
+    'HTTP_POOL_SIZE' : 8,
+    'HTTP_RETRIES' : 2,
+    'HTTP_RETRY_BACKOFF' : 0.5,
+    'BREAKER_FAILURES' : 5,
+    'BREAKER_SLOW_CALL' : 0,
+    'BREAKER_RESET' : 30,
+    'ASYNC_WORKERS' : 10,
+    'BULK_CAPTURE_WORKERS' : 4,
+    'BULK_CAPTURE_RATE' : 0,
+    'BULK_CAPTURE_BATCH' : 100,
+    'METRICS' : ('memory',),
+    'METRICS_BUCKETS' : (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    'METRICS_STATSD' : ('127.0.0.1', 8125),
+    'METRICS_STATSD_PREFIX' : 'bursar',
 }
 
 if hasattr(settings, 'BURSAR_SETTINGS'):
@@ -11,7 +11,38 @@ from django.utils.translation import ugettext_lazy as _
 
 BURSAR_SETTINGS = {
     'STORE_CREDIT_NUMBERS' : False,
-    'CURRENCY' : '$' # Use a '_' for force a space
+    'CURRENCY' : '$', # Use a '_' for force a space
+    # Cipher for stored card numbers, "blowfish" or "aes", see bursar/cipher.py.  Alter
+    # bursar_creditcarddetail.encrypted_cc to varchar(255) before switching an existing site to "aes".
+    'CIPHER' : 'blowfish',
+    # Key version -> secret, by default {1 : SECRET_KEY}.  Use a long random secret, an empty
+    # one is refused.  Keep old versions until rotate_cipher_keys has re-encrypted every card.
+    # 'CIPHER_KEYS' : {1 : 'replace with a long random secret'},
+    # 'CIPHER_KEY_VERSION' : 1,
+    # Gateway connections, each gateway's settings can override these
+    'HTTP_CONNECT_TIMEOUT' : 10,
+    'HTTP_READ_TIMEOUT' : 60,
+    'HTTP_POOL_SIZE' : 8,
+    # Retries for voids and IPN checks, and the per-gateway circuit breaker,
+    # see bursar/gateway/resilience.py
+    'HTTP_RETRIES' : 2,
+    'HTTP_RETRY_BACKOFF' : 0.5,
+    'BREAKER_FAILURES' : 5,
+    'BREAKER_SLOW_CALL' : 0,
+    'BREAKER_RESET' : 30,
+    # Threads posting for AsyncPaymentProcessor, see bursar/gateway/asyncprocessor.py
+    'ASYNC_WORKERS' : 10,
+    # Concurrent captures and captures a second per gateway for the capture_authorizations
+    # command, see bursar/gateway/bulk.py
+    'BULK_CAPTURE_WORKERS' : 4,
+    'BULK_CAPTURE_RATE' : 0,
+    'BULK_CAPTURE_BATCH' : 100,
+    # Where payment metrics go, "memory" for the Prometheus metrics view and/or "statsd",
+    # and the memory sink's histogram buckets in seconds, see bursar/metrics.py
+    'METRICS' : ('memory',),
+    'METRICS_BUCKETS' : (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    'METRICS_STATSD' : ('127.0.0.1', 8125),
+    'METRICS_STATSD_PREFIX' : 'bursar',
     'AUTHORIZENET' : {
         'LIVE' : False,
         'SIMULATE' : False,
@@ -0,0 +1,285 @@
+"""
+Pluggable encryption for stored card data.
+
+Values are encrypted by the current engine under the current key version,
+and tagged with both, as in "$aes$2$<base64 payload>".  Values without a
+tag were written by the original Blowfish code under settings.SECRET_KEY,
+and stay readable, so old rows can be re-encrypted as they are saved.
+
+Settings, in BURSAR_SETTINGS:
+    CIPHER: name of the engine used for new values, 'blowfish' (default) or
+        'aes'.  Tagged AES values are too long for the 40 character
+        encrypted_cc column of databases created before it was widened, so
+        alter it to varchar(255) before switching.  With 'blowfish' and no
+        CIPHER_KEYS, values are written untagged under SECRET_KEY, as the
+        original code wrote them.
+    CIPHER_KEYS: dictionary of key version (int) -> secret.  Defaults to
+        {1 : settings.SECRET_KEY}.  Old versions must be kept until every
+        value encrypted under them has been rotated.  An empty secret is
+        refused, as anyone could derive the key from it.
+    CIPHER_KEY_VERSION: the key version used for new values, defaults to the
+        highest version in CIPHER_KEYS.
+
+Keyed engines are expensive to build, Blowfish in particular runs a long
+key schedule, so they are built once per engine, version and key, and
+shared.
+"""
+from bursar.bursar_settings import get_bursar_setting
+from bursar.errors import CipherError
+from Crypto.Cipher import AES, Blowfish
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+
+log = logging.getLogger('bursar.cipher')
+
+TAG = '$'
+LEGACY_VERSION = 0
+
+class CipherEngine(object):
+    """Base class for cipher engines.  Subclasses must set `name` and implement
+    `encrypt_raw`, `decrypt_raw` and `digest`."""
+
+    name = None
+
+    def __init__(self, key, version):
+        self.key = smart_str(key)
+        self.version = version
+
+    def decrypt(self, token):
+        """Decrypt a tagged (or, for the legacy engine, untagged) value."""
+        return self.decrypt_raw(_payload(token))
+
+    def decrypt_many(self, tokens):
+        return [self.decrypt(token) for token in tokens]
+
+    def digest(self, value):
+        """Return a stable, non-reversible string for `value`, for use as a cache key."""
+        raise NotImplementedError
+
+    def encrypt(self, value):
+        """Encrypt and tag a value."""
+        return self.prefix + self.encrypt_raw(smart_str(value))
+
+    def encrypt_many(self, values):
+        return [self.encrypt(value) for value in values]
+
+    @property
+    def prefix(self):
+        """The tag starting every value this engine encrypts."""
+        return '%s%s%s%i%s' % (TAG, self.name, TAG, self.version, TAG)
+
+    def __repr__(self):
+        return '<%s version %s>' % (self.__class__.__name__, self.version)
+
+class BlowfishEngine(CipherEngine):
+    """The original Blowfish/ECB engine.  It is not authenticated and
+    encrypts equal values to equal strings, kept for reading old values."""
+
+    name = 'blowfish'
+
+    def __init__(self, key, version):
+        super(BlowfishEngine, self).__init__(key, version)
+        # ECB mode holds no state between calls, so one keyed object can be shared
+        self.cipher = Blowfish.new(self.key)
+        self.lock = threading.Lock()
+
+    def decrypt_raw(self, payload):
+        self.lock.acquire()
+        try:
+            # strip padding from decrypted credit card number
+            return self.cipher.decrypt(base64.b64decode(payload)).rstrip('X')
+        finally:
+            self.lock.release()
+
+    def digest(self, value):
+        return self.encrypt_raw(smart_str(value))
+
+    @property
+    def prefix(self):
+        if self.version == LEGACY_VERSION:
+            return ''
+        return super(BlowfishEngine, self).prefix
+
+    def encrypt_raw(self, value):
+        # block cipher length must be a multiple of 8
+        padding = ''
+        if (len(value) % 8) <> 0:
+            padding = 'X' * (8 - (len(value) % 8))
+        self.lock.acquire()
+        try:
+            return base64.b64encode(self.cipher.encrypt(value + padding))
+        finally:
+            self.lock.release()
+
+class AESEngine(CipherEngine):
+    """AES-256 in CBC mode with a random IV, authenticated with an
+    HMAC-SHA256 over the IV and ciphertext (encrypt-then-MAC)."""
+
+    name = 'aes'
+    MAC_LENGTH = 16
+
+    def __init__(self, key, version):
+        super(AESEngine, self).__init__(key, version)
+        self.encryption_key = hashlib.sha256('bursar.cipher.encrypt:' + self.key).digest()
+        self.mac_key = hashlib.sha256('bursar.cipher.mac:' + self.key).digest()
+
+    def _mac(self, data):
+        return hmac.new(self.mac_key, data, hashlib.sha256).digest()[:self.MAC_LENGTH]
+
+    def decrypt_raw(self, payload):
+        try:
+            data = base64.b64decode(payload)
+        except TypeError:
+            raise CipherError('Cannot decode value')
+        if len(data) < AES.block_size * 2 + self.MAC_LENGTH:
+            raise CipherError('Value is too short')
+        body, mac = data[:-self.MAC_LENGTH], data[-self.MAC_LENGTH:]
+        if not _constant_time_equal(mac, self._mac(body)):
+            raise CipherError('Value failed authentication')
+        iv, ciphertext = body[:AES.block_size], body[AES.block_size:]
+        plaintext = AES.new(self.encryption_key, AES.MODE_CBC, iv).decrypt(ciphertext)
+        return plaintext[:-ord(plaintext[-1])]
+
+    def digest(self, value):
+        return hmac.new(self.mac_key, smart_str(value), hashlib.sha256).hexdigest()
+
+    def encrypt_raw(self, value):
+        padding = AES.block_size - (len(value) % AES.block_size)
+        iv = os.urandom(AES.block_size)
+        ciphertext = AES.new(self.encryption_key, AES.MODE_CBC, iv).encrypt(value + chr(padding) * padding)
+        body = iv + ciphertext
+        return base64.b64encode(body + self._mac(body))
+
+ENGINES = {
+    'aes' : AESEngine,
+    'blowfish' : BlowfishEngine,
+}
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+def register_engine(cls):
+    """Make a CipherEngine subclass available by its name."""
+    ENGINES[cls.name] = cls
+
+def cipher_keys():
+    keys = get_bursar_setting('CIPHER_KEYS', None)
+    if not keys:
+        keys = {1 : settings.SECRET_KEY}
+    return keys
+
+def current_version():
+    version = get_bursar_setting('CIPHER_KEY_VERSION', None)
+    if version is None:
+        if get_bursar_setting('CIPHER') == BlowfishEngine.name and not get_bursar_setting('CIPHER_KEYS', None):
+            # as the original code wrote them, so existing rows are left alone
+            return LEGACY_VERSION
+        version = max(cipher_keys().keys())
+    return version
+
+def get_engine(name=None, version=None):
+    """Return the shared engine for a name and key version, by default the current ones."""
+    if name is None:
+        name = get_bursar_setting('CIPHER')
+    if version is None:
+        version = current_version()
+
+    if version == LEGACY_VERSION:
+        key = settings.SECRET_KEY
+    else:
+        try:
+            key = cipher_keys()[version]
+        except KeyError:
+            raise CipherError('No key for cipher key version %s' % version)
+    if not key:
+        raise CipherError('The key for cipher key version %s is empty' % version)
+
+    cachekey = (name, version, key)
+    engine = _engines.get(cachekey, None)
+    if engine is None:
+        try:
+            cls = ENGINES[name]
+        except KeyError:
+            raise CipherError('Unknown cipher engine: %s' % name)
+        _engines_lock.acquire()
+        try:
+            engine = _engines.get(cachekey, None)
+            if engine is None:
+                log.debug('Building %s cipher engine for key version %s', name, version)
+                engine = cls(key, version)
+                _engines[cachekey] = engine
+        finally:
+            _engines_lock.release()
+    return engine
+
+def engine_for(token):
+    """Return the engine which can decrypt `token`."""
+    name, version = parse_tag(token)
+    return get_engine(name, version)
+
+def parse_tag(token):
+    """Return the (engine name, key version) a value was encrypted with."""
+    if token and token.startswith(TAG):
+        try:
+            name, version, payload = token[1:].split(TAG, 2)
+            return name, int(version)
+        except ValueError:
+            raise CipherError('Malformed encrypted value')
+    return BlowfishEngine.name, LEGACY_VERSION
+
+def _payload(token):
+    if token and token.startswith(TAG):
+        return token.rsplit(TAG, 1)[1]
+    return token
+
+def _constant_time_equal(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def decrypt(token):
+    """Decrypt a value written by any engine and key version."""
+    return engine_for(token).decrypt(token)
+
+def decrypt_many(tokens):
+    """Decrypt a list of values, looking up each engine once."""
+    engines = {}
+    results = []
+    for token in tokens:
+        tag = parse_tag(token)
+        engine = engines.get(tag, None)
+        if engine is None:
+            engine = engines[tag] = get_engine(*tag)
+        results.append(engine.decrypt(token))
+    return results
+
+def digest(value, token=None):
+    """Return a stable cache key for `value`, using the engine and key of `token` if given."""
+    if token:
+        engine = engine_for(token)
+    else:
+        engine = get_engine()
+    return engine.digest(value)
+
+def encrypt(value):
+    """Encrypt a value with the current engine and key version."""
+    return get_engine().encrypt(value)
+
+def encrypt_many(values):
+    """Encrypt a list of values with the current engine and key version."""
+    return get_engine().encrypt_many(values)
+
+def is_current(token):
+    """True if `token` was written by the current engine and key version."""
+    name, version = parse_tag(token)
+    return name == get_bursar_setting('CIPHER') and version == current_version()
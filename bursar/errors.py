@@ -1,2 +1,17 @@
 class GatewayError(Exception):
     pass
+
+class CipherError(Exception):
+    pass
+
+class TransportError(GatewayError):
+    """A gateway could not be reached, or answered with an HTTP error status."""
+
+    def __init__(self, message, status=None, response=None):
+        super(TransportError, self).__init__(message)
+        self.status = status
+        self.response = response
+
+class CircuitOpenError(TransportError):
+    """A gateway has been failing, so requests to it are refused for now."""
+    pass
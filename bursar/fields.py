@@ -1,5 +1,6 @@
 from django import forms
 from django.db import models
+from django.db.models import F
 from django.db.models.fields import DecimalField
 from widgets import CurrencyWidget
 
@@ -21,6 +22,23 @@ class CurrencyField(DecimalField):
         return super(CurrencyField, self).formfield(**defaults)
 
 
+class BalanceField(CurrencyField):
+    """A running balance, only ever changed by UPDATEs with F() expressions.
+
+    Saving an existing row sets the column to itself, so the value on a
+    possibly stale instance is never written back over the database's."""
+
+    def pre_save(self, model_instance, add):
+        if add:
+            return super(BalanceField, self).pre_save(model_instance, add)
+        return F(self.attname)
+
+    def get_db_prep_save(self, value):
+        if hasattr(value, 'evaluate'):
+            return value
+        return super(BalanceField, self).get_db_prep_save(value)
+
+
 class RoundedDecimalField(forms.Field):
     def clean(self, value):
         """
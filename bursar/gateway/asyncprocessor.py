@@ -0,0 +1,132 @@
+"""
+Non-blocking access to a payment processor.
+
+AsyncPaymentProcessor wraps a processor, and its methods return a
+PendingResult straight after the request has been built and handed to a
+worker thread, instead of waiting for the gateway to answer::
+
+    gateway = AsyncPaymentProcessor(PaymentProcessor(settings))
+    pending = gateway.capture_payment(purchase=purchase)
+    ... do other work, or start more payments ...
+    result = pending.result()
+
+Database reads and writes stay in the thread which calls the method and
+`result()`, only the posts themselves run on the pool, so `result()` must
+be called from the thread that started the call.  Processors which have no
+steps for an operation simply run it when it is called, and hand back a
+finished PendingResult.
+
+The pool size is the ASYNC_WORKERS bursar setting, default 10.  Operations
+run as steps are counted and timed in bursar.metrics as they are when the
+processor runs them itself.
+"""
+from bursar import metrics
+from bursar.bursar_settings import get_bursar_setting
+from bursar.errors import TransportError
+from bursar.gateway import stats
+from bursar.gateway.base import NOTSET
+from bursar.gateway.steps import Parallel, Return, Steps, outcomes
+from bursar.gateway.workers import get_pool
+import time
+
+class PendingResult(object):
+    """The result of a gateway operation which may still be waiting on the gateway."""
+
+    def __init__(self, processor, coroutine, pool, operation=None):
+        self.processor = processor
+        self.pool = pool
+        self.operation = operation
+        self.steps = Steps(coroutine)
+        self.post = None
+        self.futures = []
+        start = time.time()
+        self._advance()
+        if operation is not None and self.post is not None:
+            metrics.observe('build', processor.key, operation, time.time() - start)
+        if operation in stats.ATTEMPTS:
+            metrics.increment('attempts', processor.key, operation)
+
+    def __repr__(self):
+        if self.steps.done:
+            return '<PendingResult: %r>' % self.steps.value
+        return '<PendingResult: waiting on %s>' % self.processor.key
+
+    def _advance(self, value=None, error=None):
+        self.post = self.steps.advance(value, error)
+        if self.post is None:
+            self.futures = []
+            if self.operation in stats.ATTEMPTS and getattr(self.steps.value, 'success', False):
+                metrics.increment('successes', self.processor.key, self.operation)
+        elif isinstance(self.post, Parallel):
+            self.futures = [self._submit(post) for post in self.post.posts]
+        else:
+            self.futures = [self._submit(self.post)]
+
+    def _submit(self, post):
+        return self.pool.submit(self.processor.http_post, post.url, post.data,
+            post.headers, idempotent=post.idempotent, operation=self.operation)
+    def done(self):
+        """True if result() will not wait on the gateway."""
+        if self.steps.done:
+            return True
+        for future in self.futures:
+            if not future.done():
+                return False
+        return True
+
+    def result(self, timeout=None):
+        """Wait for the gateway and return the result of the operation.
+
+        `timeout` limits each wait on the gateway, in seconds."""
+        while not self.steps.done:
+            if isinstance(self.post, Parallel):
+                self._advance(outcomes(self.futures, timeout))
+                continue
+            future = self.futures[0]
+            error = future.exception(timeout)
+            if error is not None and issubclass(error[0], TransportError):
+                self._advance(error=error)
+            elif error is not None:
+                raise error[0], error[1], error[2]
+            else:
+                self._advance(future.value)
+        return self.steps.value
+
+class AsyncPaymentProcessor(object):
+    """Runs a payment processor's operations with the gateway posts on a worker pool."""
+
+    def __init__(self, processor, pool=None):
+        self.processor = processor
+        if pool is None:
+            pool = get_pool('bursar-gateway', get_bursar_setting('ASYNC_WORKERS'))
+        self.pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self.processor, name)
+
+    def _start(self, name, *args, **kwargs):
+        steps = getattr(self.processor, name + '_steps', None)
+        if steps is None:
+            return PendingResult(self.processor, _finished(getattr(self.processor, name), args, kwargs), self.pool)
+        return PendingResult(self.processor, steps(*args, **kwargs), self.pool, operation=name)
+
+    def authorize_payment(self, purchase=None, amount=NOTSET, testing=False):
+        return self._start('authorize_payment', purchase=purchase, amount=amount, testing=testing)
+
+    def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        return self._start('capture_authorized_payment', authorization, testing=testing, purchase=purchase, amount=amount)
+
+    def capture_payment(self, testing=False, purchase=None, amount=NOTSET):
+        return self._start('capture_payment', testing=testing, purchase=purchase, amount=amount)
+
+    def confirm_ipn_data(self, data):
+        return self._start('confirm_ipn_data', data)
+
+    def release_authorized_payment(self, purchase=None, auth=None, testing=False):
+        return self._start('release_authorized_payment', purchase=purchase, auth=auth, testing=testing)
+
+def _finished(method, args, kwargs):
+    """Steps which run a plain processor method at once."""
+    raise Return(method(*args, **kwargs))
+    # never reached, makes this a generator
+    yield
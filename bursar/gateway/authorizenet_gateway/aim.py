@@ -0,0 +1,166 @@
+"""
+Authorize.net AIM responses.
+
+An AIM reply is one line of fields separated by the delimiter character,
+each optionally wrapped in the encapsulation character, so that a field
+can itself contain the delimiter::
+
+    1|1|1|This transaction has been approved.|AUTH01|Y|2149186848|...
+    "1","1","1","This transaction has been approved.","AUTH01","Y",...
+
+AimResponse gives the fields names, from the AIM implementation guide.
+Fields are parsed as they are read, and only as far as the last one read,
+so a capture that looks at the response code and transaction id never
+splits out the billing and shipping details echoed after them.
+"""
+
+# (position, name) of the fields in the AIM guide, counting from 1.  41-50
+# and 56-68 are reserved, and merchant-defined fields follow from 69 on.
+AIM_FIELDS = (
+    (1, 'response_code'),
+    (2, 'response_subcode'),
+    (3, 'reason_code'),
+    (4, 'reason_text'),
+    (5, 'auth_code'),
+    (6, 'avs_code'),
+    (7, 'transaction_id'),
+    (8, 'invoice_number'),
+    (9, 'description'),
+    (10, 'amount'),
+    (11, 'method'),
+    (12, 'transaction_type'),
+    (13, 'customer_id'),
+    (14, 'first_name'),
+    (15, 'last_name'),
+    (16, 'company'),
+    (17, 'address'),
+    (18, 'city'),
+    (19, 'state'),
+    (20, 'zip'),
+    (21, 'country'),
+    (22, 'phone'),
+    (23, 'fax'),
+    (24, 'email'),
+    (25, 'ship_to_first_name'),
+    (26, 'ship_to_last_name'),
+    (27, 'ship_to_company'),
+    (28, 'ship_to_address'),
+    (29, 'ship_to_city'),
+    (30, 'ship_to_state'),
+    (31, 'ship_to_zip'),
+    (32, 'ship_to_country'),
+    (33, 'tax'),
+    (34, 'duty'),
+    (35, 'freight'),
+    (36, 'tax_exempt'),
+    (37, 'po_number'),
+    (38, 'md5_hash'),
+    (39, 'card_code'),
+    (40, 'cavv_code'),
+    (51, 'account_number'),
+    (52, 'card_type'),
+    (53, 'split_tender_id'),
+    (54, 'requested_amount'),
+    (55, 'balance_on_card'),
+)
+
+FIELD_INDEXES = dict([(name, position - 1) for position, name in AIM_FIELDS])
+
+# the response code through the transaction id
+FIRST_FIELDS = 7
+
+APPROVED = '1'
+DECLINED = '2'
+ERROR = '3'
+HELD = '4'
+
+class AimField(object):
+    """A named field of an AimResponse."""
+
+    def __init__(self, position):
+        self.index = position - 1
+
+    def __get__(self, response, owner):
+        if response is None:
+            return self
+        return response.field(self.index)
+
+class AimResponse(object):
+    """A reply to an AIM post, with its fields as attributes."""
+
+    def __init__(self, body, delimiter='|', encapsulator=''):
+        self.body = body
+        self.delimiter = delimiter
+        self.encapsulator = encapsulator
+        self.fields = []
+        # the part of the body not yet split into fields, None once it all is
+        self.rest = body
+        if encapsulator:
+            # between fields, which is where a field ends
+            self.separator = encapsulator + delimiter + encapsulator
+        else:
+            self.separator = delimiter
+
+    def __repr__(self):
+        return '<AimResponse %s: %s>' % (self.response_code, self.reason_text)
+
+    def __getitem__(self, name):
+        return self.field(FIELD_INDEXES[name])
+
+    @property
+    def approved(self):
+        return self.response_code == APPROVED
+
+    def field(self, index):
+        """The field at `index`, counting from 0, or '' if the response is shorter."""
+        if index >= len(self.fields):
+            self._parse(index)
+            if index >= len(self.fields):
+                return ''
+        return self.fields[index]
+
+    def as_dict(self):
+        """Every named field, parsing the whole response."""
+        self._parse(None)
+        fields = self.fields
+        count = len(fields)
+        values = {}
+        for position, name in AIM_FIELDS:
+            if position <= count:
+                values[name] = fields[position - 1]
+            else:
+                values[name] = ''
+        return values
+
+    def merchant_fields(self):
+        """The merchant-defined fields echoed back after the standard ones."""
+        self._parse(None)
+        return self.fields[68:]
+
+    def _parse(self, index):
+        """Split off fields up to `index`, or to the end if it's None."""
+        if self.rest is None:
+            return
+        fields = self.fields
+        first = not fields
+        if index is None:
+            bits = self.rest.split(self.separator)
+            self.rest = None
+        else:
+            # at least the leading fields every caller reads, in one go
+            wanted = max(index + 1 - len(fields), FIRST_FIELDS)
+            bits = self.rest.split(self.separator, wanted)
+            if len(bits) > wanted:
+                self.rest = bits.pop()
+            else:
+                self.rest = None
+        if self.rest is None:
+            bits[-1] = bits[-1].rstrip('\r\n')
+            if self.encapsulator and bits[-1].endswith(self.encapsulator):
+                bits[-1] = bits[-1][:-len(self.encapsulator)]
+        if first and self.encapsulator and bits and bits[0].startswith(self.encapsulator):
+            bits[0] = bits[0][len(self.encapsulator):]
+        fields.extend(bits)
+
+for position, name in AIM_FIELDS:
+    setattr(AimResponse, name, AimField(position))
@@ -1,14 +1,28 @@
-from bursar.errors import GatewayError
+from __future__ import with_statement
+from bursar.errors import GatewayError, TransportError
+from bursar.gateway.authorizenet_gateway.aim import AimResponse
 from bursar.gateway.base import BasePaymentProcessor, ProcessorResult, NOTSET, PaymentPending
+from bursar.gateway.builder import get_builder
+from bursar.gateway.steps import Parallel, Post, Return
 from bursar.numbers import trunc_decimal
 from datetime import datetime
 from decimal import Decimal
-from django.template import loader, Context
-from django.utils.http import urlencode
+from django.utils.encoding import smart_str
 from django.utils.translation import ugettext_lazy as _
-from xml.dom import minidom
+from xml.etree import cElementTree
 import random
-import urllib2
+import re
+import StringIO
+import urllib
+
+AIM_TRANSACTIONS = (
+    ('AUTH_CAPTURE', (('x_method', 'CC'),)),
+    ('AUTH_ONLY', (('x_method', 'CC'),)),
+    ('PRIOR_AUTH_CAPTURE', ()),
+    ('VOID', ()),
+)
+ARB_FIELDS = ('resultCode', 'code', 'text', 'subscriptionId')
+ARB_REDACT = re.compile(r'<(cardNumber|transactionKey)>[^<]*</\1>')
 
 class PaymentProcessor(BasePaymentProcessor):
     """
@@ -20,6 +34,8 @@ class PaymentProcessor(BasePaymentProcessor):
     Settings:
         ARB: Enable ARB processing for setting up subscriptions.  Note: You 
             must have this enabled in your Authorize account for it to work.
+        ARB_CONCURRENT: Post all of a purchase's subscriptions at once, rather than
+            one at a time.
         ARB_CONNECTION: Submit to URL for ARB transactions. This is the address 
             to submit live transactions for ARB.
         CAPTURE: Capture Payment immediately? IMPORTANT: If false, 
@@ -31,6 +47,8 @@ class PaymentProcessor(BasePaymentProcessor):
             "cpdev" or "cnpdev", you will get an Error 13 message. 
             Make sure you are posting to https://certification.authorize.net/gateway/transact.dll
             for test transactions if you do not have a cpdev or cnpdev.
+        DELIM_CHAR: The character separating the fields of AIM responses.
+        ENCAP_CHAR: The character wrapping each field of AIM responses, if any.
         CREDITCHOICES: Available credit cards, as (key, name).  To add American Express, 
             use (('American Express', 'American Express'))
         EXTRA_LOGGING: Verbose Logs?
@@ -57,10 +75,13 @@ class PaymentProcessor(BasePaymentProcessor):
                 (('American Express', 'American Express'))
             ),
             'CAPTURE' : True,
+            'DELIM_CHAR' : '|',
+            'ENCAP_CHAR' : '',
             'EXTRA_LOGGING' : False,
             'ARB' : False,
             'ARB_CONNECTION' : 'https://api.authorize.net/xml/v1/request.api',
             'ARB_CONNECTION_TEST' : 'https://apitest.authorize.net/xml/v1/request.api',
+            'ARB_CONCURRENT' : True,
             'STORE_NAME' : "",
             'TRANKEY' : "",
             }
@@ -68,11 +89,43 @@ class PaymentProcessor(BasePaymentProcessor):
         super(PaymentProcessor, self).__init__('authorizenet', working_settings)
         self.require_settings('LOGIN', 'STORE_NAME', 'TRANKEY')
 
+        # the connection and configuration are the same for every AIM post, so encode them once
+        if self.is_live():
+            self.connection = self.settings['CONNECTION']
+        else:
+            self.connection = self.settings['CONNECTION_TEST']
+        if self.settings['SIMULATE']:
+            testflag = 'TRUE'
+        else:
+            testflag = 'FALSE'
+        configuration = [
+            ('x_login', self.settings['LOGIN']),
+            ('x_tran_key', self.settings['TRANKEY']),
+            ('x_version', '3.1'),
+            ('x_relay_response', 'FALSE'),
+            ('x_test_request', testflag),
+            ('x_delim_data', 'TRUE'),
+            ('x_delim_char', self.settings['DELIM_CHAR']),
+        ]
+        if self.settings['ENCAP_CHAR']:
+            configuration.append(('x_encap_char', self.settings['ENCAP_CHAR']))
+        self.prefixes = {}
+        self.log_prefixes = {}
+        for transaction_type, fields in AIM_TRANSACTIONS:
+            fields = configuration + [('x_type', transaction_type)] + list(fields)
+            self.prefixes[transaction_type] = encode_fields(fields)
+            self.log_prefixes[transaction_type] = encode_fields([(name, name == 'x_tran_key' and 'REDACTED' or value)
+                for name, value in fields])
+
     def authorize_payment(self, purchase=None, amount=NOTSET, testing=False):
         """Authorize a single payment.
         
         Returns: ProcessorResult
         """
+        return self.run_steps(self.authorize_payment_steps(purchase=purchase, amount=amount, testing=testing))
+
+    def authorize_payment_steps(self, purchase=None, amount=NOTSET, testing=False):
+        """Steps for authorize_payment, see bursar.gateway.steps."""
         assert(purchase)
         if purchase.remaining == Decimal('0.00'):
             self.log_extra('%s is paid in full, no authorization attempted.', purchase)
@@ -86,10 +139,11 @@ class PaymentProcessor(BasePaymentProcessor):
                     amount = purchase.remaining
             self.log_extra('Authorizing payment of %s for %s', amount, purchase)
 
-            standard = self.get_standard_charge_data(authorize=True, purchase=purchase, amount=amount)
-            results = self.send_post(standard, testing, purchase=purchase)
+            with purchase.processing():
+                standard = self.get_standard_charge_data(authorize=True, purchase=purchase, amount=amount)
+            results = yield self.send_post_steps(standard, testing, purchase=purchase)
 
-        return results
+        raise Return(results)
 
     def can_authorize(self):
         return True
@@ -99,10 +153,15 @@ class PaymentProcessor(BasePaymentProcessor):
 
     def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
         """Capture a single payment"""
+        return self.run_steps(self.capture_authorized_payment_steps(authorization, testing=testing,
+            purchase=purchase, amount=amount))
+
+    def capture_authorized_payment_steps(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        """Steps for capture_authorized_payment, see bursar.gateway.steps."""
         assert(purchase)
         if purchase.authorized_remaining == Decimal('0.00'):
             self.log_extra('No remaining authorizations on %s', purchase)
-            return ProcessorResult(self.key, True, _("Already complete"))
+            raise Return(ProcessorResult(self.key, True, _("Already complete")))
 
         self.log_extra('Capturing Authorization #%i of %s', authorization.id, amount)
         if amount==NOTSET:
@@ -110,31 +169,36 @@ class PaymentProcessor(BasePaymentProcessor):
         data = self.get_prior_auth_data(authorization, amount=amount)
         results = None
         if data:
-            results = self.send_post(data, testing, purchase=purchase)
+            results = yield self.send_post_steps(data, testing, purchase=purchase)
         
-        return results
+        raise Return(results)
         
     def capture_payment(self, testing=False, purchase=None, amount=NOTSET):
         """Process payments without an authorization step."""
+        return self.run_steps(self.capture_payment_steps(testing=testing, purchase=purchase, amount=amount))
+
+    def capture_payment_steps(self, testing=False, purchase=None, amount=NOTSET):
+        """Steps for capture_payment, see bursar.gateway.steps."""
         assert(purchase)
-        recurlist = self.get_recurring_charge_data(purchase=purchase)
-        if recurlist:
-            success, results = self.process_recurring_subscriptions(recurlist, testing)
-            if not success:
-                self.log_extra('recur payment failed, aborting the rest of the module')
-                return results
+        with purchase.processing():
+            recurlist = self.get_recurring_charge_data(purchase=purchase)
+            if recurlist:
+                success, results = yield self.process_recurring_subscriptions_steps(recurlist, purchase=purchase, testing=testing)
+                if not success:
+                    self.log_extra('recur payment failed, aborting the rest of the module')
+                    raise Return(results)
+
+            if purchase.remaining == Decimal('0.00'):
+                self.log_extra('%s is paid in full, no capture attempted.', purchase)
+                results = ProcessorResult(self.key, True, _("No charge needed, paid in full."))
+                self.record_payment(purchase=purchase)
+            else:
+                self.log_extra('Capturing payment for %s', purchase)
 
-        if purchase.remaining == Decimal('0.00'):
-            self.log_extra('%s is paid in full, no capture attempted.', purchase)
-            results = ProcessorResult(self.key, True, _("No charge needed, paid in full."))
-            self.record_payment(purchase=purchase)
-        else:
-            self.log_extra('Capturing payment for %s', purchase)
-            
-            standard = self.get_standard_charge_data(amount=amount, purchase=purchase)
-            results = self.send_post(standard, testing, purchase=purchase)
-            
-        return results
+                standard = self.get_standard_charge_data(amount=amount, purchase=purchase)
+                results = yield self.send_post_steps(standard, testing, purchase=purchase)
+
+        raise Return(results)
 
     def get_prior_auth_data(self, authorization, amount=NOTSET):
         """Build the dictionary needed to process a prior auth capture."""
@@ -147,47 +211,14 @@ class PaymentProcessor(BasePaymentProcessor):
         
         balance = trunc_decimal(amount, 2)
         trans['amount'] = amount
-        
-        if self.is_live():
-            conn = self.settings["CONNECTION"]
-            self.log_extra('Using live connection.')
-        else:
-            testflag = 'TRUE'
-            conn = self.settings["CONNECTION_TEST"]
-            self.log_extra('Using test connection.')
-            
-        if self.settings["SIMULATE"]:
-            testflag = 'TRUE'
-        else:
-            testflag = 'FALSE'
-
-        trans['connection'] = conn
+        trans['connection'] = self.connection
 
-        trans['configuration'] = {
-            'x_login' : self.settings["LOGIN"],
-            'x_tran_key' : self.settings["TRANKEY"],
-            'x_version' : '3.1',
-            'x_relay_response' : 'FALSE',
-            'x_test_request' : testflag,
-            'x_delim_data' : 'TRUE',
-            'x_delim_char' : '|',
-            'x_type': 'PRIOR_AUTH_CAPTURE',
-            'x_trans_id' : authorization.transaction_id
-            }
-        
-        self.log_extra('prior auth configuration: %s', trans['configuration'])
-                
-        trans['transactionData'] = {
-            'x_amount' : balance,
-            }
+        fields = encode_fields((('x_trans_id', authorization.transaction_id), ('x_amount', balance)))
+        trans['postString'] = '&'.join((self.prefixes['PRIOR_AUTH_CAPTURE'], fields))
+        if self.settings['EXTRA_LOGGING']:
+            trans['logPostString'] = '&'.join((self.log_prefixes['PRIOR_AUTH_CAPTURE'], fields))
+            self.log_extra('prior auth poststring: %s', trans['logPostString'])
 
-        part1 = urlencode(trans['configuration']) 
-        postdata = part1 + "&" + urlencode(trans['transactionData'])
-        trans['postString'] = postdata
-        
-        self.log_extra('prior auth poststring: %s', postdata)
-        trans['logPostString'] = postdata
-        
         return trans
         
         
@@ -196,42 +227,14 @@ class PaymentProcessor(BasePaymentProcessor):
         trans = {
             'authorization' : authorization,
             'amount' : Decimal('0.00'),
+            'connection' : self.connection,
         }
 
-        if self.is_live():
-            conn = self.settings['CONNECTION']
-            self.log_extra('Using live connection.')
-        else:
-            testflag = 'TRUE'
-            conn = self.settings["CONNECTION_TEST"]
-            self.log_extra('Using test connection.')
-
-        if self.settings['SIMULATE']:
-            testflag = 'TRUE'
-        else:
-            testflag = 'FALSE'
-
-        trans['connection'] = conn
-
-        trans['configuration'] = {
-            'x_login' : self.settings["LOGIN"],
-            'x_tran_key' : self.settings["TRANKEY"],
-            'x_version' : '3.1',
-            'x_relay_response' : 'FALSE',
-            'x_test_request' : testflag,
-            'x_delim_data' : 'TRUE',
-            'x_delim_char' : '|',
-            'x_type': 'VOID',
-            'x_trans_id' : authorization.transaction_id
-            }
-
-        self.log_extra('void auth configuration: %s', trans['configuration'])
-
-        postdata = urlencode(trans['configuration']) 
-        trans['postString'] = postdata
-
-        self.log_extra('void auth poststring: %s', postdata)
-        trans['logPostString'] = postdata
+        fields = encode_fields((('x_trans_id', authorization.transaction_id),))
+        trans['postString'] = '&'.join((self.prefixes['VOID'], fields))
+        if self.settings['EXTRA_LOGGING']:
+            trans['logPostString'] = '&'.join((self.log_prefixes['VOID'], fields))
+            self.log_extra('void auth poststring: %s', trans['logPostString'])
 
         return trans
 
@@ -269,7 +272,7 @@ class PaymentProcessor(BasePaymentProcessor):
             'shop_name' : self.settings['STORE_NAME'],
         }
         trans['purchase'] = purchase
-        cc = self.purchase.credit_card
+        cc = purchase.credit_card
         trans['card'] = cc
         trans['card_expiration'] =  "%4i-%02i" % (cc.expire_year, cc.expire_month)
         
@@ -323,58 +326,28 @@ class PaymentProcessor(BasePaymentProcessor):
         balance = trunc_decimal(amount, 2)
         trans['amount'] = balance
         
-        if self.is_live():
-            conn = self.settings['CONNECTION']
-            self.log_extra('Using live connection.')
-        else:
-            testflag = 'TRUE'
-            conn = self.settings['CONNECTION_TEST']
-            self.log_extra('Using test connection.')
-            
-        if self.settings['SIMULATE']:
-            testflag = 'TRUE'
-        else:
-            testflag = 'FALSE'
-
-        trans['connection'] = conn
-            
+        trans['connection'] = self.connection
         trans['authorize_only'] = authorize
 
         if not authorize:
             transaction_type = 'AUTH_CAPTURE'
         else:
             transaction_type = 'AUTH_ONLY'
-                        
-        trans['configuration'] = {
-            'x_login' : self.settings['LOGIN'],
-            'x_tran_key' : self.settings['TRANKEY'],
-            'x_version' : '3.1',
-            'x_relay_response' : 'FALSE',
-            'x_test_request' : testflag,
-            'x_delim_data' : 'TRUE',
-            'x_delim_char' : '|',
-            'x_type': transaction_type,
-            'x_method': 'CC',
-            }
-        
-        self.log_extra('standard charges configuration: %s', trans['configuration'])
-        
-        trans['custBillData'] = {
-            'x_first_name' : purchase.first_name,
-            'x_last_name' : purchase.last_name,
-            'x_address': purchase.full_bill_street,
-            'x_city': purchase.bill_city,
-            'x_state' : purchase.bill_state,
-            'x_zip' : purchase.bill_postal_code,
-            'x_country': purchase.bill_country,
-            'x_phone' : purchase.phone,
-            'x_email' : purchase.email,
-            }
-    
-        self.log_extra('standard charges configuration: %s', trans['custBillData'])
+
+        bill = encode_fields((
+            ('x_first_name', purchase.first_name),
+            ('x_last_name', purchase.last_name),
+            ('x_address', purchase.full_bill_street),
+            ('x_city', purchase.bill_city),
+            ('x_state', purchase.bill_state),
+            ('x_zip', purchase.bill_postal_code),
+            ('x_country', purchase.bill_country),
+            ('x_phone', purchase.phone),
+            ('x_email', purchase.email),
+            ))
         
         invoice = "%s" % purchase.orderno
-        failct = purchase.paymentfailures.count()
+        failct = purchase.failure_count
         if failct > 0:
             invoice = "%s_%i" % (invoice, failct)
 
@@ -392,135 +365,205 @@ class PaymentProcessor(BasePaymentProcessor):
             else:
                 self.log_extra('Setting a bad credit card number to force an error')
                 cc = '1234'
-        trans['transactionData'] = {
-            'x_amount' : balance,
-            'x_card_num' : cc,
-            'x_exp_date' : card.expirationDate,
-            'x_card_code' : ccv,
-            'x_invoice_num' : invoice
-            }
+        parts = [self.prefixes[transaction_type]]
+        append_fields(parts, (
+            ('x_amount', balance),
+            ('x_card_num', cc),
+            ('x_exp_date', card.expirationDate),
+            ('x_card_code', ccv),
+            ('x_invoice_num', invoice),
+            ))
+        parts.append('&')
+        parts.append(bill)
+        trans['postString'] = ''.join(parts)
 
-        part1 = urlencode(trans['configuration']) + "&"
-        part2 = "&" + urlencode(trans['custBillData'])
-        trans['postString'] = part1 + urlencode(trans['transactionData']) + part2
-        
-        redactedData = {
-            'x_amount' : balance,
-            'x_card_num' : card.display_cc,
-            'x_exp_date' : card.expirationDate,
-            'x_card_code' : "REDACTED",
-            'x_invoice_num' : invoice
-        }
-        self.log_extra('standard charges transactionData: %s', redactedData)
-        trans['logPostString'] = part1 + urlencode(redactedData) + part2
+        if self.settings['EXTRA_LOGGING']:
+            parts = [self.log_prefixes[transaction_type]]
+            append_fields(parts, (
+                ('x_amount', balance),
+                ('x_card_num', card.display_cc),
+                ('x_exp_date', card.expirationDate),
+                ('x_card_code', 'REDACTED'),
+                ('x_invoice_num', invoice),
+                ))
+            parts.append('&')
+            parts.append(bill)
+            trans['logPostString'] = ''.join(parts)
+            self.log_extra('standard charges poststring: %s', trans['logPostString'])
         
         return trans
         
     def process_recurring_subscriptions(self, recurlist, purchase=None, testing=False):
         """Post all subscription requests."""    
+        return self.run_steps(self.process_recurring_subscriptions_steps(recurlist, purchase=purchase, testing=testing))
+
+    def process_recurring_subscriptions_steps(self, recurlist, purchase=None, testing=False):
+        """Steps for process_recurring_subscriptions, see bursar.gateway.steps.
+
+        A purchase's subscriptions are created all or none.  With ARB_CONCURRENT
+        they are posted together, otherwise one at a time, stopping at the first
+        failure.  If any fails, the ones which were created are cancelled, nothing
+        is recorded, and the result holds the first failure in `recurlist` order.
+        Otherwise the payments are recorded in `recurlist` order.
+
+        Returns (success, [ProcessorResult, ...])
+        """
         assert(purchase)
+        if self.settings['ARB_CONCURRENT'] and len(recurlist) > 1:
+            responses = yield Parallel([self.get_subscription_post(recur) for recur in recurlist])
+            outcomes = [self.parse_subscription_response(recur, response)
+                for recur, response in zip(recurlist, responses)]
+        else:
+            outcomes = []
+            for recur in recurlist:
+                outcome = yield self.process_recurring_subscription_steps(recur, testing=testing)
+                outcomes.append(outcome)
+                if not outcome[0]:
+                    break
+
+        failures = [outcome for outcome in outcomes if not outcome[0]]
+        if failures:
+            success, reason, response, subscription_id = failures[0]
+            self.log.info("Failed to process recurring subscription, %s: %s", reason, response)
+            created = [outcome[3] for outcome in outcomes if outcome[0]]
+            if created:
+                yield self.cancel_subscriptions_steps(recurlist[0], created)
+            raise Return((False, [ProcessorResult(self.key, False, response)]))
+
         results = []
-        for recur in recurlist:
-            success, reason, response, subscription_id = self.process_recurring_subscription(recur, testing=testing)
-            if success:
-                if not testing:
-                    payment = self.record_payment(purchase=purchase, amount=recur['charged_today'], transaction_id=subscription_id, reason_code=reason)
-                    results.append(ProcessorResult(self.key, success, response, payment=payment))
-            else:
-                self.log.info("Failed to process recurring subscription, %s: %s", reason, response)
-                break
-        
-        return success, results
-        
+        for recur, (success, reason, response, subscription_id) in zip(recurlist, outcomes):
+            if not testing:
+                payment = self.record_payment(purchase=purchase, amount=recur['charged_today'], transaction_id=subscription_id, reason_code=reason)
+                results.append(ProcessorResult(self.key, success, response, payment=payment))
+
+        raise Return((True, results))
+
     def process_recurring_subscription(self, data, testing=False):
         """Post one subscription request."""
-        self.log_extra('Processing subscription: %s', data['product'].slug)
-        
-        t = loader.get_template('bursar/gateway/authorizenet_gateway/arb_create_subscription.xml')
-        ctx = Context(data)
-        request = t.render(ctx)
-        
+        return self.run_steps(self.process_recurring_subscription_steps(data, testing=testing))
+
+    def process_recurring_subscription_steps(self, data, testing=False):
+        """Steps for process_recurring_subscription, see bursar.gateway.steps.
+
+        Returns (success, reason code, response text, subscription id)
+        """
+        response = yield self.get_subscription_post(data)
+        raise Return(self.parse_subscription_response(data, response))
+
+    def cancel_subscriptions_steps(self, data, subscription_ids):
+        """Steps cancelling subscriptions, posted together.  `data` is any of the
+        purchase's subscription dictionaries, for the connection and credentials.
+
+        Returns the ids which could not be cancelled."""
+        builder = get_builder('bursar/gateway/authorizenet_gateway/arb_cancel_subscription.xml')
+        posts = []
+        for subscription_id in subscription_ids:
+            request = builder.build({'config' : data['config'], 'subscription_id' : subscription_id})
+            # cancelling is safe to retry
+            posts.append(Post(data['connection'], request, {'Content-type':'text/xml'}, idempotent=True))
+        responses = yield Parallel(posts)
+
+        failed = []
+        for subscription_id, response in zip(subscription_ids, responses):
+            if isinstance(response, TransportError):
+                success = False
+            else:
+                success = parse_arb_response(response.body).get('resultCode', None) == 'Ok'
+            if not success:
+                failed.append(subscription_id)
+        if failed:
+            self.log.error("Could not cancel subscriptions %s, they must be cancelled by hand", ', '.join(failed))
+        else:
+            self.log_extra('Cancelled subscriptions %s', ', '.join(subscription_ids))
+        raise Return(failed)
+
+    def get_subscription_post(self, data):
+        """Build the Post creating one subscription."""
+        self.log_extra('Processing subscription: %s', data['product'])
+        request = get_builder('bursar/gateway/authorizenet_gateway/arb_create_subscription.xml').build(data)
         if self.settings['EXTRA_LOGGING']:
-            data['redact'] = True
-            ctx = Context(data)
-            redacted = t.render(ctx)
-            self.log_extra('Posting data to: %s\n%s', data['connection'], redacted)
-        
-        headers = {'Content-type':'text/xml'}
-        conn = urllib2.Request(data['connection'], request, headers)
-        try:
-            f = urllib2.urlopen(conn)
-            all_results = f.read()
-        except urllib2.URLError, ue:
-            self.log.error("error opening %s\n%s", data['connection'], ue)
+            self.log_extra('Posting data to: %s\n%s', data['connection'], redact_arb(request))
+        return Post(data['connection'], request, {'Content-type':'text/xml'})
+
+    def parse_subscription_response(self, data, response):
+        """Read the outcome of a subscription Post, the Response or TransportError it got.
+
+        Returns (success, reason code, response text, subscription id)
+        """
+        if isinstance(response, TransportError):
+            self.log.error("error opening %s\n%s", data['connection'], response)
             return (False, 'ERROR', _('Could not talk to Authorize.net gateway'), None)
-        
+
+        all_results = response.body
         self.log_extra('Authorize response: %s', all_results)
-        
-        subscriptionID = None
         try:
-            response = minidom.parseString(all_results)
-            doc = response.documentElement
-            reason = doc.getElementsByTagName('code')[0].firstChild.nodeValue
-            response_text = doc.getElementsByTagName('text')[0].firstChild.nodeValue                
-            result = doc.getElementsByTagName('resultCode')[0].firstChild.nodeValue
-            success = result == "Ok"
-
+            values = parse_arb_response(all_results)
+            reason = values['code']
+            response_text = values['text']
+            success = values['resultCode'] == "Ok"
+            subscriptionID = None
             if success:
-                #refID = doc.getElementsByTagName('refId')[0].firstChild.nodeValue
-                subscriptionID = doc.getElementsByTagName('subscriptionId')[0].firstChild.nodeValue
+                subscriptionID = values['subscriptionId']
         except Exception, e:
             self.log.error("Error %s\nCould not parse response: %s", e, all_results)
             success = False
             reason = "Parse Error"
             response_text = "Could not parse response"
-            
-        return success, reason, response_text, subscriptionID
-        
+            subscriptionID = None
+
+        return (success, reason, response_text, subscriptionID)
         
     def release_authorized_payment(self, purchase=None, auth=None, testing=False):
         """Release a previously authorized payment."""
+        return self.run_steps(self.release_authorized_payment_steps(purchase=purchase, auth=auth, testing=testing))
+
+    def release_authorized_payment_steps(self, purchase=None, auth=None, testing=False):
+        """Steps for release_authorized_payment, see bursar.gateway.steps."""
         assert(purchase)
         self.log_extra('Releasing Authorization #%i for %s', auth.id, purchase)
         data = self.get_void_auth_data(auth)
         results = None
         if data:
-            results = self.send_post(data, testing, purchase=purchase)
+            # voids can safely be retried
+            results = yield self.send_post_steps(data, testing, purchase=purchase, idempotent=True)
             
         if results.success:
-            auth.complete = True
-            auth.save()
+            self.record_release(auth, purchase=purchase)
             
-        return results
+        raise Return(results)
         
-    def send_post(self, data, testing=False, purchase=None, amount=NOTSET):
+    def send_post(self, data, testing=False, purchase=None, amount=NOTSET, idempotent=False):
         """Execute the post to Authorize Net.
         
         Params:
         - data: dictionary as returned by get_standard_charge_data
         - testing: if true, then don't record the payment
+        - idempotent: if true, the post is retried when the gateway can't be reached
         
         Returns:
         - ProcessorResult
         """
+        return self.run_steps(self.send_post_steps(data, testing=testing, purchase=purchase,
+            amount=amount, idempotent=idempotent))
+
+    def send_post_steps(self, data, testing=False, purchase=None, amount=NOTSET, idempotent=False):
+        """Steps for send_post, see bursar.gateway.steps."""
         assert(purchase)
-        self.log.info("About to send a request to authorize.net: %(connection)s\n%(logPostString)s", data)
+        self.log.info("About to send a request to authorize.net: %s", data['connection'])
 
-        conn = urllib2.Request(url=data['connection'], data=data['postString'])
         try:
-            f = urllib2.urlopen(conn)
-            all_results = f.read()
-            self.log_extra('Authorize response: %s', all_results)
-        except urllib2.URLError, ue:
-            self.log.error("error opening %s\n%s", data['connection'], ue)
-            return ProcessorResult(self.key, False, _('Could not talk to Authorize.net gateway'))
+            response = yield Post(data['connection'], data['postString'], idempotent=idempotent)
+            self.log_extra('Authorize response: %s', response.body)
+        except TransportError, te:
+            self.log.error("error opening %s\n%s", data['connection'], te)
+            raise Return(ProcessorResult(self.key, False, _('Could not talk to Authorize.net gateway')))
             
-        parsed_results = all_results.split(data['configuration']['x_delim_char'])
-        response_code = parsed_results[0]
-        reason_code = parsed_results[1]
-        response_text = parsed_results[3]
-        transaction_id = parsed_results[6]
-        success = response_code == '1'
+        aim = AimResponse(response.body, delimiter=self.settings['DELIM_CHAR'],
+            encapsulator=self.settings['ENCAP_CHAR'])
+        reason_code = aim.reason_code
+        response_text = aim.reason_text
+        transaction_id = aim.transaction_id
+        success = aim.approved
         if amount == NOTSET:
             amount = data['amount']
 
@@ -544,4 +587,34 @@ class PaymentProcessor(BasePaymentProcessor):
                 reason_code=reason_code, details=response_text, purchase=purchase)
 
         self.log_extra("Returning success=%s, reason=%s, response_text=%s", success, reason_code, response_text)
-        return ProcessorResult(self.key, success, response_text, payment=payment)
+        raise Return(ProcessorResult(self.key, success, response_text, payment=payment, response=aim))
+
+def append_fields(parts, fields):
+    """Append (name, value) pairs to `parts` url encoded, each after an "&"."""
+    for name, value in fields:
+        parts.append('&')
+        parts.append(name)
+        parts.append('=')
+        parts.append(urllib.quote_plus(smart_str(value)))
+
+def encode_fields(fields):
+    """URL encode (name, value) pairs, as urlencode does but in their given order."""
+    parts = []
+    append_fields(parts, fields)
+    return ''.join(parts[1:])
+
+def parse_arb_response(body):
+    """Read the result code, message code and text, and subscription id from an ARB
+    response, streaming through it and keeping the first of each."""
+    values = {}
+    for event, element in cElementTree.iterparse(StringIO.StringIO(body)):
+        # tags are namespaced, "{AnetApi/xml/v1/schema/AnetApiSchema.xsd}code"
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag in ARB_FIELDS and tag not in values:
+            values[tag] = element.text
+        element.clear()
+    return values
+
+def redact_arb(request):
+    """Mask the card number and transaction key in an ARB request, for logging."""
+    return ARB_REDACT.sub(r'<\1>REDACTED</\1>', request)
@@ -1,23 +1,60 @@
 # -*- coding: UTF-8 -*-
 """Bursar Authorizenet Gateway Tests."""
-from bursar.gateway.authorizenet_gateway import processor
+from __future__ import with_statement
+from bursar.gateway.authorizenet_gateway import aim, processor
+from bursar.gateway.asyncprocessor import AsyncPaymentProcessor, PendingResult
+from bursar.gateway.workers import WorkerPool
 from bursar.errors import GatewayError
-from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
-from bursar.bursar_settings import get_bursar_setting
+from bursar.models import Authorization, Payment, Purchase
+from bursar.gateway.builder import get_builder
+from bursar.gateway.simulator.server import SimulatorServer
+from bursar.tests import make_test_purchase, GatewayServer, QueryCounter, read_golden, run_within_budget
+from bursar.bursar_settings import get_bursar_setting, set_bursar_setting
 from decimal import Decimal
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core import urlresolvers
+from django.core.management import call_command
 from django.core.urlresolvers import reverse as url
+from django.template import Context, loader
 from django.test import TestCase
 from django.test.client import Client
+import cgi
+import re
+import time
 
 SKIP_TESTS = False
 NEED_SETTINGS = """Tests for authorizenet_gateway module require an
 AUTHORIZENET_TEST section in settings.BURSAR_SETTINGS.  At a 
 minimum, you must specify the LOGIN, TRANKEY, and STORE_NAME."""
 
+# the most SQL queries each operation may run
+QUERY_BUDGETS = {
+    'authorize_payment' : 3,
+    'capture_payment' : 2,
+    'capture_authorized_payment' : 6,
+    'release_authorized_payment' : 5,
+    'record_authorization' : 3,
+    'record_payment' : 6,
+    'record_release' : 3,
+}
+
+SUBSCRIPTION_DATA = {
+    'config' : {'merchantID' : 'acme_store', 'transactionKey' : 'k3y&<key>', 'shop_name' : 'Acme & Co'},
+    'purchase' : {'id' : 42, 'orderno' : 'A-1042', 'email' : 'zoe@example.com', 'phone' : '555-555-1234',
+        'first_name' : u'Zo\xeb', 'last_name' : "O'Brien"},
+    'card' : {'decryptedCC' : '4111111111111111'},
+    'card_expiration' : '2012-12',
+    'subscription' : {'pk' : 7, 'expire_length' : 1, 'expire_unit' : 'MONTH', 'trial' : True},
+    'product' : 'Gold <Plan>',
+    'occurrences' : 12,
+    'trial_occurrences' : 1,
+    'amount' : Decimal('9.99'),
+    'trial_amount' : Decimal('0.00'),
+}
+
+START_DATE = re.compile(r'<startDate>[^<]*</startDate>')
+
 class TestGateway(TestCase):
     def setUp(self):
         global SKIP_TESTS
@@ -114,3 +151,294 @@ class TestGateway(TestCase):
         pend2 = self.gateway.create_pending_payment(purchase=purchase, amount=purchase.total)
     
         self.assertEqual(purchase.paymentspending.count(), 1)
+
+class TestRequestQueries(TestCase):
+    """Building a request must not touch the database once the purchase is loaded."""
+    def setUp(self):
+        self.gateway = processor.PaymentProcessor(settings={
+            'LOGIN' : 'test', 'TRANKEY' : 'test', 'STORE_NAME' : 'test'})
+        self.default_payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def test_standard_charge_data(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        purchase = Purchase.objects.for_processing(purchase.pk)
+        with QueryCounter() as counter:
+            data = self.gateway.get_standard_charge_data(purchase=purchase)
+        self.assertEqual(counter.count, 0, counter.queries)
+        self.assert_('x_card_num=4111111111111111' in data['postString'])
+        self.failIf('logPostString' in data)
+
+    def test_post_strings(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        purchase = Purchase.objects.for_processing(purchase.pk)
+        data = self.gateway.get_standard_charge_data(purchase=purchase, authorize=True)
+        fields = cgi.parse_qs(data['postString'])
+        self.assertEqual(fields['x_type'], ['AUTH_ONLY'])
+        self.assertEqual(fields['x_method'], ['CC'])
+        self.assertEqual(fields['x_tran_key'], ['test'])
+        self.assertEqual(fields['x_test_request'], ['FALSE'])
+        self.assertEqual(fields['x_amount'], [str(data['amount'])])
+        self.assertEqual(fields['x_card_num'], ['4111111111111111'])
+        self.assertEqual(fields['x_email'], [purchase.email])
+        self.assertEqual(fields['x_address'], [purchase.full_bill_street])
+
+        auth = Authorization(purchase=purchase, method='authorizenet', amount=Decimal('20.00'), transaction_id='A&1')
+        fields = cgi.parse_qs(self.gateway.get_prior_auth_data(auth, amount=Decimal('5'))['postString'])
+        self.assertEqual(fields['x_type'], ['PRIOR_AUTH_CAPTURE'])
+        self.assertEqual(fields['x_trans_id'], ['A&1'])
+        self.failIf('x_method' in fields)
+        fields = cgi.parse_qs(self.gateway.get_void_auth_data(auth)['postString'])
+        self.assertEqual(fields['x_type'], ['VOID'])
+        self.assertEqual(fields['x_trans_id'], ['A&1'])
+
+    def test_log_post_string(self):
+        gateway = processor.PaymentProcessor(settings={
+            'LOGIN' : 'test', 'TRANKEY' : 'secret', 'STORE_NAME' : 'test', 'EXTRA_LOGGING' : True})
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        purchase = Purchase.objects.for_processing(purchase.pk)
+        data = gateway.get_standard_charge_data(purchase=purchase)
+        self.assert_('x_tran_key=secret' in data['postString'])
+        fields = cgi.parse_qs(data['logPostString'])
+        self.assertEqual(fields['x_tran_key'], ['REDACTED'])
+        self.assertEqual(fields['x_card_code'], ['REDACTED'])
+        self.assertEqual(fields['x_card_num'], ['1111'])
+
+class TestQueryBudgets(TestCase):
+    """Each operation against the gateway simulator, within its query budget."""
+    def setUp(self):
+        self.server = SimulatorServer()
+        self.gateway = processor.PaymentProcessor(dict(self.server.gateway_settings('authorizenet'), LOGIN='test', TRANKEY='test', STORE_NAME='test'))
+        self.default_payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def purchase(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        return Purchase.objects.for_processing(purchase.pk)
+
+    def test_query_budgets(self):
+        purchase = self.purchase()
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.authorize_payment, purchase=purchase)
+        self.assert_(result.success, result.message)
+        self.assertEqual(result.stats.http_posts, 1)
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_authorized_payment, result.payment,
+            purchase=purchase)
+        self.assert_(result.success, result.message)
+
+        purchase = self.purchase()
+        auth = self.gateway.authorize_payment(purchase=purchase).payment
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.release_authorized_payment, purchase=purchase,
+            auth=auth)
+        self.assert_(result.success, result.message)
+
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_payment, purchase=self.purchase())
+        self.assert_(result.success, result.message)
+
+class TestAsyncProcessor(TestCase):
+    """Posts run on worker threads, while the database work stays in the calling thread."""
+    def setUp(self):
+        self.server = GatewayServer(reply='1|1|1|This transaction has been approved.|AUTH01|Y|async0001', delay=0.2)
+        self.gateway = processor.PaymentProcessor(settings={
+            'LOGIN' : 'test', 'TRANKEY' : 'test', 'STORE_NAME' : 'test',
+            'CONNECTION_TEST' : self.server.url + '/gateway/transact.dll'})
+        self.default_payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_capture(self):
+        purchase = make_test_purchase(sub_total=Decimal('10.00'), payment=self.default_payment)
+        pending = AsyncPaymentProcessor(self.gateway).capture_payment(purchase=purchase)
+        self.failIf(pending.done())
+        result = pending.result(timeout=5)
+        self.assert_(result.success)
+        self.assertEqual(result.payment.transaction_id, 'async0001')
+        self.assertEqual(result.response.auth_code, 'AUTH01')
+        self.assertEqual(result.response.avs_code, 'Y')
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).remaining, Decimal('0.00'))
+        self.assert_('x_card_num=4111111111111111' in self.server.posts[0][1])
+
+    def test_authorize(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        result = self.gateway.authorize_payment(purchase=purchase)
+        self.assert_(result.success)
+        self.assertEqual(purchase.authorized_remaining, Decimal('20.00'))
+
+    def test_capture_command(self):
+        """Test the capture_authorizations command, building the processor from BURSAR_SETTINGS
+        and skipping a method with no settings."""
+        saved = get_bursar_setting('AUTHORIZENET_TEST')
+        set_bursar_setting('AUTHORIZENET_TEST', self.gateway.settings)
+        try:
+            purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+            self.assert_(self.gateway.authorize_payment(purchase=purchase).success)
+            unconfigured = make_test_purchase(sub_total=Decimal('10.00'))
+            Authorization(purchase=unconfigured, method='unconfigured', amount=Decimal('10.00')).save()
+            call_command('capture_authorizations', str(unconfigured.pk), str(purchase.pk),
+                test_settings=True, verbosity=0)
+        finally:
+            set_bursar_setting('AUTHORIZENET_TEST', saved)
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.total_payments, Decimal('20.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+        self.assertEqual(Authorization.objects.filter(purchase=unconfigured, complete=False).count(), 1)
+
+ARB_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<%(kind)sResponse xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">
+<refId>%(ref)s</refId><messages><resultCode>%(result)s</resultCode><message><code>%(code)s</code><text>%(text)s</text></message></messages>
+<subscriptionId>%(subscription)s</subscriptionId></%(kind)sResponse>"""
+
+class TestRecurring(TestCase):
+    """Subscriptions are posted together, and created all or none."""
+    def setUp(self):
+        self.server = GatewayServer(reply=self.reply, delay=0.3)
+        self.gateway = processor.PaymentProcessor(settings={
+            'LOGIN' : 'test', 'TRANKEY' : 'secretkey', 'STORE_NAME' : 'test', 'EXTRA_LOGGING' : True})
+        self.decline = None
+
+    def tearDown(self):
+        self.server.stop()
+
+    def reply(self, path, body):
+        if 'ARBCancelSubscriptionRequest' in body:
+            return ARB_RESPONSE % {'kind' : 'ARBCancelSubscription', 'ref' : '', 'result' : 'Ok',
+                'code' : 'I00001', 'text' : 'Successful.', 'subscription' : ''}
+        ref = body.split('<refId>')[1].split('</refId>')[0]
+        if ref == self.decline:
+            return ARB_RESPONSE % {'kind' : 'ARBCreateSubscription', 'ref' : ref, 'result' : 'Error',
+                'code' : 'E00012', 'text' : 'Duplicate subscription.', 'subscription' : ''}
+        return ARB_RESPONSE % {'kind' : 'ARBCreateSubscription', 'ref' : ref, 'result' : 'Ok',
+            'code' : 'I00001', 'text' : 'Successful.', 'subscription' : 'sub' + ref}
+
+    def recurlist(self, purchase):
+        return [{'connection' : self.server.url + '/xml/v1/request.api',
+            'config' : {'merchantID' : 'test', 'transactionKey' : 'secretkey', 'shop_name' : 'test'},
+            'purchase' : purchase, 'subscription' : {'pk' : i}, 'product' : 'Plan %i' % i,
+            'charged_today' : Decimal('5.00')} for i in (1, 2, 3)]
+
+    def test_concurrent(self):
+        """Test that subscriptions are posted at once and recorded in order."""
+        purchase = make_test_purchase(sub_total=Decimal('15.00'))
+        started = time.time()
+        success, results = self.gateway.process_recurring_subscriptions(self.recurlist(purchase), purchase=purchase)
+        self.assert_(time.time() - started < 0.8)
+        self.assert_(success)
+        self.assertEqual([r.payment.transaction_id for r in results], ['sub1', 'sub2', 'sub3'])
+        self.assertEqual(purchase.total_payments, Decimal('15.00'))
+
+    def test_concurrent_async(self):
+        """Test that the async driver posts a Parallel's posts at once too."""
+        purchase = make_test_purchase(sub_total=Decimal('15.00'))
+        started = time.time()
+        pending = PendingResult(self.gateway, self.gateway.process_recurring_subscriptions_steps(
+            self.recurlist(purchase), purchase=purchase), WorkerPool(size=3))
+        success, results = pending.result(timeout=5)
+        self.assert_(time.time() - started < 0.8)
+        self.assertEqual([r.payment.transaction_id for r in results], ['sub1', 'sub2', 'sub3'])
+
+    def test_partial_failure(self):
+        """Test that a failed subscription cancels the others, recording nothing."""
+        self.decline = '2'
+        purchase = make_test_purchase(sub_total=Decimal('15.00'))
+        success, results = self.gateway.process_recurring_subscriptions(self.recurlist(purchase), purchase=purchase)
+        self.failIf(success)
+        self.assertEqual(results[0].message, 'Duplicate subscription.')
+        cancelled = [body.split('<subscriptionId>')[1].split('<')[0] for path, body in self.server.posts
+            if 'ARBCancelSubscriptionRequest' in body]
+        self.assertEqual(sorted(cancelled), ['sub1', 'sub3'])
+        self.assertEqual(purchase.total_payments, Decimal('0.00'))
+
+    def test_sequential(self):
+        """Test that without ARB_CONCURRENT the posts stop at the first failure."""
+        self.gateway.settings['ARB_CONCURRENT'] = False
+        self.server.delay = 0
+        self.decline = '2'
+        purchase = make_test_purchase(sub_total=Decimal('15.00'))
+        success, results = self.gateway.process_recurring_subscriptions(self.recurlist(purchase), purchase=purchase)
+        self.failIf(success)
+        self.assertEqual(len(self.server.posts), 3)
+        self.assert_('<subscriptionId>sub1</subscriptionId>' in self.server.posts[2][1])
+
+    def test_parse_and_redact(self):
+        values = processor.parse_arb_response(self.reply('/', '<refId>7</refId>'))
+        self.assertEqual(values, {'resultCode' : 'Ok', 'code' : 'I00001', 'text' : 'Successful.', 'subscriptionId' : 'sub7'})
+        redacted = processor.redact_arb('<transactionKey>secretkey</transactionKey><cardNumber>4111111111111111</cardNumber>')
+        self.assertEqual(redacted, '<transactionKey>REDACTED</transactionKey><cardNumber>REDACTED</cardNumber>')
+
+class TestAimResponse(TestCase):
+    def test_fields(self):
+        fields = ['1', '1', '1', 'This transaction has been approved.', 'QWE123', 'Y', '2149186848'] + [''] * 30 + \
+            ['HASH', 'M', '2'] + [''] * 10 + ['XXXX1111', 'Visa'] + [''] * 16 + ['gift wrap']
+        response = aim.AimResponse('|'.join(fields) + '\n')
+        self.assert_(response.approved)
+        self.assertEqual(response.transaction_id, '2149186848')
+        self.assertEqual(response['auth_code'], 'QWE123')
+        # only parsed as far as the last field read
+        self.assertEqual(len(response.fields), 7)
+        self.assertEqual(response.card_code, 'M')
+        self.assertEqual(response.cavv_code, '2')
+        self.assertEqual(response.account_number, 'XXXX1111')
+        self.assertEqual(response.card_type, 'Visa')
+        self.assertEqual(response.as_dict()['md5_hash'], 'HASH')
+        self.assertEqual(response.merchant_fields(), ['gift wrap'])
+
+    def test_encapsulated(self):
+        response = aim.AimResponse('"2","1","2","This transaction has been declined.","","N","0","A,B"\r\n',
+            delimiter=',', encapsulator='"')
+        self.failIf(response.approved)
+        self.assertEqual(response.reason_text, 'This transaction has been declined.')
+        self.assertEqual(response.auth_code, '')
+        self.assertEqual(response.transaction_id, '0')
+        self.assertEqual(response.invoice_number, 'A,B')
+        self.assertEqual(response.description, '')
+
+    def test_short(self):
+        response = aim.AimResponse('3|1|13|The merchant login ID or password is invalid or the account is inactive.')
+        self.assertEqual(response.response_code, aim.ERROR)
+        self.assertEqual(response.reason_code, '13')
+        self.assertEqual(response.transaction_id, '')
+        self.assertEqual(response.merchant_fields(), [])
+
+    def test_benchmark(self):
+        """Test the benchmark_responses command runs."""
+        call_command('benchmark_responses', number=2, verbosity=0)
+
+class TestRequestBuilder(TestCase):
+    def assertBuilds(self, name, data, golden=None):
+        name = 'bursar/gateway/authorizenet_gateway/' + name
+        request = get_builder(name).build(data)
+        self.assertEqual(request, loader.get_template(name).render(Context(data)))
+        if golden:
+            # the golden request was made on another day
+            self.assertEqual(START_DATE.sub('', request), START_DATE.sub('', read_golden(__file__, golden)))
+
+    def test_golden(self):
+        """Test that the ARB request builders match the templates and the golden requests."""
+        self.assertBuilds('arb_create_subscription.xml', SUBSCRIPTION_DATA, 'arb_create_subscription.xml')
+        self.assertBuilds('arb_cancel_subscription.xml', {'config' : SUBSCRIPTION_DATA['config'],
+            'subscription_id' : '1001'}, 'arb_cancel_subscription.xml')
+
+    def test_without_trial(self):
+        data = dict(SUBSCRIPTION_DATA)
+        data['subscription'] = {'pk' : 8, 'expire_length' : 30, 'expire_unit' : 'DAY', 'trial' : False}
+        del data['card']
+        self.assertBuilds('arb_create_subscription.xml', data)
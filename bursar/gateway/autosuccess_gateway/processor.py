@@ -26,7 +26,6 @@ class PaymentProcessor(BasePaymentProcessor):
 
         payment = self.record_payment(purchase=purchase, 
             amount=amount, 
-            transaction_id=self.key, 
             reason_code='0')
 
         return ProcessorResult(self.key, True, _('Success'), payment)
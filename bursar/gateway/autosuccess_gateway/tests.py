@@ -2,7 +2,7 @@
 """Bursar Autosucess Gateway Tests."""
 from bursar.gateway.autosuccess_gateway import processor
 from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
+from bursar.tests import make_test_purchase, run_within_budget
 from decimal import Decimal
 from django.conf import settings
 from django.contrib.sites.models import Site
@@ -11,6 +11,12 @@ from django.core.urlresolvers import reverse as url
 from django.test import TestCase
 from django.test.client import Client
 
+# the most SQL queries each operation may run
+QUERY_BUDGETS = {
+    'capture_payment' : 3,
+    'record_payment' : 3,
+}
+
 class TestGateway(TestCase):
     def setUp(self):
         self.client = Client()
@@ -29,3 +35,9 @@ class TestGateway(TestCase):
         self.assertEqual(payment.amount, Decimal('10.00'))
         self.assertEqual(purchase.total_payments, Decimal('10.00'))
         self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+
+    def test_query_budgets(self):
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_payment, purchase=purchase)
+        self.assert_(result.success)
+        self.assertEqual([child.operation for child in result.stats.children], ['record_payment'])
@@ -1,18 +1,49 @@
-from bursar import signals
-from bursar.errors import GatewayError
+from bursar import metrics, signals
+from bursar.bursar_settings import get_bursar_setting
+from bursar.errors import GatewayError, TransportError
+from bursar.gateway import resilience, stats
+from bursar.gateway.steps import Parallel, Steps, outcomes
+from bursar.gateway.transport import get_transport
+from bursar.gateway.workers import get_pool
 from bursar.models import Authorization, Payment, PaymentFailure, PaymentPending, Purchase
 from datetime import datetime
 from decimal import Decimal
 from django.utils.translation import ugettext_lazy as _
 import logging
 import os
+import sys
+import time
+import uuid
 
 log = logging.getLogger('bursar.gateway.base')
 
 NOTSET = object()
 
+def share_remaining(purchase, auths):
+    """The amount to capture from each of `auths`, in order, so that together they
+    take no more than is left to pay on `purchase`.
+
+    Captures which are all started before any is recorded can't rely on the
+    purchase's balances to stop them, so they are shared out here instead, the
+    way capturing them one at a time would.  Authorizations past the total get
+    a zero amount."""
+    left = purchase.total - purchase.total_payments
+    amounts = []
+    for auth in auths:
+        amount = max(min(auth.amount, left), Decimal('0.00'))
+        amounts.append(amount)
+        left -= amount
+    return amounts
+
 class BasePaymentProcessor(object):
 
+    # measures each public operation, see bursar.gateway.stats
+    __metaclass__ = stats.MeasuredOperations
+
+    # False for processors which keep the details of the current payment on
+    # themselves, so that bursar.gateway.registry builds one for each thread
+    thread_safe = True
+
     def __init__(self, key, settings):
         self.key = key
         self.settings = settings
@@ -56,19 +87,54 @@ class BasePaymentProcessor(object):
     def can_recur_bill(self):
         return False
 
-    def capture_authorized_payments(self, purchase=None):
+    def capture_authorized_payments(self, purchase=None, concurrent=False, max_workers=None):
         """Capture all outstanding payments for this processor.  This is usually called by a
-        listener which watches for a 'shipped' status change on the Order."""
+        listener which watches for a 'shipped' status change on the Order.
+
+        If `concurrent` is set, the captures are sent to the gateway together, on a pool
+        of `max_workers` threads or else the shared ASYNC_WORKERS pool.  They are still
+        recorded one at a time in this thread.  Results are in the order of the authorizations."""
         assert(purchase)
         results = []
         if self.can_authorize():
-            auths = purchase.authorizations.filter(method__exact=self.key, complete=False)
-            self.log_extra('Capturing %i %s authorizations for purchase on order #%s', auths.count(), self.key, purchase.orderno)
-            for auth in auths:
-                results.append(self.capture_authorized_payment(auth, purchase=purchase))
+            auths = list(purchase.authorizations.filter(method__exact=self.key, complete=False).order_by('id'))
+            self.log_extra('Capturing %i %s authorizations for purchase on order #%s', len(auths), self.key, purchase.orderno)
+            if concurrent and len(auths) > 1:
+                results = self._capture_concurrently(auths, purchase, max_workers)
+            else:
+                for auth in auths:
+                    results.append(self.capture_authorized_payment(auth, purchase=purchase))
 
         return results
 
+    def _capture_concurrently(self, auths, purchase, max_workers):
+        from bursar.gateway.asyncprocessor import AsyncPaymentProcessor
+        from bursar.gateway.workers import WorkerPool
+
+        pool = None
+        if max_workers:
+            pool = WorkerPool(size=max_workers, name='bursar-capture')
+        gateway = AsyncPaymentProcessor(self, pool=pool)
+        try:
+            pending = [gateway.capture_authorized_payment(auth, purchase=purchase, amount=amount)
+                for auth, amount in zip(auths, share_remaining(purchase, auths))]
+            # every capture the gateway made must be recorded, so collect them all before raising
+            results = []
+            error = None
+            for p in pending:
+                try:
+                    results.append(p.result())
+                except Exception:
+                    self.log.exception('Error capturing an authorization for %s', purchase)
+                    if error is None:
+                        error = sys.exc_info()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            return results
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
     def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
         """Capture a single payment, must be overridden to function"""
         self.log.warn('Module does not implement capture_payment: %s', self.key)
@@ -103,8 +169,8 @@ class BasePaymentProcessor(object):
     def process(self, purchase, testing=False):
         """This will process the payment."""
         if self.can_authorize() and not self.settings['CAPTURE']:
-            self.log_extra('Authorizing payment on order #%i', purchase.orderno)
-            return self.authorize_payment(testing=testing)
+            self.log_extra('Authorizing payment on order #%s', purchase.orderno)
+            return self.authorize_payment(purchase=purchase, testing=testing)
         else:
             self.log_extra('Capturing payment on order #%s', purchase.orderno)
             return self.capture_payment(purchase=purchase, testing=testing)
@@ -144,14 +210,22 @@ class BasePaymentProcessor(object):
 
         if authorization:
             payment = recorder.capture_authorized_payment(authorization, amount=amount)
-            authorization.complete=True
-            authorization.save()
-            
+            recorder.complete_authorization(authorization)
+
         else:
             payment = recorder.capture_payment(amount=amount)
 
         return payment
 
+    def record_release(self, authorization, purchase=None):
+        """
+        Mark an authorization as released, removing it from the authorized balance.
+        """
+        if not purchase:
+            purchase = authorization.purchase
+        recorder = PaymentRecorder(purchase, self.key)
+        recorder.complete_authorization(authorization)
+
     def release_authorized_payment(self, purchase=None, auth=None, testing=False):
         """Release a previously authorized payment."""
         self.log.warn('Module does not implement released_authorized_payment: %s', self.key)
@@ -169,6 +243,86 @@ class BasePaymentProcessor(object):
             if not val:
                 raise GatewayError('You must define a %s for the %s payment module.' % (arg, self.key))
 
+    def get_setting(self, name):
+        """Return a setting from this gateway's settings, or else the bursar settings."""
+        return self.settings.get(name, get_bursar_setting(name))
+
+    @property
+    def breaker(self):
+        """The circuit breaker watching this gateway."""
+        return resilience.get_breaker(self.key,
+            failure_threshold=self.get_setting('BREAKER_FAILURES'),
+            slow_call=self.get_setting('BREAKER_SLOW_CALL'),
+            reset_timeout=self.get_setting('BREAKER_RESET'))
+
+    def http_post(self, url, data, headers={}, idempotent=False, operation=None):
+        """Post to the gateway through its circuit breaker, retrying if the request is idempotent.
+
+        `operation` labels the post's metrics, by default the operation running in this thread.
+        Raises TransportError, or CircuitOpenError without trying if the gateway is down."""
+        if idempotent:
+            retries = self.get_setting('HTTP_RETRIES')
+        else:
+            retries = 0
+        if operation is None:
+            operation = stats.operation_name('post')
+        start = time.time()
+        try:
+            return resilience.call(self.breaker, lambda: self.transport.post(url, data, headers),
+                retries=retries, backoff=self.get_setting('HTTP_RETRY_BACKOFF'))
+        except TransportError:
+            metrics.increment('transport_errors', self.key, operation)
+            raise
+        finally:
+            elapsed = time.time() - start
+            stats.add_http(elapsed)
+            metrics.observe('round_trip', self.key, operation, elapsed)
+
+    def http_post_all(self, posts):
+        """Make several posts at once on the shared ASYNC_WORKERS pool.
+
+        Returns the Response to each post, or the TransportError it raised, in order."""
+        pool = get_pool('bursar-gateway', get_bursar_setting('ASYNC_WORKERS'))
+        operation = stats.operation_name('post')
+        start = time.time()
+        try:
+            return outcomes([pool.submit(self.http_post, post.url, post.data, post.headers,
+                idempotent=post.idempotent, operation=operation) for post in posts])
+        finally:
+            # the workers' own timings aren't counted, they run no operations
+            stats.add_http(time.time() - start, posts=len(posts))
+
+    def run_steps(self, coroutine):
+        """Run a steps generator (see bursar.gateway.steps) in this thread, returning its result."""
+        steps = Steps(coroutine)
+        start = time.time()
+        post = steps.advance()
+        if post is not None:
+            metrics.observe('build', self.key, stats.operation_name('steps'), time.time() - start)
+        while post is not None:
+            if isinstance(post, Parallel):
+                post = steps.advance(self.http_post_all(post.posts))
+                continue
+            try:
+                response = self.http_post(post.url, post.data, post.headers, idempotent=post.idempotent)
+            except TransportError:
+                post = steps.advance(error=sys.exc_info())
+            else:
+                post = steps.advance(response)
+        return steps.value
+
+    def is_available(self):
+        """False while the gateway's circuit breaker is open, so it can be hidden from customers."""
+        return self.breaker.available()
+
+    @property
+    def transport(self):
+        """The shared HTTP transport, with this gateway's timeouts and pool size."""
+        return get_transport(
+            maxsize=self.get_setting('HTTP_POOL_SIZE'),
+            connect_timeout=self.get_setting('HTTP_CONNECT_TIMEOUT'),
+            read_timeout=self.get_setting('HTTP_READ_TIMEOUT'))
+
 class HeadlessPaymentProcessor(BasePaymentProcessor):
     """A payment processor which doesn't actually do any processing directly.
 
@@ -233,7 +387,6 @@ class PaymentRecorder(object):
 
         self.payment = authorization.capture
         self.payment.success=True
-        self.payment.save()
         self.cleanup()
         return self.payment
 
@@ -266,18 +419,24 @@ class PaymentRecorder(object):
     def record_failure(self, amount=NOTSET, details="", authorization=None):
         log.info('Recording a payment failure: purchase #%s order #%s, code %s\nmessage=%s',
             self.purchase, self.purchase.orderno, self.reason_code, details)
+        start = time.time()
         self.amount = amount
 
         failure = PaymentFailure.objects.create(purchase=self.purchase,
             details=details,
-            transaction_id=self.transaction_id,
+            transaction_id=self.transaction_id or self.new_transaction_id(),
             amount = self.amount,
             method = self.key,
             reason_code = self.reason_code
         )
+        self.purchase.invalidate_processing_cache('failure_count')
+        operation = stats.operation_name('record_failure')
+        metrics.increment('declines', self.key, operation, reason_code=self.reason_code or 'unknown')
+        metrics.observe('record', self.key, operation, time.time() - start)
         return failure
 
     def cleanup(self):
+        start = time.time()
         if self.pending:
             pending = self.pending
             self.payment.capture = pending.capture
@@ -287,21 +446,43 @@ class PaymentRecorder(object):
 
             # delete any extra pending payments
             for p in self.purchase.paymentspending.all():
-                if p != pending and p.capture.transaction_id=='LINKED':
+                if p != pending and p.capture.transaction_id.startswith('LINKED'):
                     p.capture.delete()
                 p.delete()
+            self.purchase.invalidate_processing_cache('pending')
 
         self.payment.reason_code=self.reason_code
-        self.payment.transaction_id=self.transaction_id
+        self.payment.transaction_id=self.transaction_id or self.new_transaction_id()
         self.payment.amount=self.amount
 
         self.payment.time_stamp = datetime.now()
         self.payment.save()
 
+        if isinstance(self.payment, Authorization):
+            if not self.payment.complete:
+                self.purchase.adjust_balances(authorized=self.payment.amount)
+        elif self.payment.success:
+            self.purchase.adjust_balances(paid=self.payment.amount)
+
         purchase = self.payment.purchase
 
         signals.payment_complete.send(sender='bursar', purchase=self.purchase, payment=self.payment)
         log.debug('cleanup details: %s', self.payment)
+        metrics.observe('record', self.key, stats.operation_name('record_payment'), time.time() - start)
+
+    def new_transaction_id(self):
+        """A unique transaction id, for a payment the gateway gave none."""
+        # 96 random bits, short enough for the 45 characters of Payment.transaction_id
+        return "%s-%s" % (self.key.upper(), uuid.uuid4().hex[:24])
+
+    def complete_authorization(self, authorization):
+        """Mark an authorization complete, after it has been captured or released."""
+        if not authorization.complete:
+            start = time.time()
+            authorization.complete = True
+            authorization.save()
+            self.purchase.adjust_balances(authorized=-authorization.amount)
+            metrics.observe('record', self.key, stats.operation_name('record_release'), time.time() - start)
 
     def create_pending(self, amount=NOTSET):
         """Create a placeholder payment entry for the purchase.
@@ -317,13 +498,14 @@ class PaymentRecorder(object):
             log.debug("Deleting %i expired pending payment entries for order #%s", ct, self.purchase.orderno)
 
             for pending in pendings.all():
-                if pending.capture.transaction_id=='LINKED':
+                if pending.capture.transaction_id.startswith('LINKED'):
                     pending.capture.delete()
                 pending.delete()
 
         log.debug("Creating pending %s payment of %s for %s", self.key, amount, self.purchase)
 
         self.pending = PaymentPending.objects.create(purchase=self.purchase, amount=amount, method=self.key)
+        self.purchase.invalidate_processing_cache('pending')
         return self.pending
 
     def set_amount_from_pending(self):
@@ -341,18 +523,23 @@ class PaymentRecorder(object):
 class ProcessorResult(object):
     """The result from a processor.process call"""
 
-    def __init__(self, processor, success, message, payment=None):
+    def __init__(self, processor, success, message, payment=None, response=None):
         """Initialize with:
 
         processor - the key of the processor setting the result
         success - boolean
         message - a lazy string label, such as _('OK)
         payment - an Payment or Authorization
+        response - the gateway's parsed response, for processors which keep it
+
+        The operation returning it sets `stats`, see bursar.gateway.stats.
         """
         self.success = success
         self.processor = processor
         self.message = message
         self.payment = payment
+        self.response = response
+        self.stats = None
 
     def __unicode__(self):
         if self.success:
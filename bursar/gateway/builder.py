@@ -0,0 +1,231 @@
+"""
+Gateway request payloads built from precompiled fragments, instead of by
+rendering a Django template for every transaction.
+
+A RequestBuilder reads a gateway's request template once and compiles it
+into its static text and the fields between them.  Building a request
+joins the static text with the field values, escaped just as autoescaping
+does, so the output is the same as rendering the template::
+
+    request = get_builder('bursar/gateway/cybersource_gateway/request.xml').build({
+        'config' : self.configuration,
+        ...
+    })
+
+The templates stay the single source of the request formats.  Only the
+template syntax they need is understood: variables without filters,
+`{% if var %}` and `{% if not var %}`, `{% ifequal var "literal" %}` and
+`{% ifnotequal %}`, each with an optional `{% else %}`, `{% now "format" %}`
+and comments.  Anything else raises TemplateSyntaxError when the builder is
+compiled.
+"""
+from datetime import datetime
+from django.conf import settings
+from django.template import Lexer, TemplateSyntaxError, Variable, VariableDoesNotExist, \
+    TOKEN_BLOCK, TOKEN_COMMENT, TOKEN_TEXT, TOKEN_VAR
+from django.template.loader import find_template_source
+from django.utils.dateformat import DateFormat
+from django.utils.encoding import force_unicode
+from django.utils.safestring import SafeData
+import re
+import threading
+
+ESCAPED = re.compile(u'[&<>"\']')
+
+class Field(object):
+    """A variable, looked up like a template variable and escaped."""
+
+    def __init__(self, path):
+        if '|' in path:
+            raise TemplateSyntaxError('Request builders do not support filters: %s' % path)
+        self.path = path
+        bits = path.split('.', 1)
+        self.name = bits[0]
+        # resolve the rest through Variable, for the same attribute, key and method lookups
+        self.rest = None
+        self.keys = ()
+        if len(bits) > 1:
+            self.rest = Variable('value.' + bits[1])
+            self.keys = tuple(bits[1].split('.'))
+
+    def resolve(self, data):
+        """The value, raising VariableDoesNotExist if it's missing."""
+        try:
+            value = data[self.name]
+        except KeyError:
+            raise VariableDoesNotExist('Failed lookup for key [%s] in %r', (self.name, data))
+        if self.rest is None:
+            return value
+        # a dictionary key is what Variable would look up first, so plain dictionaries can be walked directly
+        current = value
+        for key in self.keys:
+            if type(current) is not dict or key not in current:
+                return self.rest.resolve({'value' : value})
+            current = current[key]
+        return current
+
+    def value(self, data):
+        """The value, or None if it's missing."""
+        try:
+            return self.resolve(data)
+        except VariableDoesNotExist:
+            return None
+
+    def render(self, data, parts):
+        try:
+            value = self.resolve(data)
+        except VariableDoesNotExist:
+            value = settings.TEMPLATE_STRING_IF_INVALID
+            if '%s' in value:
+                value = value % self.path
+        parts.append(escape(value))
+
+class Literal(object):
+    def __init__(self, value):
+        self.literal = value
+
+    def value(self, data):
+        return self.literal
+
+class Condition(object):
+    """{% if %} and {% ifequal %}, with the fragments for each outcome."""
+
+    def __init__(self, test, true, false):
+        self.test = test
+        self.true = true
+        self.false = false
+
+    def render(self, data, parts):
+        if self.test(data):
+            fragments = self.true
+        else:
+            fragments = self.false
+        _render(fragments, data, parts)
+
+class Now(object):
+    def __init__(self, format_string):
+        self.format_string = format_string
+
+    def render(self, data, parts):
+        parts.append(DateFormat(datetime.now()).format(self.format_string))
+
+class RequestBuilder(object):
+    """A request template, compiled into static text and fields."""
+
+    def __init__(self, source, name='<string>'):
+        self.name = name
+        tokens = Lexer(source, name).tokenize()
+        tokens.reverse()
+        self.fragments, end = self._compile(tokens, ())
+        if end is not None:
+            raise TemplateSyntaxError('Unexpected {%% %s %%} in %s' % (end, name))
+
+    def __repr__(self):
+        return '<RequestBuilder %s>' % self.name
+
+    def build(self, data):
+        """Build the request from `data`, a dictionary like a template's context."""
+        parts = []
+        _render(self.fragments, data, parts)
+        return u''.join(parts)
+
+    def _compile(self, tokens, ends):
+        """Compile tokens up to one of the block tags in `ends`, returning
+        the fragments and the tag that ended them."""
+        fragments = []
+        while tokens:
+            token = tokens.pop()
+            if token.token_type == TOKEN_TEXT:
+                _add_text(fragments, token.contents)
+            elif token.token_type == TOKEN_VAR:
+                operand = _operand(token.contents)
+                if isinstance(operand, Literal):
+                    _add_text(fragments, escape(operand.literal))
+                else:
+                    fragments.append(operand)
+            elif token.token_type == TOKEN_BLOCK:
+                bits = token.split_contents()
+                if bits[0] in ends:
+                    return fragments, bits[0]
+                fragments.append(self._compile_tag(bits, tokens))
+            elif token.token_type != TOKEN_COMMENT:
+                raise TemplateSyntaxError('Unknown token in %s' % self.name)
+        if ends:
+            raise TemplateSyntaxError('Missing {%% %s %%} in %s' % (ends[-1], self.name))
+        return fragments, None
+
+    def _compile_tag(self, bits, tokens):
+        tag = bits[0]
+        if tag == 'now' and len(bits) == 2:
+            return Now(bits[1][1:-1])
+
+        if tag == 'if' and len(bits) == 2:
+            field = Field(bits[1])
+            test = lambda data: bool(field.value(data))
+        elif tag == 'if' and len(bits) == 3 and bits[1] == 'not':
+            field = Field(bits[2])
+            test = lambda data: not field.value(data)
+        elif tag in ('ifequal', 'ifnotequal') and len(bits) == 3:
+            first, second = _operand(bits[1]), _operand(bits[2])
+            if tag == 'ifequal':
+                test = lambda data: first.value(data) == second.value(data)
+            else:
+                test = lambda data: first.value(data) != second.value(data)
+        else:
+            raise TemplateSyntaxError('Request builders do not support {%% %s %%} in %s' % (' '.join(bits), self.name))
+
+        end = 'end' + tag
+        true, found = self._compile(tokens, ('else', end))
+        false = []
+        if found == 'else':
+            false, found = self._compile(tokens, (end,))
+        return Condition(test, true, false)
+
+def _add_text(fragments, text):
+    # neighbouring text is joined, so each stretch of static text is one fragment
+    if fragments and isinstance(fragments[-1], unicode):
+        fragments[-1] += text
+    else:
+        fragments.append(force_unicode(text))
+
+def escape(value):
+    """Escape a value as autoescaping does, without copying the many values
+    which have nothing to escape."""
+    if isinstance(value, SafeData):
+        return value
+    value = force_unicode(value)
+    if ESCAPED.search(value) is None:
+        return value
+    return value.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;') \
+        .replace(u'"', u'&quot;').replace(u"'", u'&#39;')
+
+def _operand(bit):
+    variable = Variable(bit)
+    if variable.lookups is None:
+        return Literal(variable.literal)
+    return Field(bit)
+
+def _render(fragments, data, parts):
+    for fragment in fragments:
+        if isinstance(fragment, unicode):
+            parts.append(fragment)
+        else:
+            fragment.render(data, parts)
+
+_builders = {}
+_builders_lock = threading.Lock()
+
+def get_builder(template_name):
+    """Return the builder for a template, compiling it the first time."""
+    builder = _builders.get(template_name, None)
+    if builder is None:
+        _builders_lock.acquire()
+        try:
+            builder = _builders.get(template_name, None)
+            if builder is None:
+                source, origin = find_template_source(template_name)
+                builder = RequestBuilder(source, template_name)
+                _builders[template_name] = builder
+        finally:
+            _builders_lock.release()
+    return builder
@@ -0,0 +1,210 @@
+"""
+Capturing the open authorizations of many purchases at once, such as
+everything shipped in the last hour::
+
+    report = capture_purchases(shipped, {'authorizenet' : authorizenet, 'cybersource' : cybersource})
+    print report
+
+`purchases` is a queryset or any iterable of purchases or their ids, and
+the processors are keyed by payment method.  Open authorizations are loaded
+a batch of purchases at a time and grouped by method.  Each gateway's
+captures are posted on its own WorkerPool, `workers` at a time and no more
+than `rate` a second, so a slow gateway doesn't hold up the others.
+
+Every capture goes through the processor's own capture_authorized_payment,
+run by AsyncPaymentProcessor, so the database work all stays in the calling
+thread.  Each capture is recorded in its own transaction, so a database
+error loses no more than the record of the one capture it hit, and can't
+leave money already taken by the gateway looking uncaptured.  Authorizations
+whose method has no processor are skipped and left open.
+
+The captures are all started before any is recorded, so what is left to pay
+on each purchase is shared out across its authorizations in order first, as
+capturing them one at a time would.  An authorization with nothing left to
+take is released instead of captured.
+
+Settings, in BURSAR_SETTINGS, overridable in each gateway's settings:
+
+    BULK_CAPTURE_WORKERS: captures posted at once to each gateway, default 4
+    BULK_CAPTURE_RATE: most captures a second sent to each gateway, 0 for no limit
+    BULK_CAPTURE_BATCH: purchases loaded together, default 100
+"""
+from bursar.bursar_settings import get_bursar_setting
+from bursar.gateway.asyncprocessor import AsyncPaymentProcessor
+from bursar.gateway.base import share_remaining
+from bursar.gateway.workers import RateLimiter, WorkerPool
+from bursar.models import Authorization, Purchase
+from decimal import Decimal
+from django.db import transaction
+from django.db.models.query import QuerySet
+import logging
+import time
+
+log = logging.getLogger('bursar.gateway.bulk')
+
+CAPTURED = 'captured'
+DECLINED = 'declined'
+ERROR = 'error'
+RELEASED = 'released'
+SKIPPED = 'skipped'
+
+class CaptureReport(object):
+    """Counts and amounts of the captures made by capture_purchases, per payment method."""
+
+    def __init__(self):
+        self.methods = {}
+        self.failures = []
+        self.started = time.time()
+        self.elapsed = 0
+
+    def __str__(self):
+        return '\n'.join(self.summary())
+
+    def add(self, method, outcome, amount=Decimal('0.00'), authorization=None, message=''):
+        totals = self.methods.get(method, None)
+        if totals is None:
+            totals = {CAPTURED : 0, DECLINED : 0, ERROR : 0, RELEASED : 0, SKIPPED : 0, 'amount' : Decimal('0.00')}
+            self.methods[method] = totals
+        totals[outcome] += 1
+        if outcome == CAPTURED:
+            totals['amount'] += amount
+        elif outcome not in (RELEASED, SKIPPED):
+            self.failures.append((authorization, outcome, message))
+
+    def count(self, outcome):
+        return sum([totals[outcome] for totals in self.methods.values()])
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+    def summary(self):
+        """The report as lines of text, a line per payment method and then the totals."""
+        lines = []
+        for method in sorted(self.methods.keys()):
+            totals = self.methods[method]
+            lines.append('%s: %i captured (%s), %i released, %i declined, %i errors, %i skipped' % (method,
+                totals[CAPTURED], totals['amount'], totals[RELEASED], totals[DECLINED], totals[ERROR],
+                totals[SKIPPED]))
+        lines.append('Total: %i captured, %i released, %i declined, %i errors, %i skipped in %.1f seconds' % (
+            self.count(CAPTURED), self.count(RELEASED), self.count(DECLINED), self.count(ERROR),
+            self.count(SKIPPED), self.elapsed))
+        return lines
+
+def capture_purchases(purchases, processors, workers=None, rate=None, batch_size=None, testing=False):
+    """Capture the open authorizations of `purchases`, returning a CaptureReport.
+
+    `workers` and `rate` apply to each gateway, and default to that gateway's
+    BULK_CAPTURE_WORKERS and BULK_CAPTURE_RATE settings."""
+    if batch_size is None:
+        batch_size = get_bursar_setting('BULK_CAPTURE_BATCH')
+    report = CaptureReport()
+    pools = {}
+    try:
+        for purchase_ids in _batches(purchases, batch_size):
+            auths = list(Authorization.objects.filter(purchase__in=purchase_ids, complete=False).order_by('id'))
+            if auths:
+                _capture_batch(auths, processors, pools, report, workers, rate, testing)
+    finally:
+        for pool in pools.values():
+            pool.shutdown()
+    report.finish()
+    log.info('Bulk capture finished. %s', ' '.join(report.summary()))
+    return report
+
+def _batches(purchases, batch_size):
+    """Lists of up to `batch_size` purchase ids."""
+    if isinstance(purchases, QuerySet):
+        purchases = purchases.values_list('pk', flat=True).iterator()
+    batch = []
+    for purchase in purchases:
+        batch.append(getattr(purchase, 'pk', purchase))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _get_pool(pools, processor, workers, rate):
+    pool = pools.get(processor.key, None)
+    if pool is None:
+        if workers is None:
+            workers = processor.get_setting('BULK_CAPTURE_WORKERS')
+        if rate is None:
+            rate = processor.get_setting('BULK_CAPTURE_RATE')
+        limiter = None
+        if rate:
+            limiter = RateLimiter(rate)
+        pool = WorkerPool(size=workers, name='bursar-capture-%s' % processor.key, limiter=limiter)
+        pools[processor.key] = pool
+    return pool
+
+def _capture_batch(auths, processors, pools, report, workers, rate, testing):
+    gateways = {}
+    for method in sorted(set([auth.method for auth in auths])):
+        processor = processors.get(method, None)
+        if processor is None or not processor.can_authorize():
+            log.debug('No processor to capture %s authorizations', method)
+            continue
+        gateways[method] = AsyncPaymentProcessor(processor, pool=_get_pool(pools, processor, workers, rate))
+
+    # a purchase's authorizations, in order, with one instance per purchase so
+    # its running balances stay right across them
+    groups = {}
+    purchases = {}
+    for auth in auths:
+        if auth.method not in gateways:
+            report.add(auth.method, SKIPPED, authorization=auth)
+            continue
+        purchase = purchases.get(auth.purchase_id, None)
+        if purchase is None:
+            purchase = Purchase.objects.for_processing(auth.purchase_id)
+            purchases[auth.purchase_id] = purchase
+        auth.purchase = purchase
+        groups.setdefault(auth.purchase_id, []).append(auth)
+
+    pending = []
+    for purchase_id in sorted(groups.keys()):
+        purchase = purchases[purchase_id]
+        purchase_auths = groups[purchase_id]
+        for auth, amount in zip(purchase_auths, share_remaining(purchase, purchase_auths)):
+            gateway = gateways[auth.method]
+            try:
+                if amount > Decimal('0.00'):
+                    started = _start_capture(gateway, auth, purchase, amount, testing)
+                else:
+                    # nothing left for this one to take, so let the customer's funds go
+                    started = _start_release(gateway, auth, purchase, testing)
+                pending.append((auth, amount, started))
+            except Exception, e:
+                log.exception('Error starting the capture of authorization #%i', auth.id)
+                report.add(auth.method, ERROR, authorization=auth, message=unicode(e))
+
+    for auth, amount, result in pending:
+        try:
+            result = _finish_capture(result)
+        except Exception, e:
+            log.exception('Error capturing authorization #%i', auth.id)
+            report.add(auth.method, ERROR, authorization=auth, message=unicode(e))
+        else:
+            if not result.success:
+                report.add(auth.method, DECLINED, authorization=auth, message=unicode(result.message))
+            elif amount > Decimal('0.00'):
+                if result.payment is not None:
+                    amount = result.payment.amount
+                report.add(auth.method, CAPTURED, amount=amount, authorization=auth)
+            else:
+                report.add(auth.method, RELEASED, authorization=auth)
+
+def _start_capture(gateway, auth, purchase, amount, testing):
+    return gateway.capture_authorized_payment(auth, testing=testing, purchase=purchase, amount=amount)
+
+def _start_release(gateway, auth, purchase, testing):
+    return gateway.release_authorized_payment(purchase=purchase, auth=auth, testing=testing)
+
+def _finish_capture(pending):
+    return pending.result()
+
+# each capture is recorded on its own, never rolled back with another the gateway has made
+_start_capture = transaction.commit_on_success(_start_capture)
+_start_release = transaction.commit_on_success(_start_release)
+_finish_capture = transaction.commit_on_success(_finish_capture)
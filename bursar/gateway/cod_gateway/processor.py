@@ -27,8 +27,7 @@ class PaymentProcessor(BasePaymentProcessor):
         if amount == NOTSET:
             amount = purchase.total
 
-        payment = self.record_payment(amount=amount, 
-            transaction_id=self.key, reason_code='0', purchase=purchase)
+        payment = self.record_payment(amount=amount, reason_code='0', purchase=purchase)
 
         return ProcessorResult(self.key, True, _('Success'), payment)
 
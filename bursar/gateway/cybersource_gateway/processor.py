@@ -1,14 +1,17 @@
+from __future__ import with_statement
+from bursar.errors import TransportError
 from bursar.gateway.base import BasePaymentProcessor, ProcessorResult, NOTSET
+from bursar.gateway.builder import get_builder
+from bursar.gateway.steps import Post, Return
 from bursar.numbers import trunc_decimal
 from decimal import Decimal
-from django.template import Context, loader
 from django.utils.translation import ugettext_lazy as _
+from xml.etree import cElementTree
+import re
+import StringIO
 
-import urllib2
-try:
-    from xml.etree.ElementTree import fromstring
-except ImportError:
-    from elementtree.ElementTree import fromstring
+REQUEST_HEADERS = {'Content-type' : 'text/xml; charset=utf-8', 'SOAPAction' : 'runTransaction'}
+REQUEST_REDACT = re.compile(r'<((?:ns1:|wsse:)(?:accountNumber|cvNumber|Password))([^>]*)>[^<]*</\1>')
 
 # Response codes available at:
 # http://apps.cybersource.com/library/documentation/sbc/api_guide/SB_API.pdf
@@ -55,6 +58,7 @@ class PaymentProcessor(BasePaymentProcessor):
     You must have an account with Cybersource in order to use this module
     
     """
+
     def __init__(self, settings={}):
         
         working_settings = {
@@ -83,6 +87,9 @@ class PaymentProcessor(BasePaymentProcessor):
             #Your Cybersource transaction key - REQUIRED
             'TRANKEY': "",
 
+            #If False, process() only authorizes, the payment is captured later
+            'CAPTURE': True,
+
             'EXTRA_LOGGING': False
         }
         
@@ -105,7 +112,10 @@ class PaymentProcessor(BasePaymentProcessor):
         }
 
     def prepare_content(self, purchase, amount):
-        self.bill_to = {
+        """The billing address, card and totals of an authorization, for build_request.
+        Nothing is kept on the processor, which is shared, so the card is dropped
+        once the request is built."""
+        bill_to = {
             'firstName' : purchase.first_name,
             'lastName' : purchase.last_name,
             'street1': purchase.full_bill_street,
@@ -116,80 +126,238 @@ class PaymentProcessor(BasePaymentProcessor):
             'email' : purchase.email,
             'phoneNumber' : purchase.phone,
             }
-        exp = purchase.credit_card.expirationDate.split('/')
-        self.card = {
-            'accountNumber' : purchase.credit_card.decryptedCC,
+        card = purchase.credit_card
+        exp = card.expirationDate.split('/')
+        card = {
+            'accountNumber' : card.decryptedCC,
             'expirationMonth' : exp[0],
             'expirationYear' : exp[1],
-            'cvNumber' : purchase.credit_card.ccv
+            'cvNumber' : card.ccv
             }
+        content = self.prepare_totals(amount)
+        content.update(billTo=bill_to, card=card)
+        return content
+
+    def prepare_totals(self, amount):
+        """The totals of a request which names an earlier authorization, for build_request."""
         currency = self.settings['CURRENCY_CODE']
         currency = currency.replace("_", "")
-        self.purchase_totals = {
-            'currency' : currency,
-            'grandTotalAmount' : trunc_decimal(amount, 2),
+        return {
+            'purchaseTotals' : {
+                'currency' : currency,
+                'grandTotalAmount' : trunc_decimal(amount, 2),
+            },
         }
 
+    def authorize_payment(self, purchase=None, amount=NOTSET, testing=False):
+        """Authorize a single payment."""
+        return self.run_steps(self.authorize_payment_steps(purchase=purchase, amount=amount, testing=testing))
+
+    def authorize_payment_steps(self, purchase=None, amount=NOTSET, testing=False):
+        """Steps for authorize_payment, see bursar.gateway.steps."""
+        assert(purchase)
+        if purchase.remaining == Decimal('0.00'):
+            self.log_extra('%s is paid in full, no authorization attempted.', purchase)
+            raise Return(ProcessorResult(self.key, True, _("No charge needed, paid in full.")))
+
+        if amount == NOTSET:
+            amount = purchase.remaining
+        self.log_extra('Authorizing payment of %s for %s', amount, purchase)
+
+        with purchase.processing():
+            request = self.build_request(purchase, self.prepare_content(purchase, amount), authorize=True)
+        results = yield self.send_request_steps(request, purchase, amount, testing=testing, authorize=True)
+        raise Return(results)
+
+    def can_authorize(self):
+        return True
+
+    def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        """Capture a payment authorized by authorize_payment."""
+        return self.run_steps(self.capture_authorized_payment_steps(authorization, testing=testing,
+            purchase=purchase, amount=amount))
+
+    def capture_authorized_payment_steps(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        """Steps for capture_authorized_payment, see bursar.gateway.steps."""
+        assert(purchase)
+        if purchase.authorized_remaining == Decimal('0.00'):
+            self.log_extra('No remaining authorizations on %s', purchase)
+            raise Return(ProcessorResult(self.key, True, _("Already complete")))
+
+        if amount == NOTSET or amount > authorization.remaining:
+            amount = authorization.remaining
+        self.log_extra('Capturing Authorization #%i of %s', authorization.id, amount)
+
+        request = self.build_request(purchase, self.prepare_totals(amount), capture=True,
+            authRequestID=authorization.transaction_id)
+        results = yield self.send_request_steps(request, purchase, amount, testing=testing,
+            authorization=authorization)
+        raise Return(results)
+
     def capture_payment(self, testing=False, purchase=None, amount=NOTSET):
         """
         Creates and sends XML representation of transaction to Cybersource
         """
+        return self.run_steps(self.capture_payment_steps(testing=testing, purchase=purchase, amount=amount))
+
+    def capture_payment_steps(self, testing=False, purchase=None, amount=NOTSET):
+        """Steps for capture_payment, see bursar.gateway.steps."""
+        assert(purchase)
         if purchase.remaining == Decimal('0.00'):
             self.log_extra('%s is paid in full, no capture attempted.', purchase)
             self.record_payment(purchase=purchase)
-            return ProcessorResult(self.key, True, _("No charge needed, paid in full."))
+            raise Return(ProcessorResult(self.key, True, _("No charge needed, paid in full.")))
 
         self.log_extra('Capturing payment for %s', purchase)
 
         if amount==NOTSET:
             amount = purchase.remaining
 
-        self.prepare_content(purchase, amount)
-        
+        with purchase.processing():
+            # authorized and captured in the one request
+            request = self.build_request(purchase, self.prepare_content(purchase, amount),
+                authorize=True, capture=True)
+        results = yield self.send_request_steps(request, purchase, amount, testing=testing)
+        raise Return(results)
+
+    def release_authorized_payment(self, purchase=None, auth=None, testing=False):
+        """Release a previously authorized payment."""
+        return self.run_steps(self.release_authorized_payment_steps(purchase=purchase, auth=auth, testing=testing))
+
+    def release_authorized_payment_steps(self, purchase=None, auth=None, testing=False):
+        """Steps for release_authorized_payment, see bursar.gateway.steps."""
+        assert(purchase)
+        self.log_extra('Releasing Authorization #%i for %s', auth.id, purchase)
+        request = self.build_request(purchase, self.prepare_totals(auth.amount), reverse=True,
+            authRequestID=auth.transaction_id)
+        # a reversal can safely be retried
+        results = yield self.send_request_steps(request, purchase, auth.amount, testing=testing,
+            authorization=auth, release=True, idempotent=True)
+        raise Return(results)
+
+    def build_request(self, purchase, content, authorize=False, capture=False, reverse=False, authRequestID=None):
+        """The SOAP request running the given services, with the `content` from
+        prepare_content or prepare_totals.  The billing address and card are only
+        sent with an authorization, follow-up requests name the authorization's
+        requestID instead."""
         invoice = "%s" % purchase.id
-        failct = purchase.paymentfailures.count()
+        failct = purchase.failure_count
         if failct > 0:
             invoice = "%s_%i" % (invoice, failct)
-        
-        # XML format is very simple, using ElementTree for generation would be overkill
-        t = loader.get_template('bursar/gateway/cybersource_gateway/request.xml')
-        c = Context({
+
+        data = {
             'config' : self.configuration,
             'merchantReferenceCode' : invoice,
-            'billTo' : self.bill_to,
-            'purchaseTotals' : self.purchase_totals,
-            'card' : self.card,
-        })
-        request = t.render(c)
-        self.log_extra("Cybersource request: %s", request)
-        conn = urllib2.Request(url=self.connection, data=request)
+            'purchaseTotals' : content['purchaseTotals'],
+            'authorize' : authorize,
+            'capture' : capture,
+            'reverse' : reverse,
+            'authRequestID' : authRequestID,
+        }
+        if authorize:
+            data['billTo'] = content['billTo']
+            data['card'] = content['card']
+        return get_builder('bursar/gateway/cybersource_gateway/request.xml').build(data)
+
+    def send_request(self, request, purchase, amount, testing=False, authorize=False, authorization=None,
+        release=False, idempotent=False):
+        """Post a request built by build_request and record the outcome.
+
+        Params:
+        - testing: if true, then don't record the outcome
+        - authorize: if true, record an authorization rather than a payment
+        - authorization: the authorization being captured or released
+        - release: if true, the authorization is released rather than captured
+
+        Returns:
+        - ProcessorResult, with the parsed reply as its response
+        """
+        return self.run_steps(self.send_request_steps(request, purchase, amount, testing=testing,
+            authorize=authorize, authorization=authorization, release=release, idempotent=idempotent))
+
+    def send_request_steps(self, request, purchase, amount, testing=False, authorize=False, authorization=None,
+        release=False, idempotent=False):
+        """Steps for send_request, see bursar.gateway.steps."""
+        if self.settings['EXTRA_LOGGING']:
+            self.log_extra("Cybersource request: %s", redact_request(request))
         try:
-            f = urllib2.urlopen(conn)
-        except urllib2.HTTPError, e:
+            response = yield Post(self.connection, request.encode('utf-8'), headers=REQUEST_HEADERS,
+                idempotent=idempotent)
+        except TransportError, e:
+            if e.status is None:
+                self.log.error("error opening %s\n%s", self.connection, e)
+                raise Return(ProcessorResult(self.key, False, _('Could not talk to Cybersource gateway')))
             # we probably didn't authenticate properly
             # make sure the 'v' in your account number is lowercase
-            return ProcessorResult(self.key, False, 'Problem parsing results')
+            if e.response is not None:
+                self.log.error("Cybersource fault: %s", parse_reply(e.response.body).get('faultstring'))
+            raise Return(ProcessorResult(self.key, False, 'Problem parsing results'))
 
-        f = urllib2.urlopen(conn)
-        all_results = f.read()
-        self.log_extra("Cybersource response: %s", all_results)
-        tree = fromstring(all_results)
-        parsed_results = tree.getiterator('{urn:schemas-cybersource-com:transaction-data-1.26}reasonCode')
-        try:
-            reason_code = parsed_results[0].text
-        except KeyError:
-            return ProcessorResult(self.key, False, 'Problem parsing results')
+        self.log_extra("Cybersource response: %s", response.body)
+        reply = parse_reply(response.body)
+        reason_code = reply.get('reasonCode', None)
+        if reason_code is None:
+            raise Return(ProcessorResult(self.key, False, 'Problem parsing results', response=reply))
 
         response_text = CYBERSOURCE_RESPONSES.get(reason_code, 'Unknown Failure')
+        transaction_id = reply.get('requestID', '')
+        success = reason_code == '100'
 
-        if reason_code == '100':
-            self.log_extra('%s successfully charged', purchase)
-            payment = self.record_payment(purchase=purchase, amount=amount, 
-                transaction_id="", reason_code=reason_code)
-            return ProcessorResult(self.key, True, response_text, payment=payment)
+        payment = None
+        if testing:
+            pass
+        elif not success:
+            payment = self.record_failure(purchase=purchase, amount=amount,
+                transaction_id=transaction_id, reason_code=reason_code,
+                details=response_text, authorization=authorization)
+        elif release:
+            self.log_extra('%s released', authorization)
+            self.record_release(authorization, purchase=purchase)
+        elif authorize:
+            self.log_extra('%s successfully authorized', purchase)
+            payment = self.record_authorization(purchase=purchase, amount=amount,
+                transaction_id=transaction_id, reason_code=reason_code)
         else:
-            payment = self.record_failure(purchase=purchase, amount=amount, 
-                transaction_id="", reason_code=reason_code, 
-                details=response_text)
-            
-            return ProcessorResult(self.key, False, response_text)
+            self.log_extra('%s successfully charged', purchase)
+            payment = self.record_payment(purchase=purchase, amount=amount,
+                transaction_id=transaction_id, reason_code=reason_code, authorization=authorization)
+
+        if success:
+            raise Return(ProcessorResult(self.key, True, response_text, payment=payment, response=reply))
+        raise Return(ProcessorResult(self.key, False, response_text, response=reply))
+
+def parse_reply(body):
+    """The reply's fields, as a dictionary.
+
+    The top level fields of the replyMessage are keyed by name, such as
+    `reasonCode` and `requestID`, and those of a service's reply by the reply
+    and the name, such as `ccAuthReply.authorizationCode`.  A SOAP fault's
+    `faultcode` and `faultstring` are kept too.  The reply is read as it is
+    parsed, and parsing stops at the end of the replyMessage."""
+    values = {}
+    path = []
+    try:
+        for event, element in cElementTree.iterparse(StringIO.StringIO(body), events=('start', 'end')):
+            tag = element.tag
+            if tag[0] == '{':
+                tag = tag[tag.index('}') + 1:]
+            if event == 'start':
+                path.append(tag)
+                continue
+            path.pop()
+            if tag == 'replyMessage':
+                break
+            if tag in ('faultcode', 'faultstring'):
+                values[tag] = element.text
+            elif 'replyMessage' in path and len(element) == 0:
+                # the path within the replyMessage, without the replyMessage itself
+                inner = path[path.index('replyMessage') + 1:]
+                values['.'.join(inner + [tag])] = element.text or ''
+    except SyntaxError:
+        # cElementTree's ParseError is a SyntaxError
+        pass
+    return values
+
+def redact_request(request):
+    """The request, without the card number, card code or password, for logging."""
+    return REQUEST_REDACT.sub(r'<\1\2>REDACTED</\1>', request)
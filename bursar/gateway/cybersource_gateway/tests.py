@@ -1,23 +1,71 @@
 # -*- coding: UTF-8 -*-
 """Bursar Authorizenet Gateway Tests."""
+from __future__ import with_statement
 from bursar.gateway.cybersource_gateway import processor
 from bursar.errors import GatewayError
-from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
+from bursar.models import Authorization, Payment, Purchase
+from bursar.gateway.builder import get_builder
+from bursar.gateway.simulator.server import SimulatorServer
+from bursar.tests import make_test_purchase, GatewayServer, QueryCounter, read_golden, run_within_budget
 from bursar.bursar_settings import get_bursar_setting
 from decimal import Decimal
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core import urlresolvers
 from django.core.urlresolvers import reverse as url
+from django.template import Context, loader
 from django.test import TestCase
 from django.test.client import Client
+import itertools
 
 SKIP_TESTS = False
 NEED_SETTINGS = """Tests for cybersource_gateway module require a
 CYBERSOURCE_TEST section in settings.BURSAR_SETTINGS.  At a 
 minimum, you must specify the 'MERCHANT_ID' and 'TRANKEY'."""
 
+# the most SQL queries each operation may run
+QUERY_BUDGETS = {
+    'authorize_payment' : 3,
+    'capture_payment' : 2,
+    'capture_authorized_payment' : 6,
+    'release_authorized_payment' : 3,
+    'record_authorization' : 3,
+    'record_payment' : 6,
+    'record_release' : 3,
+}
+
+REQUEST_DATA = {
+    'config' : {'merchantID' : 'acme_store', 'password' : 'p&ss<word>'},
+    'merchantReferenceCode' : '1042_1',
+    'billTo' : {
+        'firstName' : u'Zo\xeb',
+        'lastName' : "O'Brien & Sons",
+        'street1' : '12 <Main> St.',
+        'city' : 'Testington',
+        'state' : 'TX',
+        'postalCode' : '55555',
+        'country' : 'US',
+        'email' : 'zoe@example.com',
+    },
+    'purchaseTotals' : {'currency' : 'USD', 'grandTotalAmount' : Decimal('20.00')},
+    'card' : {'accountNumber' : '4111111111111111', 'expirationMonth' : '12', 'expirationYear' : '2012'},
+    'authorize' : True,
+}
+
+REPLY = '''<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">
+<soap:Header></soap:Header>
+<soap:Body><c:replyMessage xmlns:c="urn:schemas-cybersource-com:transaction-data-1.26">
+<c:merchantReferenceCode>1</c:merchantReferenceCode>
+<c:requestID>%(request_id)s</c:requestID>
+<c:decision>%(decision)s</c:decision>
+<c:reasonCode>%(reason)s</c:reasonCode>
+<c:requestToken>Ahj/7wSR</c:requestToken>
+<c:purchaseTotals><c:currency>USD</c:currency></c:purchaseTotals>
+<c:ccAuthReply><c:reasonCode>%(reason)s</c:reasonCode><c:amount>20.00</c:amount><c:authorizationCode>888888</c:authorizationCode>
+<c:avsCode>X</c:avsCode><c:cvCode>M</c:cvCode></c:ccAuthReply>
+</c:replyMessage></soap:Body></soap:Envelope>'''
+
 class TestGateway(TestCase):
     def setUp(self):
         global SKIP_TESTS
@@ -114,3 +162,182 @@ class TestGateway(TestCase):
         pend2 = self.gateway.create_pending_payment(purchase=purchase, amount=purchase.total)
     
         self.assertEqual(purchase.paymentspending.count(), 1)
+
+class TestRequestQueries(TestCase):
+    """Building a request must not touch the database once the purchase is loaded."""
+    def setUp(self):
+        self.gateway = processor.PaymentProcessor(settings={
+            'MERCHANT_ID' : 'test', 'TRANKEY' : 'test'})
+        self.default_payment = {
+            'ccv' : '144',
+            'card_number' : '6011000000000012',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def test_prepare_content(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        purchase = Purchase.objects.for_processing(purchase.pk)
+        with QueryCounter() as counter:
+            with purchase.processing():
+                content = self.gateway.prepare_content(purchase, Decimal('20.00'))
+                request = self.gateway.build_request(purchase, content, authorize=True)
+        self.assertEqual(counter.count, 0, counter.queries)
+        self.assertEqual(content['card']['cvNumber'], '144')
+        self.assert_('<ns1:accountNumber>6011000000000012</ns1:accountNumber>' in request)
+        self.assert_('<ns1:grandTotalAmount>%s</ns1:grandTotalAmount>' % content['purchaseTotals']['grandTotalAmount']
+            in request)
+        # nothing about the payment is kept on the shared processor
+        self.failIf(hasattr(self.gateway, 'card') or hasattr(self.gateway, 'bill_to'))
+
+class TestQueryBudgets(TestCase):
+    """Each operation against the gateway simulator, within its query budget."""
+    def setUp(self):
+        self.server = SimulatorServer()
+        self.gateway = processor.PaymentProcessor(dict(self.server.gateway_settings('cybersource'), MERCHANT_ID='test', TRANKEY='test'))
+        self.default_payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def purchase(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        return Purchase.objects.for_processing(purchase.pk)
+
+    def test_query_budgets(self):
+        purchase = self.purchase()
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.authorize_payment, purchase=purchase)
+        self.assert_(result.success, result.message)
+        self.assertEqual(result.stats.http_posts, 1)
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_authorized_payment, result.payment,
+            purchase=purchase)
+        self.assert_(result.success, result.message)
+
+        purchase = self.purchase()
+        auth = self.gateway.authorize_payment(purchase=purchase).payment
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.release_authorized_payment, purchase=purchase,
+            auth=auth)
+        self.assert_(result.success, result.message)
+
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_payment, purchase=self.purchase())
+        self.assert_(result.success, result.message)
+
+class TestRequests(TestCase):
+    """Each operation is a single post, recorded under the reply's requestID."""
+    def setUp(self):
+        ids = itertools.count(1)
+        self.reason = '100'
+        def reply(path, body):
+            if self.reason == '100':
+                decision = 'ACCEPT'
+            else:
+                decision = 'REJECT'
+            return REPLY % {'request_id' : '27000%i' % ids.next(), 'decision' : decision, 'reason' : self.reason}
+        self.server = GatewayServer(reply=reply)
+        self.gateway = processor.PaymentProcessor(settings={
+            'MERCHANT_ID' : 'test', 'TRANKEY' : 'test',
+            'CONNECTION_TEST' : self.server.url + '/commerce/1.x/transactionProcessor'})
+        self.default_payment = {
+            'ccv' : '144',
+            'card_number' : '6011000000000012',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_capture(self):
+        purchase = make_test_purchase(sub_total=Decimal('10.00'), payment=self.default_payment)
+        result = self.gateway.capture_payment(purchase=purchase)
+        self.assert_(result.success)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(result.payment.transaction_id, '270001')
+        self.assertEqual(result.response['ccAuthReply.authorizationCode'], '888888')
+        self.assertEqual(purchase.total_payments, Decimal('10.00'))
+        body = self.server.posts[0][1]
+        self.assert_('<ns1:ccAuthService run="true"/>' in body)
+        self.assert_('<ns1:ccCaptureService run="true"></ns1:ccCaptureService>' in body)
+
+    def test_process(self):
+        """Test that process() authorizes and captures in a single request by default,
+        or only authorizes when CAPTURE is off."""
+        purchase = make_test_purchase(sub_total=Decimal('15.00'), payment=self.default_payment)
+        result = self.gateway.process(purchase)
+        self.assert_(result.success)
+        self.assertEqual(len(self.server.posts), 1)
+        body = self.server.posts[0][1]
+        self.assert_('<ns1:ccAuthService run="true"/>' in body)
+        self.assert_('<ns1:ccCaptureService run="true"></ns1:ccCaptureService>' in body)
+        self.assert_('<ns1:accountNumber>6011000000000012</ns1:accountNumber>' in body)
+        self.assert_('<ns1:grandTotalAmount>15' in body)
+        self.assertEqual(purchase.total_payments, Decimal('15.00'))
+
+        self.gateway.settings['CAPTURE'] = False
+        purchase = make_test_purchase(sub_total=Decimal('15.00'), payment=self.default_payment)
+        self.gateway.process(purchase)
+        self.failIf('ccCaptureService' in self.server.posts[1][1])
+        self.assertEqual(purchase.authorized_remaining, Decimal('15.00'))
+
+    def test_authorize_and_capture(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        result = self.gateway.authorize_payment(purchase=purchase)
+        self.assert_(result.success)
+        auth = result.payment
+        self.assertEqual(auth.transaction_id, '270001')
+        self.assertEqual(purchase.authorized_remaining, Decimal('20.00'))
+        self.failIf('ccCaptureService' in self.server.posts[0][1])
+
+        result = self.gateway.capture_authorized_payment(auth, purchase=purchase)
+        self.assert_(result.success)
+        self.assertEqual(result.payment.transaction_id, '270002')
+        self.assertEqual(purchase.total_payments, Decimal('20.00'))
+        body = self.server.posts[1][1]
+        self.assert_('<ns1:authRequestID>270001</ns1:authRequestID>' in body)
+        self.failIf('accountNumber' in body)
+
+    def test_release(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        auth = self.gateway.authorize_payment(purchase=purchase).payment
+        result = self.gateway.release_authorized_payment(purchase=purchase, auth=auth)
+        self.assert_(result.success)
+        self.assert_('<ns1:ccAuthReversalService run="true">' in self.server.posts[1][1])
+        self.assert_(Authorization.objects.get(pk=auth.pk).complete)
+
+    def test_decline(self):
+        self.reason = '203'
+        purchase = make_test_purchase(sub_total=Decimal('10.00'), payment=self.default_payment)
+        result = self.gateway.capture_payment(purchase=purchase)
+        self.failIf(result.success)
+        self.assertEqual(result.message, processor.CYBERSOURCE_RESPONSES['203'])
+        self.assertEqual(purchase.paymentfailures.get().transaction_id, '270001')
+        self.assertEqual(purchase.total_payments, Decimal('0.00'))
+
+    def test_parse_and_redact(self):
+        reply = processor.parse_reply(REPLY % {'request_id' : '99', 'decision' : 'ACCEPT', 'reason' : '100'})
+        self.assertEqual(reply['requestID'], '99')
+        self.assertEqual(reply['reasonCode'], '100')
+        self.assertEqual(reply['ccAuthReply.cvCode'], 'M')
+        self.assertEqual(reply['purchaseTotals.currency'], 'USD')
+        self.assertEqual(processor.parse_reply('<html>Not found'), {})
+        request = get_builder('bursar/gateway/cybersource_gateway/request.xml').build(REQUEST_DATA)
+        redacted = processor.redact_request(request)
+        self.failIf('4111111111111111' in redacted)
+        self.failIf('p&amp;ss' in redacted)
+        self.assert_('<ns1:accountNumber>REDACTED</ns1:accountNumber>' in redacted)
+
+class TestRequestBuilder(TestCase):
+    def test_golden(self):
+        """Test that the request builder matches the template and the golden request."""
+        name = 'bursar/gateway/cybersource_gateway/request.xml'
+        request = get_builder(name).build(REQUEST_DATA)
+        self.assertEqual(request, loader.get_template(name).render(Context(REQUEST_DATA)))
+        self.assertEqual(request, read_golden(__file__, 'request.xml'))
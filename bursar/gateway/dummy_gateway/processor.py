@@ -39,12 +39,12 @@ class PaymentProcessor(BasePaymentProcessor):
             if ccn == '4222222222222':
                 if ccv == '222':
                     self.log_extra('Bad CCV forced')
-                    payment = self.record_failure(amount=amount, transaction_id='2', 
+                    payment = self.record_failure(amount=amount, purchase=purchase,
                         reason_code='2', details='CCV error forced')                
                     return ProcessorResult(self.key, False, _('Bad CCV - order declined'), payment)
                 else:
                     self.log_extra('Setting a bad credit card number to force an error')
-                    payment = self.record_failure(amount=amount, transaction_id='2', 
+                    payment = self.record_failure(amount=amount, purchase=purchase,
                         reason_code='2', details='Credit card number error forced')                
                     return ProcessorResult(self.key, False, _('Bad credit card number - order declined'), payment)
 
@@ -62,7 +62,7 @@ class PaymentProcessor(BasePaymentProcessor):
         return ProcessorResult(self.key, True, _('Success'), payment)
 
 
-    def capture_authorized_payment(self, authorization, amount=NOTSET, purchase=None):
+    def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
         """
         Capture a prior authorization
         """
@@ -72,12 +72,11 @@ class PaymentProcessor(BasePaymentProcessor):
             amount = authorization.amount
             
         payment = self.record_payment(amount=amount, reason_code="0", 
-            transaction_id="dummy", authorization=authorization, purchase=purchase)
+            authorization=authorization, purchase=purchase)
         
         return ProcessorResult(self.key, True, _('Success'), payment)
         
     def release_authorized_payment(self, purchase=None, auth=None, testing=False):
         """Release a previously authorized payment."""
-        auth.complete = True
-        auth.save()
+        self.record_release(auth, purchase=purchase)
         return ProcessorResult(self.key, True, _('Success'))
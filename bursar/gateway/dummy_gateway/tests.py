@@ -2,7 +2,7 @@
 """Bursar Dummy Gateway Tests."""
 from bursar.gateway.dummy_gateway import processor
 from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
+from bursar.tests import make_test_purchase, run_within_budget
 from decimal import Decimal
 from django.conf import settings
 from django.contrib.sites.models import Site
@@ -11,6 +11,18 @@ from django.core.urlresolvers import reverse as url
 from django.test import TestCase
 from django.test.client import Client
 
+# the most SQL queries each operation may run
+QUERY_BUDGETS = {
+    'create_pending_payment' : 3,
+    'authorize_payment' : 9,
+    'capture_payment' : 3,
+    'capture_authorized_payment' : 7,
+    'release_authorized_payment' : 3,
+    'record_authorization' : 7,
+    'record_payment' : 7,
+    'record_release' : 3,
+}
+
 class TestGateway(TestCase):
     def setUp(self):
         self.client = Client()
@@ -86,3 +98,20 @@ class TestGateway(TestCase):
         pend2 = self.gateway.create_pending_payment(purchase=purchase, amount=purchase.total)
     
         self.assertEqual(purchase.paymentspending.count(), 1)
+
+    def test_query_budgets(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        run_within_budget(self, QUERY_BUDGETS, self.gateway.create_pending_payment, purchase=purchase)
+        auth = run_within_budget(self, QUERY_BUDGETS, self.gateway.authorize_payment, purchase=purchase).payment
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_authorized_payment, auth, purchase=purchase)
+        self.assert_(result.success)
+        self.assertEqual([child.operation for child in result.stats.children], ['record_payment'])
+
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        auth = run_within_budget(self, QUERY_BUDGETS, self.gateway.authorize_payment, purchase=purchase).payment
+        run_within_budget(self, QUERY_BUDGETS, self.gateway.release_authorized_payment, purchase=purchase, auth=auth)
+        self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_payment, purchase=purchase)
+        self.assertEqual(purchase.total_payments, Decimal('20.00'))
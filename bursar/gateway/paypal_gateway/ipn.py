@@ -0,0 +1,195 @@
+"""
+Processing queued PayPal IPNs.
+
+With the IPN_QUEUE setting on, the ipn view only stores what PayPal posted as
+an IpnMessage and answers at once, so a slow postback never holds up a web
+worker or makes PayPal send the IPN again.  The process_ipn command then
+drains the queue::
+
+    report = process_queue(gateway)
+
+A batch of IPNs is taken at a time and posted back to PayPal together,
+over the shared transport's pooled connections.  Each verified IPN is
+accepted in its own transaction.  An IPN which can't be verified or
+accepted is tried again IPN_RETRY_DELAY seconds later, doubling after each
+attempt, and after IPN_ATTEMPTS attempts it is marked failed, left in the
+queue with its last error for someone to look at.  `process_ipn --retry-failed`
+queues the failed IPNs again.
+
+Each IPN's attempt is counted when a worker takes it, which also puts off
+its next attempt, so two workers don't take the same IPN and one which dies
+part way only delays its batch.
+"""
+from bursar.errors import TransportError
+from bursar.gateway.paypal_gateway.models import IpnMessage, IPN_DONE, IPN_FAILED, IPN_IGNORED, IPN_PENDING
+from bursar.gateway.paypal_gateway.processor import mark_ipn_seen
+from bursar.gateway.steps import Parallel, Return
+from datetime import datetime, timedelta
+from decimal import Decimal
+from django.db import transaction
+from django.http import QueryDict
+from django.utils.encoding import smart_str
+import codecs
+import logging
+
+log = logging.getLogger('bursar.gateway.paypal_gateway')
+
+RETRIED = 'retried'
+
+class IpnReport(object):
+    """Counts of the IPNs handled by process_queue, by outcome."""
+
+    def __init__(self):
+        self.counts = {IPN_DONE : 0, IPN_IGNORED : 0, RETRIED : 0, IPN_FAILED : 0}
+
+    def __str__(self):
+        return '%i accepted, %i ignored, %i to retry, %i failed' % (self.counts[IPN_DONE],
+            self.counts[IPN_IGNORED], self.counts[RETRIED], self.counts[IPN_FAILED])
+
+    def add(self, outcome):
+        self.counts[outcome] += 1
+
+def accept_ipn_data(gateway, data):
+    """Accept a verified IPN, returning False if it is not one to record."""
+    status = data.get('payment_status', 'unknown')
+    if status != "Completed":
+        # We want to respond to anything that isn't a payment - but we won't insert into our database.
+        log.info("Ignoring IPN data for non-completed payment. Status is '%s'", status)
+        return False
+
+    invoice = data.get('invoice', '')
+    if not invoice:
+        invoice = data.get('item_number', '')
+    if not invoice:
+        log.info("No invoice # in data, aborting IPN")
+        return False
+
+    gross = Decimal(data['mc_gross'])
+    txn_id = data['txn_id']
+    note = data.get('memo', '')
+    gateway.accept_ipn(invoice, gross, txn_id, note)
+    return True
+
+def parse_ipn(raw):
+    """The IPN's fields, decoded with the charset PayPal says it used."""
+    # the fields are percent encoded, so decode them from bytes
+    raw = smart_str(raw)
+    data = QueryDict(raw)
+    charset = data.get('charset', None)
+    if charset:
+        try:
+            codecs.lookup(charset)
+        except LookupError:
+            log.warn('Unknown IPN charset %s', charset)
+        else:
+            data = QueryDict(raw, encoding=charset)
+    return data
+
+def process_queue(gateway, batch_size=None, now=None):
+    """Process the queued IPNs that are due, a batch at a time, returning an IpnReport."""
+    if batch_size is None:
+        batch_size = gateway.settings['IPN_BATCH']
+    report = IpnReport()
+    while True:
+        if now is None:
+            started = datetime.now()
+        else:
+            started = now
+        messages = _claim(gateway, started, batch_size)
+        if not messages:
+            break
+        _process_batch(gateway, messages, report)
+    log.info('IPN queue processed: %s', report)
+    return report
+
+def retry_failed():
+    """Queue the failed IPNs again, returning how many there were."""
+    return IpnMessage.objects.filter(status=IPN_FAILED).update(status=IPN_PENDING, attempts=0,
+        next_attempt=datetime.now())
+
+def _claim(gateway, now, batch_size):
+    """Take up to `batch_size` due IPNs, counting the attempt so no other worker takes them."""
+    messages = []
+    due = IpnMessage.objects.filter(status=IPN_PENDING, next_attempt__lte=now).order_by('id')
+    for message in due[:batch_size]:
+        attempts = message.attempts + 1
+        retry_at = now + _retry_delay(gateway, attempts)
+        claimed = IpnMessage.objects.filter(pk=message.pk, status=IPN_PENDING,
+            attempts=message.attempts).update(attempts=attempts, next_attempt=retry_at)
+        if claimed:
+            message.attempts = attempts
+            message.next_attempt = retry_at
+            messages.append(message)
+    return messages
+
+def _retry_delay(gateway, attempts):
+    return timedelta(seconds=gateway.settings['IPN_RETRY_DELAY'] * 2 ** (attempts - 1))
+
+def _verify_steps(gateway, messages):
+    results = yield Parallel([gateway.get_ipn_post(message.raw) for message in messages])
+    raise Return(results)
+
+def _process_batch(gateway, messages, report):
+    results = gateway.run_steps(_verify_steps(gateway, messages))
+    for message, response in zip(messages, results):
+        if isinstance(response, TransportError):
+            _failed(gateway, message, 'Could not verify with PayPal: %s' % response, report)
+        elif response.body == 'INVALID':
+            log.warn('PayPal says IPN #%i is invalid', message.id)
+            _finish(message, IPN_IGNORED, 'PayPal answered INVALID', report)
+        elif response.body != 'VERIFIED':
+            _failed(gateway, message, 'Unexpected answer from PayPal: %r' % response.body[:200], report)
+        else:
+            try:
+                accepted = _accept(gateway, message)
+            except Exception, e:
+                log.exception('Error accepting IPN #%i', message.id)
+                _failed(gateway, message, 'Error accepting: %s' % e, report)
+            else:
+                if accepted:
+                    report.add(IPN_DONE)
+                else:
+                    report.add(IPN_IGNORED)
+
+def accept_verified_ipn(gateway, data, message=None):
+    """Accept a verified IPN in its own transaction, returning False if it is not
+    one to record.  Its transaction is only remembered as seen once committed."""
+    accepted = _record(gateway, data, message)
+    if accepted:
+        mark_ipn_seen(data['txn_id'])
+    return accepted
+
+def _record(gateway, data, message):
+    accepted = accept_ipn_data(gateway, data)
+    if message is not None:
+        if accepted:
+            message.status = IPN_DONE
+        else:
+            message.status = IPN_IGNORED
+        message.processed = datetime.now()
+        message.error = ''
+        message.save()
+    return accepted
+
+# the payment and the IPN's status are recorded together
+_record = transaction.commit_on_success(_record)
+
+def _accept(gateway, message):
+    return accept_verified_ipn(gateway, parse_ipn(message.raw), message)
+
+def _finish(message, status, error, report):
+    message.status = status
+    message.processed = datetime.now()
+    message.error = error
+    message.save()
+    report.add(status)
+
+def _failed(gateway, message, error, report):
+    if message.attempts >= gateway.settings['IPN_ATTEMPTS']:
+        log.error('Giving up on IPN #%i after %i attempts: %s', message.id, message.attempts, error)
+        _finish(message, IPN_FAILED, error, report)
+    else:
+        log.warn('IPN #%i will be retried at %s: %s', message.id, message.next_attempt, error)
+        message.error = error
+        message.save()
+        report.add(RETRIED)
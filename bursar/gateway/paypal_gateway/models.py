@@ -0,0 +1,38 @@
+from datetime import datetime
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+IPN_PENDING = 'pending'
+IPN_DONE = 'done'
+IPN_IGNORED = 'ignored'
+IPN_FAILED = 'failed'
+
+IPN_STATUS_CHOICES = (
+    (IPN_PENDING, _('Pending')),
+    (IPN_DONE, _('Done')),
+    (IPN_IGNORED, _('Ignored')),
+    (IPN_FAILED, _('Failed')),
+)
+
+class IpnMessage(models.Model):
+    """
+    An IPN as PayPal posted it, queued by the ipn view for the process_ipn command.
+    """
+    raw = models.TextField(_("Posted data"))
+    status = models.CharField(_("Status"), max_length=10, choices=IPN_STATUS_CHOICES,
+        default=IPN_PENDING, db_index=True)
+    attempts = models.IntegerField(_("Attempts"), default=0)
+    received = models.DateTimeField(_("Received"), default=datetime.now)
+    next_attempt = models.DateTimeField(_("Next attempt"), default=datetime.now, db_index=True)
+    processed = models.DateTimeField(_("Processed"), blank=True, null=True)
+    error = models.TextField(_("Last error"), blank=True)
+
+    def __unicode__(self):
+        if self.id is not None:
+            return u"IPN #%i (%s)" % (self.id, self.status)
+        else:
+            return u"IPN (unsaved)"
+
+    class Meta:
+        verbose_name = _("PayPal IPN")
+        verbose_name_plural = _("PayPal IPNs")
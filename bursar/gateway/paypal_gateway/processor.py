@@ -13,15 +13,39 @@ be returned after a successful purchase.  In Satchmo, this is "PAYPAL_satchmo_ch
 
 from bursar.errors import GatewayError
 from bursar.gateway.base import HeadlessPaymentProcessor
+from bursar.gateway.steps import Post, Return
 from bursar.models import Payment, Purchase
+from bursar.utils import FileCache, LRUCache
 from django.contrib.sites.models import Site
+from django.db import IntegrityError, transaction
 from django.core import urlresolvers
 from django.utils.http import urlencode
 from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_str
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
+import hashlib
+import keyedcache
 
-import urllib2
+# transactions recently seen by this process, in front of the shared cache and the database
+SEEN_TRANSACTIONS = LRUCache(1000)
+# seconds a transaction is remembered in the shared cache
+SEEN_TIMEOUT = 24 * 60 * 60
+
+class SigningKeys(object):
+    """Our private key and certificate, and PayPal's certificate, for encrypting forms."""
+
+    def __init__(self, private_key, public_key, paypal_key):
+        from M2Crypto import EVP, X509
+        self.pkey = EVP.load_key(private_key)
+        self.x509 = X509.load_cert(public_key)
+        self.recipients = X509.X509_Stack()
+        self.recipients.push(X509.load_cert(paypal_key))
+
+# key material by path, read again when the files change
+SIGNING_KEYS = FileCache(SigningKeys)
+# encrypted forms by a hash of their plaintext, with the SigningKeys they were made with
+ENCRYPTED_FORMS = LRUCache(500)
 
 PAYMENT_CMD = {
     'BUY_NOW' : '_xclick',
@@ -86,6 +110,19 @@ class PaymentProcessor(HeadlessPaymentProcessor):
             # Your Cert ID, copied from the PayPal website after uploading your public key
             'PUBLIC_CERT_ID' : "",
             
+            'POST_URL' : 'https://www.paypal.com/cgi-bin/webscr',
+            'POST_TEST_URL' : 'https://www.sandbox.paypal.com/cgi-bin/webscr',
+
+            # Queue IPNs for the process_ipn command, rather than confirming them
+            # with PayPal before answering.  Needs process_ipn run regularly.
+            'IPN_QUEUE' : False,
+            # IPNs confirmed together by process_ipn
+            'IPN_BATCH' : 50,
+            # Attempts at an IPN before it is marked failed
+            'IPN_ATTEMPTS' : 5,
+            # Seconds before an IPN is retried, doubled after each attempt
+            'IPN_RETRY_DELAY' : 60,
+
             'BUY_BUTTON_URL' : 'http://images.paypal.com/images/x-click-but01.gif',
             'SUBSCRIBE_BUTTON_URL' : 'https://www.paypal.com/en_US/i/btn/btn_subscribeCC_LG.gif',
             'TEST_BUY_BUTTON_URL' : 'https://www.sandbox.paypal.com/en_US/i/btn/btn_buynowCC_LG.gif',
@@ -109,61 +146,78 @@ class PaymentProcessor(HeadlessPaymentProcessor):
                 raise GatewayError('paypal_gateway: You must install M2Crypto to use an encrypted PayPal form.')
 
     def accept_ipn(self, invoice, amount, transaction_id, note=""):
-        """Mark a PayPal payment as successfully paid - due to a successful IPN confirmation."""
+        """Mark a PayPal payment as successfully paid - due to a successful IPN confirmation.
+
+        PayPal sends an IPN again until it is answered, so the same transaction
+        often arrives many times.  Returns the Payment, or None for a transaction
+        already recorded."""
         
         # skip if we've already handled this one
-        if Payment.objects.filter(transaction_id=transaction_id).count() > 0:
+        if ipn_seen(transaction_id):
             self.log.warn('IPN received for transaction #%s, already processed', transaction_id)
-        else:
-            self.log_extra('Successful IPN on invoice #%s, transaction #%s', invoice, transaction_id)
-            # invoice may have a suffix due to retries
-            invoice = invoice.replace('-', '_')
-            invoice = invoice.split('_')[0]
-            purchase = Purchase.objects.get(pk=invoice)
+            return None
+
+        self.log_extra('Successful IPN on invoice #%s, transaction #%s', invoice, transaction_id)
+        # invoice may have a suffix due to retries
+        invoice = invoice.replace('-', '_')
+        invoice = invoice.split('_')[0]
+        purchase = Purchase.objects.get(pk=invoice)
+
+        # the unique transaction id stops a duplicate IPN being recorded at the same time
+        sid = transaction.savepoint()
+        try:
             payment = self.record_payment(
                 amount = amount,
                 transaction_id = transaction_id,
                 purchase = purchase
                 )
-
-            if note:
-                payment.add_note(_('---Comment via Paypal IPN---') + u'\n' + note)
-                self.log_extra("Saved order notes from PayPal: %s", note)
-
-            #TODO: verify - is this right? not sure if I should be setting them to "completed"
-            for item in purchase.recurring_lineitems():
-                if not item.completed:
-                    self.log_extra("Marking item: %s complete", item)
-                    item.completed = True
-                    item.save()
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            self.log.warn('IPN received for transaction #%s, recorded at the same time', transaction_id)
+            return None
+        transaction.savepoint_commit(sid)
+
+        if note:
+            payment.add_note(_('---Comment via Paypal IPN---') + u'\n' + note)
+            self.log_extra("Saved order notes from PayPal: %s", note)
+
+        #TODO: verify - is this right? not sure if I should be setting them to "completed"
+        for item in purchase.recurring_lineitems():
+            if not item.completed:
+                self.log_extra("Marking item: %s complete", item)
+                item.completed = True
+                item.save()
+        return payment
 
     def confirm_ipn_data(self, data):
         """Test an IPN from PayPal.  If `force` is set, then skip the post."""
+        return self.run_steps(self.confirm_ipn_data_steps(data))
 
-        self.log_extra("PayPal IPN data: ", repr(data))
-        
-        if self.is_live():
-            self.log.debug("Live IPN on %s", self.key)
-            url = self.settings['POST_URL']
-        else:
-            self.log.debug("Test IPN on %s", self.key)
-            url = self.settings['POST_TEST_URL']
-        
-        data['cmd'] = "_notify-validate"
-        params = urlencode(data)
-
-        req = urllib2.Request(url)
-        req.add_header("Content-type", "application/x-www-form-urlencoded")
-        fo = urllib2.urlopen(req, params)
+    def confirm_ipn_data_steps(self, data):
+        """Steps for confirm_ipn_data, see bursar.gateway.steps."""
+        self.log_extra("PayPal IPN data: %r", data)
+        fo = yield self.get_ipn_post(urlencode(data))
 
         ret = fo.read()
         if ret == "VERIFIED":
             self.log.info("PayPal IPN data verification was successful.")
-            return True
+            raise Return(True)
 
         self.log.info("PayPal IPN data verification failed.")
         self.log_extra("HTTP code %s, response text: '%s'" % (fo.code, ret))
-        return False
+        raise Return(False)
+
+    def get_ipn_post(self, raw):
+        """The Post sending an IPN, url encoded as PayPal sent it, back to be verified.
+        PayPal answers "VERIFIED" or "INVALID"."""
+        if self.is_live():
+            self.log.debug("Live IPN on %s", self.key)
+            url = self.settings['POST_URL']
+        else:
+            self.log.debug("Test IPN on %s", self.key)
+            url = self.settings['POST_TEST_URL']
+        return Post(url, 'cmd=_notify-validate&' + smart_str(raw), {"Content-type" : "application/x-www-form-urlencoded"},
+            idempotent=True)
 
     @property
     def ipn_url(self):
@@ -219,8 +273,10 @@ class PaymentProcessor(HeadlessPaymentProcessor):
 
     def form_encrypted(self, data):
         """Return an s/mime encrypted form.  Refer to 
-        http://sandbox.rulemaker.net/ngps/m2/howto.smime.html for instructions."""
-        from M2Crypto import BIO, SMIME, X509
+        http://sandbox.rulemaker.net/ngps/m2/howto.smime.html for instructions.
+
+        The keys are read once, and again when their files change, and the
+        encrypted form is kept for when the same form is rendered again."""
         certid = self.settings["PUBLIC_CERT_ID"]
         ret = ['CERT_ID=%s' % certid]
         ret.extend([u'%s=%s' % (key, val) for key, val in data.items() if val])
@@ -228,26 +284,38 @@ class PaymentProcessor(HeadlessPaymentProcessor):
         raw = raw.encode('utf-8')
         
         self.log_extra('Plaintext form: %s', raw)
-        
-        # encrypt the plaintext
-        
-        # make an smime object
+
+        keys = SIGNING_KEYS.get(self.localprikey, self.localpubkey, self.paypalpubkey)
+        digest = (hashlib.sha1(raw).hexdigest(), self.localprikey, self.localpubkey, self.paypalpubkey)
+        cached = ENCRYPTED_FORMS.get(digest)
+        if cached is not None and cached[0] is keys:
+            self.log_extra('Using the cached encrypted form')
+            form = cached[1]
+        else:
+            form = self.encrypt_form(raw, keys)
+            ENCRYPTED_FORMS.set(digest, (keys, form))
+        self.log_extra('Encrypted form: %s', form)
+        return mark_safe(u"""<input type="hidden" name="cmd" value="_s-xclick" />
+<input type="hidden" name="encrypted" value="%s" />
+        """ % form)
+
+    def encrypt_form(self, raw, keys):
+        """Sign `raw` with our key and encrypt it to PayPal, returning it as PEM."""
+        from M2Crypto import BIO, SMIME
+
+        # make an smime object, with our public and private keys
         s = SMIME.SMIME()
-        
-        # load our public and private keys	
-        s.load_key_bio(BIO.openfile(self.localprikey), BIO.openfile(self.localpubkey))
-        
+        s.pkey = keys.pkey
+        s.x509 = keys.x509
+
         # put the data in the buffer
         buf = BIO.MemoryBuffer(raw)
         
         # sign the text
         p7 = s.sign(buf, flags=SMIME.PKCS7_BINARY)
         
-        # Load target cert to encrypt to.
-        x509 = X509.load_cert_bio(BIO.openfile(self.paypalpubkey))
-        sk = X509.X509_Stack()
-        sk.push(x509)
-        s.set_x509_stack(sk)
+        # encrypt to PayPal's cert
+        s.set_x509_stack(keys.recipients)
         
         # Set cipher: 3-key triple-DES in CBC mode.
         s.set_cipher(SMIME.Cipher('des_ede3_cbc'))
@@ -264,11 +332,7 @@ class PaymentProcessor(HeadlessPaymentProcessor):
         p7.write(out)
         
         # read the result
-        form = out.read()
-        self.log_extra('Encrypted form: %s', form)
-        return mark_safe(u"""<input type="hidden" name="cmd" value="_s-xclick" />
-<input type="hidden" name="encrypted" value="%s" />
-        """ % form)
+        return out.read()
         
     def get_form_data(self, purchase):
         """Creates a list of key,val to be sumbitted to PayPal."""
@@ -369,3 +433,26 @@ class PaymentProcessor(HeadlessPaymentProcessor):
                 submit['state'] = purchase.bill_state
                 
         return submit
+
+def ipn_seen(transaction_id):
+    """True if the transaction has been recorded, checking this process's
+    recent transactions, then the shared cache, then the database."""
+    if transaction_id in SEEN_TRANSACTIONS:
+        return True
+    try:
+        keyedcache.cache_get('paypal_ipn', transaction_id)
+    except keyedcache.NotCachedError:
+        pass
+    else:
+        SEEN_TRANSACTIONS.set(transaction_id, True)
+        return True
+    if Payment.objects.filter(transaction_id=transaction_id).values_list('pk', flat=True)[:1]:
+        mark_ipn_seen(transaction_id)
+        return True
+    return False
+
+def mark_ipn_seen(transaction_id):
+    """Remember the transaction as recorded.  Only call this once the payment
+    is committed, or a payment rolled back would never be recorded."""
+    SEEN_TRANSACTIONS.set(transaction_id, True)
+    keyedcache.cache_set('paypal_ipn', transaction_id, value=True, length=SEEN_TIMEOUT, skiplog=True)
@@ -1,23 +1,50 @@
 # -*- coding: UTF-8 -*-
 """Bursar Dummy Gateway Tests."""
 from bursar.gateway.paypal_gateway import processor
+from bursar.gateway.paypal_gateway.ipn import _accept, process_queue, retry_failed
+from bursar.gateway.paypal_gateway.models import IpnMessage, IPN_DONE, IPN_FAILED, IPN_IGNORED, IPN_PENDING
 from bursar.errors import GatewayError
-from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
+from bursar.models import Authorization, Payment, Purchase
+from bursar.tests import make_test_purchase, GatewayServer
 from bursar.bursar_settings import get_bursar_setting
 from decimal import Decimal
 from django.conf import settings
+from django.conf.urls.defaults import *
+from django.db import IntegrityError
 from django.contrib.sites.models import Site
 from django.core import urlresolvers
 from django.core.urlresolvers import reverse as url
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.utils.http import urlencode
+from datetime import datetime
+import keyedcache
 
 SKIP_TESTS = False
 NEED_SETTINGS = """Tests for paypal_gateway module require an
 PAYPAL_TEST section in settings.BURSAR_SETTINGS.  At a 
 minimum, you must specify the LOGIN, TRANKEY, and STORE_NAME."""
 
+IPN_SETTINGS = {
+    'BUSINESS' : 'shop@example.com',
+    'IPN_RETRY_DELAY' : 0,
+    'IPN_ATTEMPTS' : 2,
+    'IPN_QUEUE' : True,
+}
+
+IMMEDIATE_SETTINGS = {
+    'BUSINESS' : 'shop@example.com',
+}
+
+urlpatterns = patterns('bursar.gateway.paypal_gateway.views',
+    (r'^ipn/$', 'ipn', {'settings' : IPN_SETTINGS}, 'PAYPAL_GATEWAY_ipn'),
+    (r'^ipn/immediate/$', 'ipn', {'settings' : IMMEDIATE_SETTINGS}, 'PAYPAL_GATEWAY_ipn_immediate'),
+)
+
+def ipn_body(purchase_id, txn_id, status='Completed', amount='10.00'):
+    return urlencode([('mc_gross', amount), ('invoice', purchase_id), ('payment_status', status),
+        ('txn_id', txn_id), ('memo', 'Leave it by the door'), ('charset', 'windows-1252')])
+
 class TestGateway(TestCase):
     def setUp(self):
         global SKIP_TESTS
@@ -52,3 +79,155 @@ class TestGateway(TestCase):
         self.assertEqual(purchase.total_payments, Decimal('10.00'))
         self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
 
+
+class TestIpnDuplicates(TestCase):
+    def setUp(self):
+        self.gateway = processor.PaymentProcessor(settings={'BUSINESS' : 'shop@example.com'})
+
+    def forget(self, transaction_id):
+        processor.SEEN_TRANSACTIONS.clear()
+        keyedcache.cache_delete('paypal_ipn', transaction_id)
+
+    def test_duplicates(self):
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        self.failIf(processor.ipn_seen('DUP1'))
+        payment = self.gateway.accept_ipn(str(purchase.id), Decimal('10.00'), 'DUP1')
+        self.assertEqual(payment.transaction_id, 'DUP1')
+        # not remembered until the caller commits the payment, but found in the database
+        self.failIf('DUP1' in processor.SEEN_TRANSACTIONS)
+        self.assertEqual(self.gateway.accept_ipn(str(purchase.id), Decimal('10.00'), 'DUP1'), None)
+        self.assert_('DUP1' in processor.SEEN_TRANSACTIONS)
+
+        # from the shared cache, and then the database
+        processor.SEEN_TRANSACTIONS.clear()
+        self.assert_(processor.ipn_seen('DUP1'))
+        self.forget('DUP1')
+        self.assertEqual(self.gateway.accept_ipn(str(purchase.id), Decimal('10.00'), 'DUP1'), None)
+        self.assertEqual(Payment.objects.filter(transaction_id='DUP1').count(), 1)
+        self.forget('DUP1')
+
+    def test_concurrent_duplicate(self):
+        """Test that a duplicate recorded by another process between the check and the insert is skipped."""
+        class RacingProcessor(processor.PaymentProcessor):
+            def record_payment(self, **kwargs):
+                raise IntegrityError('column transaction_id is not unique')
+        gateway = RacingProcessor(settings={'BUSINESS' : 'shop@example.com'})
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        self.assertEqual(gateway.accept_ipn(str(purchase.id), Decimal('10.00'), 'DUP2'), None)
+        # left to the database, which has the other process's payment
+        self.failIf('DUP2' in processor.SEEN_TRANSACTIONS)
+        self.forget('DUP2')
+
+class TestIpnRollback(TransactionTestCase):
+    def tearDown(self):
+        processor.SEEN_TRANSACTIONS.clear()
+        keyedcache.cache_delete('paypal_ipn', 'ROLLBACK1')
+
+    def test_retry_after_rollback(self):
+        """Test that an IPN whose payment is rolled back is recorded when it is retried."""
+        class FailingProcessor(processor.PaymentProcessor):
+            failures = 1
+            def accept_ipn(self, *args, **kwargs):
+                payment = super(FailingProcessor, self).accept_ipn(*args, **kwargs)
+                if self.failures:
+                    self.failures -= 1
+                    raise ValueError('Failed after recording')
+                return payment
+        gateway = FailingProcessor(settings=IPN_SETTINGS)
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        message = IpnMessage.objects.create(raw=ipn_body(purchase.id, 'ROLLBACK1'))
+        self.assertRaises(ValueError, _accept, gateway, message)
+        self.failIf(Payment.objects.filter(transaction_id='ROLLBACK1'))
+        self.failIf(processor.ipn_seen('ROLLBACK1'))
+
+        self.assert_(_accept(gateway, message))
+        self.assertEqual(Payment.objects.filter(transaction_id='ROLLBACK1').count(), 1)
+        self.assertEqual(IpnMessage.objects.get(pk=message.pk).status, IPN_DONE)
+        self.assert_('ROLLBACK1' in processor.SEEN_TRANSACTIONS)
+
+class TestIpnQueue(TestCase):
+    urls = 'bursar.gateway.paypal_gateway.tests'
+
+    def setUp(self):
+        def reply(path, body):
+            if 'txn_id=FORGED' in body:
+                return 'INVALID'
+            return 'VERIFIED'
+        self.server = GatewayServer(reply=reply)
+        IPN_SETTINGS['POST_TEST_URL'] = self.server.url + '/cgi-bin/webscr'
+        IMMEDIATE_SETTINGS['POST_TEST_URL'] = self.server.url + '/cgi-bin/webscr'
+        self.gateway = processor.PaymentProcessor(settings=IPN_SETTINGS)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_view_queues(self):
+        """Test that the ipn view stores the IPN and answers without posting back to PayPal."""
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        body = ipn_body(purchase.id, 'TXN1')
+        response = self.client.post(url('PAYPAL_GATEWAY_ipn'), body, content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        message = IpnMessage.objects.get()
+        self.assertEqual(message.raw, body)
+        self.assertEqual(message.status, IPN_PENDING)
+        self.assertEqual(self.server.posts, [])
+        self.assertEqual(purchase.total_payments, Decimal('0.00'))
+
+    def test_view_records(self):
+        """Test that without IPN_QUEUE the ipn view confirms and records the IPN at once."""
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        response = self.client.post(url('PAYPAL_GATEWAY_ipn_immediate'), ipn_body(purchase.id, 'TXN5'),
+            content_type='application/x-www-form-urlencoded')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.server.posts), 1)
+        self.assertEqual(IpnMessage.objects.count(), 0)
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).total_payments, Decimal('10.00'))
+        processor.SEEN_TRANSACTIONS.clear()
+        keyedcache.cache_delete('paypal_ipn', 'TXN5')
+
+    def test_process_queue(self):
+        paid = make_test_purchase(sub_total=Decimal('10.00'))
+        pending = make_test_purchase(sub_total=Decimal('10.00'))
+        for body in (ipn_body(paid.id, 'TXN1'), ipn_body(pending.id, 'TXN2', status='Pending'),
+                ipn_body(paid.id, 'FORGED')):
+            IpnMessage.objects.create(raw=body)
+
+        report = process_queue(self.gateway, batch_size=2)
+        self.assertEqual(str(report), '1 accepted, 2 ignored, 0 to retry, 0 failed')
+        self.assertEqual(len(self.server.posts), 3)
+        self.assert_(self.server.posts[0][1].startswith('cmd=_notify-validate&mc_gross=10.00&'))
+        self.assertEqual([message.status for message in IpnMessage.objects.order_by('id')],
+            [IPN_DONE, IPN_IGNORED, IPN_IGNORED])
+        self.assertEqual(Purchase.objects.get(pk=paid.pk).total_payments, Decimal('10.00'))
+        self.assertEqual(Payment.objects.get(transaction_id='TXN1').notes.count(), 1)
+        self.assertEqual(Purchase.objects.get(pk=pending.pk).total_payments, Decimal('0.00'))
+
+        # nothing left to do
+        self.assertEqual(str(process_queue(self.gateway)), '0 accepted, 0 ignored, 0 to retry, 0 failed')
+
+    def test_retry_and_fail(self):
+        """Test that an IPN which can't be accepted is retried, then marked failed."""
+        message = IpnMessage.objects.create(raw=ipn_body(999999, 'TXN3'))
+        report = process_queue(self.gateway)
+        self.assertEqual(str(report), '0 accepted, 0 ignored, 1 to retry, 1 failed')
+        message = IpnMessage.objects.get(pk=message.pk)
+        self.assertEqual(message.status, IPN_FAILED)
+        self.assertEqual(message.attempts, 2)
+        self.assert_(message.error.startswith('Error accepting'))
+
+        self.assertEqual(retry_failed(), 1)
+        message = IpnMessage.objects.get(pk=message.pk)
+        self.assertEqual((message.status, message.attempts), (IPN_PENDING, 0))
+
+    def test_retry_later(self):
+        """Test that an IPN PayPal can't be asked about waits for its next attempt."""
+        gateway = processor.PaymentProcessor(settings=dict(IPN_SETTINGS,
+            POST_TEST_URL=self.server.url + '/missing', IPN_RETRY_DELAY=60))
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        message = IpnMessage.objects.create(raw=ipn_body(purchase.id, 'TXN4'))
+        self.assertEqual(str(process_queue(gateway)), '0 accepted, 0 ignored, 1 to retry, 0 failed')
+        message = IpnMessage.objects.get(pk=message.pk)
+        self.assertEqual((message.status, message.attempts), (IPN_PENDING, 1))
+        self.assert_(message.next_attempt > datetime.now())
+        self.assert_('404' in message.error)
+        self.assertEqual(str(process_queue(gateway)), '0 accepted, 0 ignored, 0 to retry, 0 failed')
@@ -1,4 +1,5 @@
 from bursar.bursar_settings import get_bursar_setting
+from bursar.gateway.registry import get_processor
 from django.conf.urls.defaults import *
 from django.conf import settings
 
@@ -30,3 +31,7 @@ paypal_settings = get_bursar_setting(key, default_value={})
 ssl = paypal_settings.get('SSL', False)
 ipn_test = paypal_settings.get('IPN_TEST')
 urlpatterns = make_urlpatterns(paypal_settings, ssl=ssl, ipn_test=ipn_test)
+
+if paypal_settings:
+    # build the processor the views use now, so bad settings show at startup
+    get_processor('paypal', settings=paypal_settings)
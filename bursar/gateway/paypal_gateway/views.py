@@ -1,5 +1,7 @@
 from bursar.errors import GatewayError
-from bursar.gateway.paypal_gateway import processor
+from bursar.gateway.paypal_gateway.ipn import accept_verified_ipn
+from bursar.gateway.paypal_gateway.models import IpnMessage
+from bursar.gateway.registry import get_processor
 from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
@@ -12,45 +14,27 @@ log = logging.getLogger('bursar.gateway.paypal_gateway')
 def ipn(request, settings=None):
     """PayPal IPN (Instant Payment Notification)
     Confirms that payment has been completed and marks invoice as paid.
+
+    With the IPN_QUEUE setting, the IPN is only stored, for the process_ipn
+    command to confirm and record, see bursar/gateway/paypal_gateway/ipn.py.
     Adapted from IPN cgi script provided at http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/456361"""
     
     if not settings:
         raise GatewayError('Paypal IPN needs settings, please put into your urls.')
     
-    gateway = processor.PaymentProcessor(settings=settings)
+    gateway = get_processor('paypal', settings=settings)
 
-    sane = True
-    
     if not request.method == "POST":
         log.warn("IPN request - no post data, ignoring.")
-        sane = False
+
+    elif gateway.settings['IPN_QUEUE']:
+        message = IpnMessage.objects.create(raw=request.raw_post_data)
+        gateway.log_extra('Queued IPN #%i', message.id)
 
     else:
         data = request.POST.copy()
-        if not gateway.confirm_ipn_data(data):
-            sane = False
-            
-    if sane:
-        status = data.get('payment_status', 'unknown')
-        if status != "Completed":
-            # We want to respond to anything that isn't a payment - but we won't insert into our database.
-             log.info("Ignoring IPN data for non-completed payment. Status is '%s'", status)
-             sane = False
-
-    if sane:
-        invoice = data.get('invoice', '')
-        if not invoice:
-            invoice = data.get('item_number', '')
-        
-        if not invoice:
-            log.info("No invoice # in data, aborting IPN")
-            sane = False
-
-    if sane:
-        gross = data['mc_gross']
-        txn_id = data['txn_id']
-        note = data.get('memo', '')
-        gateway.accept_ipn(invoice, gross, txn_id, note)
+        if gateway.confirm_ipn_data(data):
+            accept_verified_ipn(gateway, data)
 
     return HttpResponse()
     
@@ -62,7 +46,7 @@ def ipn_test(request, settings=None):
     if not settings:
         raise GatewayError('Paypal IPN needs settings, please put into your urls.')
 
-    gateway = processor.PaymentProcessor(settings=settings)
+    gateway = get_processor('paypal', settings=settings)
 
     if request.method == "POST":
         data = request.POST.copy()
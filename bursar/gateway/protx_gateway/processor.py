@@ -1,18 +1,54 @@
 """Prot/X Payment Gateway.
 """
+from __future__ import with_statement
 from bursar.gateway.base import BasePaymentProcessor, ProcessorResult, NOTSET
-from bursar.errors import GatewayError
+from bursar.gateway.steps import Post, Return
+from bursar.errors import GatewayError, TransportError
 from bursar.numbers import trunc_decimal
 from decimal import Decimal
 from django.utils.http import urlencode
 from django.utils.translation import ugettext_lazy as _
-import urllib2
 
 PROTOCOL = "2.22"
 
+class ProtxRequest(object):
+    """A post to Prot/X, its url and fields, which can't be changed once built.
+
+    Requests are built for each payment rather than kept on the processor, so
+    one processor can take payments in many threads at once."""
+
+    __slots__ = ('url', 'fields', 'body')
+
+    def __init__(self, url, fields):
+        fields = fields.items()
+        fields.sort()
+        set_field = super(ProtxRequest, self).__setattr__
+        set_field('url', url)
+        set_field('fields', tuple(fields))
+        set_field('body', urlencode(fields))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ProtxRequest is read-only')
+
+    def __repr__(self):
+        return '<ProtxRequest %s: %s>' % (self.url, self.get('VendorTxCode', ''))
+
+    def get(self, name, default=None):
+        for key, value in self.fields:
+            if key == name:
+                return value
+        return default
+
+    @property
+    def packet(self):
+        """The fields, as a new dict."""
+        return dict(self.fields)
+
+def parse_response(body):
+    """The name=value lines of a Prot/X reply, as a dict."""
+    return dict([row.split('=', 1) for row in body.splitlines()])
+
 class PaymentProcessor(BasePaymentProcessor):
-    packet = {}
-    response = {}
     
     def __init__(self, settings={}):
         
@@ -72,13 +108,13 @@ class PaymentProcessor(BasePaymentProcessor):
         else:
             vendor = self.settings['VENDOR']
         
-        self.packet = {
-            'VPSProtocol': PROTOCOL,
-            'TxType': self.settings['CAPTURE'],
-            'Vendor': vendor,
-            'Currency': self.settings['CURRENCY_CODE'],
-            }
-        self.valid = False
+        # the fields sent with every payment, never changed after this
+        self.vendor_fields = (
+            ('VPSProtocol', PROTOCOL),
+            ('TxType', self.settings['CAPTURE']),
+            ('Vendor', vendor),
+            ('Currency', self.settings['CURRENCY_CODE']),
+            )
 
     def _url(self, key):
         if self.settings['SIMULATOR']:
@@ -99,122 +135,123 @@ class PaymentProcessor(BasePaymentProcessor):
         return self._url('CALLBACK')
         
     def prepare_post(self, purchase, amount):
-        
+        """The ProtxRequest paying `amount` for `purchase`, or None if the
+        purchase's details can't be sent."""
         invoice = "%s" % purchase.id
-        failct = purchase.paymentfailures.count()
+        failct = purchase.failure_count
         if failct > 0:
             invoice = "%s_%i" % (invoice, failct)
         
+        packet = dict(self.vendor_fields)
         try:
             cc = purchase.credit_card
-            balance = trunc_decimal(purchase.remaining, 2)
-            self.packet['VendorTxCode'] = invoice
-            self.packet['Amount'] = balance
-            self.packet['Description'] = 'Online purchase'
-            self.packet['CardType'] = cc.credit_type
-            self.packet['CardHolder'] = cc.card_holder
-            self.packet['CardNumber'] = cc.decryptedCC
-            self.packet['ExpiryDate'] = '%02d%s' % (cc.expire_month, str(cc.expire_year)[2:])
+            packet['VendorTxCode'] = invoice
+            packet['Amount'] = trunc_decimal(amount, 2)
+            packet['Description'] = 'Online purchase'
+            packet['CardType'] = cc.credit_type
+            packet['CardHolder'] = cc.card_holder
+            packet['CardNumber'] = cc.decryptedCC
+            packet['ExpiryDate'] = '%02d%s' % (cc.expire_month, str(cc.expire_year)[2:])
             if cc.start_month is not None:
-                self.packet['StartDate'] = '%02d%s' % (cc.start_month, str(cc.start_year)[2:])
+                packet['StartDate'] = '%02d%s' % (cc.start_month, str(cc.start_year)[2:])
             if cc.ccv is not None and cc.ccv != "":
-                self.packet['CV2'] = cc.ccv
+                packet['CV2'] = cc.ccv
             if cc.issue_num is not None and cc.issue_num != "":
-                self.packet['IssueNumber'] = cc.issue_num #'%02d' % int(cc.issue_num)
+                packet['IssueNumber'] = cc.issue_num #'%02d' % int(cc.issue_num)
             addr = [purchase.bill_street1, purchase.bill_street2, purchase.bill_city, purchase.bill_state]
-            self.packet['BillingAddress'] = ', '.join(addr)
-            self.packet['BillingPostCode'] = purchase.bill_postal_code
+            packet['BillingAddress'] = ', '.join(addr)
+            packet['BillingPostCode'] = purchase.bill_postal_code
         except Exception, e:
             self.log.error('preparing data, got error: %s\nData: %s', e, purchase)
-            self.valid = False
-            return
+            return None
             
         # handle pesky unicode chars in names
-        for key, value in self.packet.items():
+        for key, value in packet.items():
             try:
-                value = value.encode('utf-8')
-                self.packet[key] = value
+                packet[key] = value.encode('utf-8')
             except AttributeError:
                 pass
         
-        self.postString = urlencode(self.packet)
-        self.url = self.connection
-        self.valid = True
+        return ProtxRequest(self.connection, packet)
     
     def prepare_data3d(self, md, pares):
-        self.packet = {}
-        self.packet['MD'] = md
-        self.packet['PARes'] = pares
-        self.postString = urlencode(self.packet)
-        self.url = self.callback
-        self.valid = True
+        """The ProtxRequest completing a 3D-Secure check."""
+        return ProtxRequest(self.callback, {'MD' : md, 'PARes' : pares})
+
+    def post_request_steps(self, request):
+        """Steps posting a ProtxRequest, returning the reply's fields."""
+        response = yield Post(request.url, request.body)
+        self.log_extra('Process: url=%s\nPacket=%s\nResult=%s', request.url, request.packet, response.body)
+        raise Return(parse_response(response.body))
         
     def capture_payment(self, testing=False, purchase=None, amount=NOTSET):
         """Execute the post to protx VSP DIRECT"""
-        if not purchase:
-            purchase = self.purchase
+        return self.run_steps(self.capture_payment_steps(testing=testing, purchase=purchase, amount=amount))
+
+    def capture_payment_steps(self, testing=False, purchase=None, amount=NOTSET):
+        """Steps for capture_payment, see bursar.gateway.steps."""
+        assert(purchase)
 
         if purchase.remaining == Decimal('0.00'):
             self.log_extra('%s is paid in full, no capture attempted.', purchase)
             self.record_payment(purchase=purchase)
-            return ProcessorResult(self.key, True, _("No charge needed, paid in full."))
+            raise Return(ProcessorResult(self.key, True, _("No charge needed, paid in full.")))
 
         self.log_extra('Capturing payment for %s', purchase)
 
         if amount == NOTSET:
             amount = purchase.remaining
 
-        self.prepare_post(purchase, amount)
+        with purchase.processing():
+            request = self.prepare_post(purchase, amount)
         
-        if self.valid:
-            if self.settings['SKIP_POST']:
-                self.log.info("TESTING MODE - Skipping post to server.  Would have posted %s?%s", self.url, self.postString)
-                payment = self.record_payment(purchase=purchase, amount=amount, 
-                    transaction_id="TESTING", reason_code='0')
+        if request is None:
+            raise Return(ProcessorResult(self.key, False, _('Error processing payment.')))
 
-                return ProcessorResult(self.key, True, _('TESTING MODE'), payment=payment)
-                
-            else:
-                self.log_extra("About to post to server: %s?%s", self.url, self.postString)
-                conn = urllib2.Request(self.url, data=self.postString)
-                try:
-                    f = urllib2.urlopen(conn)
-                    result = f.read()
-                    self.log_extra('Process: url=%s\nPacket=%s\nResult=%s', self.url, self.packet, result)
-
-                except urllib2.URLError, ue:
-                    self.log.error("error opening %s\n%s", self.url, ue)
-                    return ProcessorResult(self.key, False, 'ERROR: Could not talk to Protx gateway')
-
-                try:
-                    self.response = dict([row.split('=', 1) for row in result.splitlines()])
-                    status = self.response['Status']
-                    success = (status == 'OK')
-                    detail = self.response['StatusDetail']
-                
-                    payment = None
-                    transaction_id = ""
-                    if success:
-                        vpstxid = self.response.get('VPSTxID', '')
-                        txauthno = self.response.get('TxAuthNo', '')
-                        transaction_id="%s,%s" % (vpstxid, txauthno)
-                        self.log.info('Success on purchase #%i, recording payment', self.purchase.id)
-                        payment = self.record_payment(purchase=purchase, amount=amount, 
-                            transaction_id=transaction_id, reason_code=status)
-                        
-                    else:
-                        payment = self.record_failure(purchase=purchase, amount=amount, 
-                            transaction_id=transaction_id, reason_code=status, 
-                            details=detail)
-
-                    return ProcessorResult(self.key, success, detail, payment=payment)
-
-                except Exception, e:
-                    self.log.info('Error submitting payment: %s', e)
-                    payment = self.record_failure(purchase=purchase, amount=amount, 
-                        transaction_id="", reason_code="error", 
-                        details='Invalid response from bursar gateway')
-                    
-                    return ProcessorResult(self.key, False, _('Invalid response from bursar gateway'))
+        if self.settings['SKIP_POST']:
+            self.log.info("TESTING MODE - Skipping post to server.  Would have posted %s?%s", request.url, request.body)
+            payment = self.record_payment(purchase=purchase, amount=amount, 
+                transaction_id="TESTING", reason_code='0')
+
+            raise Return(ProcessorResult(self.key, True, _('TESTING MODE'), payment=payment))
+
+        self.log_extra("About to post to server: %s?%s", request.url, request.body)
+        try:
+            reply = yield self.post_request_steps(request)
+        except TransportError, te:
+            self.log.error("error opening %s\n%s", request.url, te)
+            raise Return(ProcessorResult(self.key, False, 'ERROR: Could not talk to Protx gateway'))
+        except ValueError, e:
+            self.log.info('Error submitting payment: %s', e)
+            payment = self.record_failure(purchase=purchase, amount=amount, 
+                transaction_id="", reason_code="error", 
+                details='Invalid response from bursar gateway')
+            raise Return(ProcessorResult(self.key, False, _('Invalid response from bursar gateway')))
+
+        try:
+            status = reply['Status']
+            success = (status == 'OK')
+            detail = reply['StatusDetail']
+        except KeyError, e:
+            self.log.info('Error submitting payment: %s missing from the reply', e)
+            payment = self.record_failure(purchase=purchase, amount=amount, 
+                transaction_id="", reason_code="error", 
+                details='Invalid response from bursar gateway')
+            raise Return(ProcessorResult(self.key, False, _('Invalid response from bursar gateway')))
+
+        payment = None
+        transaction_id = ""
+        if success:
+            vpstxid = reply.get('VPSTxId', '')
+            txauthno = reply.get('TxAuthNo', '')
+            transaction_id="%s,%s" % (vpstxid, txauthno)
+            self.log.info('Success on purchase #%i, recording payment', purchase.id)
+            payment = self.record_payment(purchase=purchase, amount=amount, 
+                transaction_id=transaction_id, reason_code=status)
+            
         else:
-            return ProcessorResult(self.key, False, _('Error processing payment.'))
+            payment = self.record_failure(purchase=purchase, amount=amount, 
+                transaction_id=transaction_id, reason_code=status, 
+                details=detail)
+
+        raise Return(ProcessorResult(self.key, success, detail, payment=payment, response=reply))
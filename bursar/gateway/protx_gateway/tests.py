@@ -1,9 +1,12 @@
 # -*- coding: UTF-8 -*-
 """Bursar Authorizenet Gateway Tests."""
+from __future__ import with_statement
 from bursar.gateway.protx_gateway import processor
 from bursar.errors import GatewayError
-from bursar.models import Authorization, Payment
-from bursar.tests import make_test_purchase
+from bursar.models import Authorization, Payment, Purchase
+from bursar.numbers import trunc_decimal
+from bursar.gateway.simulator.server import SimulatorServer
+from bursar.tests import make_test_purchase, GatewayServer, QueryCounter, run_within_budget
 from bursar.bursar_settings import get_bursar_setting
 from decimal import Decimal
 from django.conf import settings
@@ -12,12 +15,20 @@ from django.core import urlresolvers
 from django.core.urlresolvers import reverse as url
 from django.test import TestCase
 from django.test.client import Client
+import cgi
+import threading
 
 SKIP_TESTS = False
 NEED_SETTINGS = """Tests for protx_gateway module require a
 PROTX_TEST section in settings.BURSAR_SETTINGS.  At a 
 minimum, you must specify the VENDOR."""
 
+# the most SQL queries each operation may run
+QUERY_BUDGETS = {
+    'capture_payment' : 2,
+    'record_payment' : 2,
+}
+
 class TestGateway(TestCase):
     def setUp(self):
         global SKIP_TESTS
@@ -115,3 +126,100 @@ class TestGateway(TestCase):
         pend2 = self.gateway.create_pending_payment(purchase=purchase, amount=purchase.total)
     
         self.assertEqual(purchase.paymentspending.count(), 1)
+
+class TestRequestQueries(TestCase):
+    """Building a request must not touch the database once the purchase is loaded."""
+    def setUp(self):
+        self.gateway = processor.PaymentProcessor(settings={'VENDOR' : 'test'})
+        self.default_payment = {
+            'card_holder' : 'Cave Man',
+            'ccv' : '144',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def test_prepare_post(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        purchase = Purchase.objects.for_processing(purchase.pk)
+        with QueryCounter() as counter:
+            request = self.gateway.prepare_post(purchase, Decimal('20.00'))
+        self.assertEqual(counter.count, 0, counter.queries)
+        self.assertEqual(request.packet['CardNumber'], '4111111111111111')
+        self.assertEqual(request.get('Amount'), Decimal('20.00'))
+        self.assertEqual(request.url, self.gateway.connection)
+        self.assertRaises(AttributeError, setattr, request, 'url', 'http://example.com/')
+
+class TestQueryBudgets(TestCase):
+    """Each operation against the gateway simulator, within its query budget."""
+    def setUp(self):
+        self.server = SimulatorServer()
+        self.gateway = processor.PaymentProcessor(dict(self.server.gateway_settings('protx'), VENDOR='test'))
+        self.default_payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def purchase(self):
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=self.default_payment)
+        return Purchase.objects.for_processing(purchase.pk)
+
+    def test_query_budgets(self):
+        result = run_within_budget(self, QUERY_BUDGETS, self.gateway.capture_payment, purchase=self.purchase())
+        self.assert_(result.success, result.message)
+        self.assertEqual(result.stats.http_posts, 1)
+        self.assertEqual([child.operation for child in result.stats.children], ['record_payment'])
+
+class TestConcurrency(TestCase):
+    """One processor taking payments in many threads at once."""
+    def setUp(self):
+        def reply(path, body):
+            fields = dict(cgi.parse_qsl(body))
+            # echo what was sent, so a crossed packet shows in the reply
+            return '\r\n'.join(['Status=OK', 'StatusDetail=Approved',
+                'VPSTxId=%s' % fields['VendorTxCode'], 'TxAuthNo=%s' % fields['Amount'],
+                'CardHolder=%s' % fields['CardHolder']])
+        self.server = GatewayServer(reply=reply)
+        self.gateway = processor.PaymentProcessor(settings={'VENDOR' : 'test',
+            'TEST_CONNECTION' : self.server.url + '/vspdirect-register.vsp'})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_no_crossed_packets(self):
+        # loaded here, since the test database can't be used from other threads
+        purchases = []
+        for i in range(8):
+            payment = {'card_holder' : 'Holder %i' % i, 'ccv' : '144', 'card_number' : '4111111111111111',
+                'expire_month' : 12, 'expire_year' : 2012, 'card_type' : 'visa'}
+            purchase = make_test_purchase(sub_total=Decimal('%i.00' % (i + 10)), payment=payment)
+            purchases.append(Purchase.objects.for_processing(purchase.pk))
+
+        errors = []
+        def pay(purchase, amount):
+            try:
+                for attempt in range(20):
+                    request = self.gateway.prepare_post(purchase, amount)
+                    reply = self.gateway.run_steps(self.gateway.post_request_steps(request))
+                    expected = {'VPSTxId' : str(purchase.id), 'TxAuthNo' : str(trunc_decimal(amount, 2)),
+                        'CardHolder' : purchase.credit_card.card_holder}
+                    for name, value in expected.items():
+                        if reply[name] != value:
+                            errors.append((purchase.id, name, value, reply[name]))
+            except Exception, e:
+                errors.append((purchase.id, e))
+
+        threads = [threading.Thread(target=pay, args=(purchase, purchase.sub_total)) for purchase in purchases]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.server.posts), 160)
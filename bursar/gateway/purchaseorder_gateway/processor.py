@@ -21,8 +21,7 @@ class PaymentProcessor(BasePaymentProcessor):
         if amount == NOTSET:
             amount = purchase.total
 
-        payment = self.record_payment(purchase=purchase, amount=amount, 
-            transaction_id="PO", reason_code='0')
+        payment = self.record_payment(purchase=purchase, amount=amount, reason_code='0')
 
         return ProcessorResult(self.key, True, _('Success'), payment)
 
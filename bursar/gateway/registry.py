@@ -0,0 +1,121 @@
+"""
+Shared processor instances.
+
+Building a processor merges its defaults into the settings and checks the
+required ones, and some processors look for key files and libraries too.
+Rather than do that on every request, get_processor builds each processor
+once and hands out the same instance afterwards::
+
+    gateway = get_processor('paypal', 'PAYPAL_TEST')
+
+is the paypal PaymentProcessor for the PAYPAL_TEST entry of BURSAR_SETTINGS,
+the name defaulting to 'PAYPAL'.  Views which are given their settings by
+the urls pass them instead::
+
+    gateway = get_processor('paypal', settings=settings)
+
+A processor is built again when an entry of its settings is added, removed
+or replaced.  Processors which keep the details of the current payment on
+themselves, those with thread_safe False, are built once for each thread.
+
+check_processors builds every processor configured for the installed
+gateways, so that mistakes in the settings show up when a site starts, see
+the check_processors command.
+"""
+from bursar.bursar_settings import get_bursar_setting
+from bursar.errors import GatewayError
+from django.conf import settings as django_settings
+import logging
+import threading
+
+log = logging.getLogger('bursar.gateway.registry')
+
+_entries = {}
+_lock = threading.Lock()
+
+class RegistryEntry(object):
+    """A processor as built from one set of settings."""
+
+    def __init__(self, key, settings):
+        self.key = key
+        # a copy, so that changes to the caller's settings are noticed
+        self.settings = dict(settings)
+        self.processor = build_processor(key, self.settings)
+        if not self.processor.thread_safe:
+            self.local = threading.local()
+            self.local.processor = self.processor
+
+    def get_processor(self):
+        if self.processor.thread_safe:
+            return self.processor
+        processor = getattr(self.local, 'processor', None)
+        if processor is None:
+            # already checked when the first one was built
+            processor = self.local.processor = build_processor(self.key, self.settings)
+        return processor
+
+def build_processor(key, settings):
+    """A new PaymentProcessor from `bursar.gateway.<key>_gateway`."""
+    try:
+        module = __import__('bursar.gateway.%s_gateway.processor' % key, {}, {}, ['PaymentProcessor'])
+    except ImportError, e:
+        raise GatewayError('Cannot load the %s processor: %s' % (key, e))
+    return module.PaymentProcessor(settings)
+
+def clear():
+    """Forget every processor, so they are built again."""
+    _lock.acquire()
+    try:
+        _entries.clear()
+    finally:
+        _lock.release()
+
+def get_processor(key, name=None, settings=None):
+    """The shared processor for `key`, with the given settings or those of
+    the `name` entry of BURSAR_SETTINGS."""
+    if settings is None:
+        if name is None:
+            name = key.upper()
+        settings = get_bursar_setting(name, default_value=None)
+        if settings is None:
+            raise GatewayError('There is no %s entry in BURSAR_SETTINGS' % name)
+    lookup = (key, name)
+    entry = _entries.get(lookup, None)
+    if entry is None or entry.settings != settings:
+        _lock.acquire()
+        try:
+            # another thread may have built it while this one waited
+            entry = _entries.get(lookup, None)
+            if entry is None or entry.settings != settings:
+                if entry is not None:
+                    log.info('Settings for the %s processor changed, building it again', key)
+                entry = RegistryEntry(key, settings)
+                _entries[lookup] = entry
+        finally:
+            _lock.release()
+    return entry.get_processor()
+
+def installed_gateways():
+    """The keys of the gateways in INSTALLED_APPS, 'paypal' for bursar.gateway.paypal_gateway."""
+    keys = []
+    for app in django_settings.INSTALLED_APPS:
+        if app.startswith('bursar.gateway.') and app.endswith('_gateway'):
+            keys.append(app[len('bursar.gateway.'):-len('_gateway')])
+    return keys
+
+def check_processors(keys=None):
+    """Build the processor for each configured KEY and KEY_TEST entry of
+    BURSAR_SETTINGS, returning a list of (name, error) for those which fail."""
+    if keys is None:
+        keys = installed_gateways()
+    errors = []
+    for key in keys:
+        for name in (key.upper(), key.upper() + '_TEST'):
+            if get_bursar_setting(name, default_value=None) is None:
+                continue
+            try:
+                get_processor(key, name)
+            except GatewayError, e:
+                log.error('The %s processor cannot be built from %s: %s', key, name, e)
+                errors.append((name, e))
+    return errors
@@ -0,0 +1,164 @@
+"""
+Retries and circuit breakers for gateway requests.
+
+A circuit breaker watches the requests to one gateway.  After too many
+consecutive failures, or requests slower than a latency limit, it opens, and
+requests to that gateway fail at once with CircuitOpenError instead of
+tying up a worker until they time out.  After `reset_timeout` seconds one
+probe request is let through (half-open); if it succeeds the breaker closes
+again, otherwise it stays open for another `reset_timeout`.
+
+Only requests which can safely be repeated, such as voids and IPN
+verification, are retried, with jittered exponential backoff.
+
+Settings, in BURSAR_SETTINGS, overridable in each gateway's settings:
+
+    HTTP_RETRIES: extra attempts for idempotent requests, default 2
+    HTTP_RETRY_BACKOFF: seconds before the first retry, doubling each time, default 0.5
+    BREAKER_FAILURES: consecutive failures opening the breaker, default 5
+    BREAKER_SLOW_CALL: seconds after which a request counts as failed, 0 to disable
+    BREAKER_RESET: seconds the breaker stays open before a probe, default 30
+"""
+from bursar.errors import CircuitOpenError, TransportError
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('bursar.gateway.resilience')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class CircuitBreaker(object):
+    """Tracks the health of one gateway."""
+
+    def __init__(self, name, failure_threshold=5, slow_call=0, reset_timeout=30, clock=time.time):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<CircuitBreaker %s: %s>' % (self.name, self.state)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warn('Circuit breaker for %s is now %s', self.name, state)
+            self.state = state
+
+    def available(self):
+        """True if a request would be let through, without using up the half-open probe."""
+        self.lock.acquire()
+        try:
+            if self.state == OPEN:
+                return self.clock() - self.opened_at >= self.reset_timeout
+            if self.state == HALF_OPEN:
+                return not self.probing
+            return True
+        finally:
+            self.lock.release()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a request may go to the gateway now."""
+        self.lock.acquire()
+        try:
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError('%s is unavailable' % self.name)
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    raise CircuitOpenError('%s is unavailable' % self.name)
+                self.probing = True
+        finally:
+            self.lock.release()
+
+    def record(self, success, elapsed=0):
+        """Record the outcome of a request let through by before_call."""
+        if success and self.slow_call and elapsed > self.slow_call:
+            log.warn('%s took %.2f seconds to answer', self.name, elapsed)
+            success = False
+        self.lock.acquire()
+        try:
+            self.probing = False
+            if success:
+                self.failures = 0
+                self._set_state(CLOSED)
+            else:
+                self.failures += 1
+                if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    self.opened_at = self.clock()
+                    self._set_state(OPEN)
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.probing = False
+            self._set_state(CLOSED)
+        finally:
+            self.lock.release()
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name, **options):
+    """Return the shared breaker for a gateway, with its thresholds updated from `options`."""
+    breaker = _breakers.get(name, None)
+    if breaker is None:
+        _breakers_lock.acquire()
+        try:
+            breaker = _breakers.get(name, None)
+            if breaker is None:
+                breaker = CircuitBreaker(name, **options)
+                _breakers[name] = breaker
+        finally:
+            _breakers_lock.release()
+    else:
+        for key, value in options.items():
+            setattr(breaker, key, value)
+    return breaker
+
+def is_retryable(error):
+    """Connection failures, timeouts and server errors are worth another try."""
+    return not isinstance(error, CircuitOpenError) and (error.status is None or error.status >= 500)
+
+def call(breaker, func, retries=0, backoff=0.5, max_backoff=10, sleep=time.sleep):
+    """Call `func` through `breaker`, retrying up to `retries` times on retryable
+    TransportErrors, with full-jitter exponential backoff.  Any other exception
+    counts as a failure, and is raised at once."""
+    attempt = 0
+    while True:
+        breaker.before_call()
+        started = time.time()
+        returned = success = False
+        elapsed = 0
+        try:
+            try:
+                result = func()
+                returned = success = True
+                elapsed = time.time() - started
+            except TransportError, e:
+                # an error status means the gateway is up and answering
+                success = e.status is not None and e.status < 500
+                if attempt >= retries or not is_retryable(e):
+                    raise
+        finally:
+            # whatever happened, so a half-open breaker's probe is never left outstanding
+            breaker.record(success, elapsed)
+        if returned:
+            return result
+        delay = random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+        log.info('Retrying %s in %.2f seconds after: %s', breaker.name, delay, e)
+        attempt += 1
+        sleep(delay)
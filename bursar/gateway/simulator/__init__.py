@@ -0,0 +1,21 @@
+"""
+A local stand-in for the payment gateways, for load and latency testing.
+
+SimulatorServer answers the posts of the Authorize.net AIM and ARB,
+CyberSource, Prot/X VSP Direct and PayPal IPN processors, each at its own
+path, with replies in that gateway's protocol.  How it behaves is set by a
+Behaviour: how long each reply takes, how many posts fail with a server
+error, and which card numbers are declined::
+
+    from bursar.gateway.simulator.behaviour import Behaviour
+    from bursar.gateway.simulator.server import SimulatorServer
+
+    server = SimulatorServer(behaviour=Behaviour(latency='uniform:0.05,0.2', error_rate=0.01))
+    gateway_settings = dict(settings, **server.gateway_settings('authorizenet'))
+    ...
+    server.stop()
+
+gateway_settings gives the _TEST connection settings pointing a gateway at
+the server.  To run one on its own, for a load test or a development site,
+use the run_gateway_simulator command.
+"""
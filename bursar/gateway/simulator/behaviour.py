@@ -0,0 +1,65 @@
+"""How the gateway simulator answers: its latency, errors and declines."""
+import random
+
+# test card numbers the real gateways' sandboxes decline
+DECLINE_CARDS = (
+    '4222222222222',
+    '4000000000000002',
+)
+
+def parse_latency(spec):
+    """A function returning a delay in seconds, drawn from the distribution in `spec`.
+
+    - "0.1" or "fixed:0.1": always 0.1
+    - "uniform:0.05,0.2": between 0.05 and 0.2
+    - "normal:0.1,0.02": mean 0.1, standard deviation 0.02, never below 0
+    - "exponential:0.1": mean 0.1, with a long tail of slow replies
+    """
+    if not spec:
+        return lambda rng: 0
+    if ':' in spec:
+        kind, args = spec.split(':', 1)
+    else:
+        kind, args = 'fixed', spec
+    try:
+        args = [float(arg) for arg in args.split(',')]
+    except ValueError:
+        raise ValueError('Bad latency %r' % spec)
+    if kind == 'fixed' and len(args) == 1:
+        return lambda rng: args[0]
+    if kind == 'uniform' and len(args) == 2:
+        return lambda rng: rng.uniform(args[0], args[1])
+    if kind == 'normal' and len(args) == 2:
+        return lambda rng: max(0, rng.normalvariate(args[0], args[1]))
+    if kind == 'exponential' and len(args) == 1 and args[0] > 0:
+        return lambda rng: rng.expovariate(1 / args[0])
+    raise ValueError('Bad latency %r' % spec)
+
+class Behaviour(object):
+    """How the simulator answers each post.
+
+    - latency: a distribution for parse_latency, or a function of a Random
+    - error_rate: the fraction of posts answered with a 500 error
+    - decline_cards: card numbers whose payments are declined
+    - seed: for the Random deciding delays and errors, so runs can be repeated
+    """
+
+    def __init__(self, latency=None, error_rate=0, decline_cards=DECLINE_CARDS, seed=None):
+        if callable(latency):
+            self.latency = latency
+        else:
+            self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.decline_cards = set(decline_cards)
+        self.random = random.Random(seed)
+
+    def delay(self):
+        """Seconds to wait before answering."""
+        return self.latency(self.random)
+
+    def fails(self):
+        """True if this post should get a server error."""
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def declines(self, card_number):
+        return card_number in self.decline_cards
@@ -0,0 +1,225 @@
+"""
+Replies to each gateway's posts, in its protocol.
+
+Each function takes the body of a post, the simulator's Behaviour and a
+function giving the next transaction number, and returns the status,
+content type and body of the reply.
+"""
+from cStringIO import StringIO
+from xml.sax.saxutils import escape
+import cgi
+import xml.etree.cElementTree as cElementTree
+
+TEXT = 'text/plain'
+XML = 'text/xml; charset=utf-8'
+
+def _form(body):
+    return dict([(name, values[0]) for name, values in cgi.parse_qs(body, keep_blank_values=True).items()])
+
+def _tags(body):
+    """The text and attributes of each element in an XML post, by tag without its namespace."""
+    values = {}
+    for event, element in cElementTree.iterparse(StringIO(body)):
+        tag = element.tag
+        if tag[0] == '{':
+            tag = tag[tag.index('}') + 1:]
+        values.setdefault(tag, (element.text, dict(element.attrib)))
+    return values
+
+def _last_four(card_number):
+    return 'XXXX' + card_number[-4:]
+
+def _valid_card(card_number):
+    """True if `card_number` could be a card number, passing the Luhn check."""
+    if not card_number.isdigit() or not 13 <= len(card_number) <= 19:
+        return False
+    total = 0
+    for i, digit in enumerate(reversed(card_number)):
+        digit = int(digit)
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+# Authorize.net AIM
+
+AIM_APPROVED = ('1', '1', 'This transaction has been approved.')
+AIM_DECLINED = ('2', '2', 'This transaction has been declined.')
+AIM_BAD_LOGIN = ('3', '13', 'The merchant login ID or password is invalid or the account is inactive.')
+AIM_NO_TRANSACTION = ('3', '33', 'A valid referenced transaction ID is required.')
+AIM_BAD_CARD = ('3', '6', 'The credit card number is invalid.')
+
+def authorizenet_aim(body, behaviour, next_id):
+    fields = _form(body)
+    transaction_type = fields.get('x_type', 'AUTH_CAPTURE')
+    card_number = fields.get('x_card_num', '')
+    transaction_id = fields.get('x_trans_id', '')
+    auth_code = ''
+    if not fields.get('x_login') or not fields.get('x_tran_key'):
+        outcome = AIM_BAD_LOGIN
+    elif transaction_type in ('PRIOR_AUTH_CAPTURE', 'VOID'):
+        if transaction_id:
+            outcome = AIM_APPROVED
+        else:
+            outcome = AIM_NO_TRANSACTION
+    elif not _valid_card(card_number):
+        outcome = AIM_BAD_CARD
+    elif behaviour.declines(card_number):
+        outcome = AIM_DECLINED
+        transaction_id = str(next_id())
+    else:
+        outcome = AIM_APPROVED
+        transaction_id = str(next_id())
+        auth_code = 'SIM%03i' % (int(transaction_id) % 1000)
+
+    reply = [''] * 68
+    reply[0], reply[2], reply[3] = outcome
+    reply[1] = '1'
+    reply[4] = auth_code
+    reply[5] = outcome is AIM_APPROVED and 'Y' or 'P'
+    reply[6] = transaction_id or '0'
+    reply[7] = fields.get('x_invoice_num', '')
+    reply[8] = fields.get('x_description', '')
+    reply[9] = fields.get('x_amount', '')
+    reply[10] = fields.get('x_method', 'CC')
+    reply[11] = transaction_type.lower()
+    reply[13] = fields.get('x_first_name', '')
+    reply[14] = fields.get('x_last_name', '')
+    if fields.get('x_card_code'):
+        reply[38] = 'M'
+    if card_number:
+        reply[50] = _last_four(card_number)
+        reply[51] = 'Visa'
+
+    delimiter = fields.get('x_delim_char', ',')
+    encapsulator = fields.get('x_encap_char', '')
+    separator = encapsulator + delimiter + encapsulator
+    return 200, TEXT, encapsulator + separator.join(reply) + encapsulator
+
+# Authorize.net ARB
+
+ARB_RESPONSE = """<?xml version="1.0" encoding="utf-8"?>
+<%(root)s xmlns="AnetApi/xml/v1/schema/AnetApiSchema.xsd">%(ref)s<messages><resultCode>%(result)s</resultCode><message><code>%(code)s</code><text>%(text)s</text></message></messages>%(subscription)s</%(root)s>"""
+
+def authorizenet_arb(body, behaviour, next_id):
+    try:
+        tags = _tags(body)
+    except SyntaxError:
+        return 200, XML, ARB_RESPONSE % {'root' : 'ErrorResponse', 'ref' : '', 'result' : 'Error',
+            'code' : 'E00003', 'text' : 'The request could not be parsed.', 'subscription' : ''}
+    if 'ARBCreateSubscriptionRequest' in tags:
+        root = 'ARBCreateSubscriptionResponse'
+    elif 'ARBCancelSubscriptionRequest' in tags:
+        root = 'ARBCancelSubscriptionResponse'
+    else:
+        root = 'ErrorResponse'
+    values = {'root' : root, 'ref' : '', 'subscription' : '',
+        'result' : 'Ok', 'code' : 'I00001', 'text' : 'Successful.'}
+    ref = tags.get('refId', (None, {}))[0]
+    if ref:
+        values['ref'] = '<refId>%s</refId>' % escape(ref)
+    card_number = tags.get('cardNumber', ('', {}))[0] or ''
+    if not tags.get('name', (None, {}))[0] or not tags.get('transactionKey', (None, {}))[0]:
+        values.update(result='Error', code='E00007',
+            text='User authentication failed due to invalid authentication values.')
+    elif root == 'ErrorResponse':
+        values.update(result='Error', code='E00004', text='The method name is invalid.')
+    elif behaviour.declines(card_number):
+        values.update(result='Error', code='E00027', text='The transaction was unsuccessful.')
+    elif root == 'ARBCreateSubscriptionResponse':
+        values['subscription'] = '<subscriptionId>%i</subscriptionId>' % next_id()
+    return 200, XML, ARB_RESPONSE % values
+
+# CyberSource
+
+SOAP_REPLY = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Header></soap:Header><soap:Body><c:replyMessage xmlns:c="urn:schemas-cybersource-com:transaction-data-1.26">%s</c:replyMessage></soap:Body></soap:Envelope>"""
+
+SOAP_FAULT = """<?xml version="1.0" encoding="utf-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Header></soap:Header><soap:Body><soap:Fault xmlns:c="urn:schemas-cybersource-com:transaction-data-1.26"><faultcode>%s</faultcode><faultstring>%s</faultstring></soap:Fault></soap:Body></soap:Envelope>"""
+
+def _elements(fields):
+    return ''.join(['<c:%s>%s</c:%s>' % (name, escape(value), name) for name, value in fields])
+
+def cybersource(body, behaviour, next_id):
+    try:
+        tags = _tags(body)
+    except SyntaxError:
+        return 500, XML, SOAP_FAULT % ('soap:Client', 'Malformed request')
+    if not tags.get('Username', (None, {}))[0] or not tags.get('Password', (None, {}))[0]:
+        return 500, XML, SOAP_FAULT % ('wsse:FailedCheck', 'Security Data : UsernameToken authentication failed.')
+
+    def runs(service):
+        return tags.get(service, (None, {}))[1].get('run') == 'true'
+
+    amount = tags.get('grandTotalAmount', ('0.00', {}))[0]
+    card_number = tags.get('accountNumber', ('', {}))[0] or ''
+    if runs('ccAuthService') and behaviour.declines(card_number):
+        decision, reason_code = 'REJECT', '203'
+    elif (runs('ccCaptureService') or runs('ccAuthReversalService')) and not runs('ccAuthService') \
+            and not tags.get('authRequestID', (None, {}))[0]:
+        decision, reason_code = 'REJECT', '101'
+    else:
+        decision, reason_code = 'ACCEPT', '100'
+    request_id = '%022i' % next_id()
+
+    fields = [
+        ('merchantReferenceCode', tags.get('merchantReferenceCode', ('', {}))[0] or ''),
+        ('requestID', request_id),
+        ('decision', decision),
+        ('reasonCode', reason_code),
+    ]
+    reply = [_elements(fields)]
+    reply.append('<c:purchaseTotals>%s</c:purchaseTotals>' % _elements([
+        ('currency', tags.get('currency', ('USD', {}))[0])]))
+    if runs('ccAuthService'):
+        auth = [('reasonCode', reason_code), ('amount', amount)]
+        if decision == 'ACCEPT':
+            auth.extend([('authorizationCode', request_id[-6:]), ('avsCode', 'Y'), ('processorResponse', '00')])
+        reply.append('<c:ccAuthReply>%s</c:ccAuthReply>' % _elements(auth))
+    if runs('ccCaptureService') and decision == 'ACCEPT':
+        reply.append('<c:ccCaptureReply>%s</c:ccCaptureReply>' % _elements([('reasonCode', reason_code),
+            ('amount', amount), ('reconciliationID', request_id[-10:])]))
+    if runs('ccAuthReversalService') and decision == 'ACCEPT':
+        reply.append('<c:ccAuthReversalReply>%s</c:ccAuthReversalReply>' % _elements([('reasonCode', reason_code),
+            ('amount', amount)]))
+    return 200, XML, SOAP_REPLY % ''.join(reply)
+
+# Prot/X VSP Direct
+
+def _vsp_reply(fields):
+    return 200, TEXT, '\r\n'.join(['%s=%s' % field for field in [('VPSProtocol', '2.22')] + fields])
+
+def protx_register(body, behaviour, next_id):
+    fields = _form(body)
+    missing = [name for name in ('Vendor', 'VendorTxCode', 'Amount', 'CardNumber') if not fields.get(name)]
+    if missing:
+        return _vsp_reply([('Status', 'INVALID'), ('StatusDetail', 'The %s field is required.' % missing[0])])
+    transaction = next_id()
+    tx_id = '{SIM-%i}' % transaction
+    if behaviour.declines(fields['CardNumber']):
+        return _vsp_reply([('Status', 'NOTAUTHED'),
+            ('StatusDetail', 'The VSP was unable to authorise your payment.'),
+            ('VPSTxId', tx_id), ('SecurityKey', 'SIM%07i' % transaction)])
+    return _vsp_reply([('Status', 'OK'), ('StatusDetail', 'Successfully Authorised Transaction'),
+        ('VPSTxId', tx_id), ('SecurityKey', 'SIM%07i' % transaction), ('TxAuthNo', str(transaction)),
+        ('AVSCV2', 'ALL MATCH'), ('AddressResult', 'MATCHED'), ('PostCodeResult', 'MATCHED'),
+        ('CV2Result', 'MATCHED')])
+
+def protx_callback(body, behaviour, next_id):
+    fields = _form(body)
+    if not fields.get('MD') or not fields.get('PARes'):
+        return _vsp_reply([('Status', 'INVALID'), ('StatusDetail', 'The MD and PARes fields are required.')])
+    transaction = next_id()
+    return _vsp_reply([('Status', 'OK'), ('StatusDetail', 'Successfully Authorised Transaction'),
+        ('VPSTxId', '{SIM-%i}' % transaction),
+        ('TxAuthNo', str(transaction)), ('3DSecureStatus', 'OK')])
+
+# PayPal IPN postback
+
+def paypal_ipn(body, behaviour, next_id):
+    if body.startswith('cmd=_notify-validate&'):
+        return 200, TEXT, 'VERIFIED'
+    return 200, TEXT, 'INVALID'
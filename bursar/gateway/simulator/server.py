@@ -0,0 +1,117 @@
+"""The gateway simulator's HTTP server."""
+from bursar.gateway.simulator import protocols
+from bursar.gateway.simulator.behaviour import Behaviour
+import BaseHTTPServer
+import itertools
+import logging
+import SocketServer
+import threading
+import time
+
+log = logging.getLogger('bursar.gateway.simulator')
+
+# the protocol answered at each path
+PATHS = {
+    '/authorizenet/gateway/transact.dll' : protocols.authorizenet_aim,
+    '/authorizenet/xml/v1/request.api' : protocols.authorizenet_arb,
+    '/cybersource/commerce/1.x/transactionProcessor' : protocols.cybersource,
+    '/protx/vspgateway/service/vspdirect-register.vsp' : protocols.protx_register,
+    '/protx/vspgateway/service/direct3dcallback.vsp' : protocols.protx_callback,
+    '/paypal/cgi-bin/webscr' : protocols.paypal_ipn,
+}
+
+# the settings pointing each gateway's test mode at a path
+GATEWAY_SETTINGS = {
+    'authorizenet' : (
+        ('CONNECTION_TEST', '/authorizenet/gateway/transact.dll'),
+        ('ARB_CONNECTION_TEST', '/authorizenet/xml/v1/request.api'),
+    ),
+    'cybersource' : (
+        ('CONNECTION_TEST', '/cybersource/commerce/1.x/transactionProcessor'),
+    ),
+    'protx' : (
+        ('TEST_CONNECTION', '/protx/vspgateway/service/vspdirect-register.vsp'),
+        ('TEST_CALLBACK', '/protx/vspgateway/service/direct3dcallback.vsp'),
+    ),
+    'paypal' : (
+        ('POST_TEST_URL', '/paypal/cgi-bin/webscr'),
+    ),
+}
+
+class SimulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers a SimulatorServer's posts, over keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+    # send each reply in one write, rather than wait on a delayed ack between them
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        server = self.server
+        status, content_type, reply = server.answer(self.path, body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+class SimulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local server answering like the payment gateways, see bursar/gateway/simulator.
+
+    It serves in a background thread unless `background` is False, when
+    serve_forever should be called.  `counts` holds the posts answered at
+    each path."""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, behaviour=None, background=True):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), SimulatorHandler)
+        if behaviour is None:
+            behaviour = Behaviour()
+        self.behaviour = behaviour
+        self.url = 'http://%s:%i' % (host, self.server_address[1])
+        self.counts = {}
+        self.lock = threading.Lock()
+        # transaction ids, unique across runs as the gateways' are
+        self.ids = itertools.count(int(time.time() * 1000))
+        if background:
+            thread = threading.Thread(target=self.serve_forever, name='bursar-simulator')
+            thread.setDaemon(True)
+            thread.start()
+
+    def answer(self, path, body):
+        """The status, content type and body answering a post of `body` to `path`."""
+        self.lock.acquire()
+        try:
+            self.counts[path] = self.counts.get(path, 0) + 1
+            # the Behaviour's Random isn't safe to share between threads
+            delay = self.behaviour.delay()
+            fails = self.behaviour.fails()
+        finally:
+            self.lock.release()
+        if delay:
+            time.sleep(delay)
+        if fails:
+            return 500, protocols.TEXT, 'Simulated server error'
+        protocol = PATHS.get(path.split('?', 1)[0], None)
+        if protocol is None:
+            return 404, protocols.TEXT, 'No gateway is simulated at %s' % path
+        return protocol(body, self.behaviour, self.next_id)
+
+    def gateway_settings(self, key):
+        """Settings pointing the `key` gateway's test mode at this server."""
+        return dict([(name, self.url + path) for name, path in GATEWAY_SETTINGS[key]])
+
+    def next_id(self):
+        self.lock.acquire()
+        try:
+            return self.ids.next()
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
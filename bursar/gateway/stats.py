@@ -0,0 +1,161 @@
+"""
+What each processor operation cost.
+
+The public operations of every processor -- authorize_payment,
+capture_payment, capture_authorized_payment, release_authorized_payment,
+create_pending_payment and the record_* methods -- are measured.  The
+ProcessorResult an operation returns carries its OperationStats, and last()
+gives those of the last operation to finish in the thread::
+
+    result = gateway.capture_payment(purchase=purchase)
+    result.stats.queries, result.stats.db_time, result.stats.http_time, result.stats.wall_time
+
+An operation run inside another, such as record_payment inside
+capture_payment, is counted in the outer one too, and is listed in its
+`children`, so the stats show which part of an operation ran the queries.
+AsyncPaymentProcessor drives the processors' steps itself, so the
+operations it runs as steps have no stats, only the record_* operations
+inside them.
+
+Django only records SQL queries when settings.DEBUG is on, so without it
+`queries` and `db_time` are None.  The queries are those run on the
+connection while the operation ran, by any thread.  Gateway posts made on
+worker threads, as for a Parallel, are timed from when the operation hands
+them over until it has every answer.
+"""
+from bursar import metrics
+from django.conf import settings
+from django.db import connection
+import threading
+import time
+
+OPERATIONS = (
+    'authorize_payment',
+    'capture_payment',
+    'capture_authorized_payment',
+    'release_authorized_payment',
+    'create_pending_payment',
+    'record_authorization',
+    'record_failure',
+    'record_payment',
+    'record_release',
+)
+
+# the operations counted as attempts at a payment, see bursar.metrics
+ATTEMPTS = OPERATIONS[:4]
+
+_local = threading.local()
+
+class OperationStats(object):
+    """The SQL queries, database time, gateway time and wall time of one operation."""
+
+    def __init__(self, processor, operation):
+        self.processor = processor
+        self.operation = operation
+        self.queries = None
+        self.db_time = None
+        self.sql = []
+        self.http_posts = 0
+        self.http_time = 0.0
+        self.wall_time = 0.0
+        self.children = []
+        self._started = None
+        self._first_query = None
+
+    def __repr__(self):
+        return '<OperationStats %s.%s: %s>' % (self.processor, self.operation, self.summary())
+
+    def summary(self):
+        if self.queries is None:
+            queries = 'queries not recorded'
+        else:
+            queries = '%i queries in %.1fms' % (self.queries, self.db_time * 1000)
+        return '%s, %i posts in %.1fms, %.1fms in all' % (queries, self.http_posts,
+            self.http_time * 1000, self.wall_time * 1000)
+
+    def report(self, indent=0):
+        """The stats of this operation and those inside it, one to a line."""
+        lines = ['%s%s: %s' % ('  ' * indent, self.operation, self.summary())]
+        for child in self.children:
+            lines.append(child.report(indent + 1))
+        return '\n'.join(lines)
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+def operation_name(default=None):
+    """The name of the outermost operation running in this thread, or `default`."""
+    stack = _stack()
+    if stack:
+        return stack[0].operation
+    return default
+
+def last():
+    """The stats of the last operation to finish in this thread, outside any other, or None."""
+    return getattr(_local, 'last', None)
+
+def start(processor, operation):
+    """Start measuring an operation of the `processor` gateway, returning its OperationStats."""
+    stats = OperationStats(processor, operation)
+    stack = _stack()
+    if stack:
+        stack[-1].children.append(stats)
+    stack.append(stats)
+    if settings.DEBUG:
+        stats._first_query = len(connection.queries)
+    stats._started = time.time()
+    return stats
+
+def finish(stats):
+    """Stop measuring the operation, which must be the innermost one running."""
+    stats.wall_time = time.time() - stats._started
+    if stats._first_query is not None and settings.DEBUG:
+        queries = connection.queries[stats._first_query:]
+        stats.queries = len(queries)
+        stats.db_time = sum([float(query['time']) for query in queries])
+        stats.sql = [query['sql'] for query in queries]
+    stack = _stack()
+    assert stack and stack[-1] is stats, 'Operations must finish in the order they started'
+    stack.pop()
+    if not stack:
+        _local.last = stats
+
+def add_http(seconds, posts=1):
+    """Count gateway posts taking `seconds`, made for the operations running in this thread."""
+    for stats in _stack():
+        stats.http_posts += posts
+        stats.http_time += seconds
+
+def measured(operation, method):
+    """`method`, measured as `operation`, with its stats set on the ProcessorResult it returns."""
+    def measured_method(self, *args, **kwargs):
+        # an operation run inside another is part of its attempt
+        attempt = operation in ATTEMPTS and not _stack()
+        if attempt:
+            metrics.increment('attempts', self.key, operation)
+        stats = start(self.key, operation)
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            finish(stats)
+        if hasattr(result, 'stats'):
+            result.stats = stats
+            if attempt and result.success:
+                metrics.increment('successes', self.key, operation)
+        return result
+    measured_method.__name__ = method.__name__
+    measured_method.__doc__ = method.__doc__
+    return measured_method
+
+class MeasuredOperations(type):
+    """Metaclass measuring each processor class's own versions of the OPERATIONS."""
+
+    def __init__(cls, name, bases, attrs):
+        super(MeasuredOperations, cls).__init__(name, bases, attrs)
+        for operation in OPERATIONS:
+            method = attrs.get(operation, None)
+            if method is not None:
+                setattr(cls, operation, measured(operation, method))
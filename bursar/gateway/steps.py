@@ -0,0 +1,121 @@
+"""
+Gateway operations written as steps, so their network waits can be run
+elsewhere.
+
+A steps method is a generator.  It yields a `Post` whenever it needs to talk
+to the gateway and is resumed with the Response, or has the TransportError
+thrown into it.  It may yield another steps generator to run it and get its
+result, and finishes by raising `Return(result)`::
+
+    def capture_payment_steps(self, purchase=None, ...):
+        with purchase.processing():
+            data = self.get_charge_data(purchase)
+        try:
+            response = yield Post(data['connection'], data['postString'])
+        except TransportError, e:
+            raise Return(ProcessorResult(self.key, False, _('Could not talk to the gateway')))
+        results = yield self.record_response_steps(purchase, response)
+        raise Return(results)
+
+To make several posts at once, yield a `Parallel` of them.  The steps are
+resumed with a list holding the Response to each post, or the TransportError
+it raised, in the order of the posts.
+
+Everything between the yields, all of the database work, runs in the thread
+driving the steps.  `BasePaymentProcessor.run_steps` drives them in the
+calling thread, `AsyncPaymentProcessor` hands the posts to worker threads.
+"""
+from bursar.errors import TransportError
+import sys
+import types
+
+class Post(object):
+    """A request for the driver to post `data` to the gateway."""
+
+    def __init__(self, url, data, headers={}, idempotent=False):
+        self.url = url
+        self.data = data
+        self.headers = headers
+        self.idempotent = idempotent
+
+    def __repr__(self):
+        return '<Post %s>' % self.url
+
+class Parallel(object):
+    """A request for the driver to make several posts at once."""
+
+    def __init__(self, posts):
+        self.posts = list(posts)
+
+    def __repr__(self):
+        return '<Parallel %s>' % ', '.join([post.url for post in self.posts])
+
+class Return(Exception):
+    """Raised by a steps generator to finish with a result."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+class Steps(object):
+    """Runs a steps generator, and the generators it yields, up to each Post."""
+
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.done = False
+        self.value = None
+
+    def advance(self, value=None, error=None):
+        """Resume with the response to the last Post, or with the exc_info of its error.
+
+        Returns the next Post or Parallel, or None once finished, with the result in `value`.
+        Exceptions raised by the steps propagate."""
+        while self.stack:
+            coroutine = self.stack[-1]
+            try:
+                if error is not None:
+                    exc_info, error = error, None
+                    step = coroutine.throw(*exc_info)
+                else:
+                    step = coroutine.send(value)
+            except Return, r:
+                self.stack.pop()
+                value = r.value
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except:
+                self.stack.pop()
+                if not self.stack:
+                    raise
+                error = sys.exc_info()
+                continue
+
+            if isinstance(step, types.GeneratorType):
+                self.stack.append(step)
+                value = None
+            elif isinstance(step, (Post, Parallel)):
+                return step
+            else:
+                raise TypeError('Gateway steps can only yield a Post, a Parallel or other steps, not %r' % step)
+
+        self.done = True
+        self.value = value
+        return None
+
+def outcomes(futures, timeout=None):
+    """Wait for the futures of a Parallel's posts, returning the list to resume the steps with.
+
+    Errors other than TransportErrors are raised."""
+    results = []
+    for future in futures:
+        error = future.exception(timeout)
+        if error is None:
+            results.append(future.value)
+        elif issubclass(error[0], TransportError):
+            results.append(error[1])
+        else:
+            raise error[0], error[1], error[2]
+    return results
@@ -0,0 +1,230 @@
+"""
+Shared HTTP transport for posting to payment gateways.
+
+Connections are kept open per host and reused, so a transaction does not
+pay for a new TCP connection and TLS handshake every time.  Every request
+has a connect and a read timeout, and each host has a limited number of
+connections; when they are all in use, a request waits up to
+`block_timeout` seconds for one to be returned.
+
+Processors get a transport from `BasePaymentProcessor.transport`, which is
+configured by these bursar settings, overridable in each gateway's settings:
+
+    HTTP_CONNECT_TIMEOUT: seconds to wait for a connection, default 10
+    HTTP_READ_TIMEOUT: seconds to wait for a response, default 60
+    HTTP_POOL_SIZE: connections kept per gateway host, default 8
+"""
+from bursar.errors import TransportError
+import httplib
+import logging
+import select
+import socket
+import threading
+import urlparse
+
+log = logging.getLogger('bursar.gateway.transport')
+
+class Response(object):
+    """A fully read HTTP response."""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def code(self):
+        return self.status
+
+    def read(self):
+        return self.body
+
+    def __repr__(self):
+        return '<Response %s %s>' % (self.status, self.reason)
+
+class ConnectionPool(object):
+    """Persistent connections to one host."""
+
+    def __init__(self, scheme, host, port, maxsize=8, connect_timeout=10, read_timeout=60, block_timeout=None):
+        if scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        else:
+            self.connection_class = httplib.HTTPConnection
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if block_timeout is None:
+            block_timeout = connect_timeout
+        self.block_timeout = block_timeout
+        self.idle = []
+        self.in_use = 0
+        self.created = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return '<ConnectionPool %s://%s:%s>' % (self.scheme, self.host, self.port)
+
+    def _get(self):
+        self.condition.acquire()
+        try:
+            if not self.idle and self.in_use >= self.maxsize:
+                self.condition.wait(self.block_timeout)
+                if not self.idle and self.in_use >= self.maxsize:
+                    raise TransportError('All %i connections to %s are in use' % (self.maxsize, self.host))
+            self.in_use += 1
+            if self.idle:
+                return self.idle.pop()
+        finally:
+            self.condition.release()
+        return None
+
+    def _put(self, conn):
+        self.condition.acquire()
+        try:
+            self.in_use -= 1
+            if conn is not None:
+                self.idle.append(conn)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def _connect(self):
+        conn = self.connection_class(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        self.created += 1
+        log.debug('Opened connection #%i to %s', self.created, self.host)
+        return conn
+
+    def close(self):
+        self.condition.acquire()
+        try:
+            while self.idle:
+                self.idle.pop().close()
+        finally:
+            self.condition.release()
+
+    def request(self, method, path, body=None, headers={}):
+        conn = self._get()
+        keep = None
+        try:
+            if conn is not None and _is_dropped(conn):
+                conn.close()
+                conn = None
+            if conn is None:
+                conn = self._connect()
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            result = Response(response.status, response.reason, dict(response.getheaders()), response.read())
+            if response.will_close:
+                conn.close()
+            else:
+                keep = conn
+        except socket.timeout, e:
+            _close(conn)
+            raise TransportError('Timed out talking to %s: %s' % (self.host, e))
+        except (socket.error, httplib.HTTPException), e:
+            _close(conn)
+            raise TransportError('Error talking to %s: %s' % (self.host, e))
+        finally:
+            self._put(keep)
+        return result
+
+def _close(conn):
+    if conn is not None:
+        conn.close()
+
+def _is_dropped(conn):
+    """True if the server has closed an idle connection.  Checked before
+    sending, since a payment post can not safely be retried."""
+    if conn.sock is None:
+        return True
+    try:
+        readable, writable, errors = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error):
+        return True
+    return bool(readable)
+
+class Transport(object):
+    """Connection pools for any number of hosts, all with the same limits."""
+
+    def __init__(self, maxsize=8, connect_timeout=10, read_timeout=60, block_timeout=None):
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.block_timeout = block_timeout
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+    def get_pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self.pools.get(key, None)
+        if pool is None:
+            self.lock.acquire()
+            try:
+                pool = self.pools.get(key, None)
+                if pool is None:
+                    pool = ConnectionPool(scheme, host, port, maxsize=self.maxsize,
+                        connect_timeout=self.connect_timeout, read_timeout=self.read_timeout,
+                        block_timeout=self.block_timeout)
+                    self.pools[key] = pool
+            finally:
+                self.lock.release()
+        return pool
+
+    def post(self, url, data, headers={}):
+        """Post `data` to `url`, returning a Response.
+
+        Raises TransportError if the host can't be reached, or answers with
+        an error status."""
+        if 'Content-type' not in headers:
+            headers = dict(headers)
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        return self.request('POST', url, data, headers)
+
+    def request(self, method, url, body=None, headers={}):
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        if scheme not in ('http', 'https'):
+            raise TransportError('Unsupported url: %s' % url)
+        port = parts.port
+        if port is None:
+            if scheme == 'https':
+                port = httplib.HTTPS_PORT
+            else:
+                port = httplib.HTTP_PORT
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+
+        response = self.get_pool(scheme, parts.hostname, port).request(method, path, body, headers)
+        if response.status >= 400:
+            raise TransportError('HTTP Error %s: %s from %s' % (response.status, response.reason, url),
+                status=response.status, response=response)
+        return response
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+def get_transport(maxsize=8, connect_timeout=10, read_timeout=60):
+    """Return the shared transport with these limits."""
+    key = (maxsize, connect_timeout, read_timeout)
+    transport = _transports.get(key, None)
+    if transport is None:
+        _transports_lock.acquire()
+        try:
+            transport = _transports.get(key, None)
+            if transport is None:
+                transport = Transport(maxsize=maxsize, connect_timeout=connect_timeout, read_timeout=read_timeout)
+                _transports[key] = transport
+        finally:
+            _transports_lock.release()
+    return transport
@@ -15,6 +15,9 @@ class PaymentProcessor(BasePaymentProcessor):
     # the tclink method shown here is extremely simple, and more secure, and uses
     # backp servers guaranteeing uptime versus the singe-server https method -  
     # see TC for details.
+
+    # prepare_post keeps the payment's details on the processor
+    thread_safe = False
     
     def __init__(self, settings):
         super(PaymentProcessor, self).__init__('trustcommerce', settings)
@@ -0,0 +1,156 @@
+"""
+A small thread pool for running gateway posts in the background.
+
+Django keeps one database connection per thread, so work handed to a
+WorkerPool must not touch the database.
+"""
+import logging
+import sys
+import threading
+import time
+import Queue
+
+log = logging.getLogger('bursar.gateway.workers')
+
+class Future(object):
+    """The eventual result of a call handed to a WorkerPool."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def exception(self, timeout=None):
+        """Wait for the call, returning its exc_info if it raised, else None."""
+        self.wait(timeout)
+        return self.exc_info
+
+    def result(self, timeout=None):
+        """Wait for the call and return its result, or raise its exception."""
+        self.wait(timeout)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise WorkerTimeout('No result after %s seconds' % timeout)
+
+class WorkerTimeout(Exception):
+    pass
+
+class RateLimiter(object):
+    """Spaces calls at least 1/`rate` seconds apart, across all the threads using it."""
+
+    def __init__(self, rate, clock=time.time, sleep=time.sleep):
+        self.interval = 1.0 / rate
+        self.clock = clock
+        self.sleep = sleep
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until the next call may be made."""
+        self.lock.acquire()
+        try:
+            now = self.clock()
+            at = max(now, self.next_call)
+            self.next_call = at + self.interval
+        finally:
+            self.lock.release()
+        if at > now:
+            self.sleep(at - now)
+
+class WorkerPool(object):
+    """Runs calls on up to `size` daemon threads, started as they are needed.
+
+    With a `limiter`, each call waits on it before running."""
+
+    def __init__(self, size=10, name='bursar-worker', limiter=None):
+        self.size = size
+        self.name = name
+        self.limiter = limiter
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.unfinished = 0
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<WorkerPool %s: %i threads>' % (self.name, len(self.threads))
+
+    def shutdown(self):
+        """Stop the threads once the queued calls have run."""
+        self.lock.acquire()
+        try:
+            for thread in self.threads:
+                self.queue.put(None)
+            self.threads = []
+        finally:
+            self.lock.release()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue `func(*args, **kwargs)`, returning a Future for its result."""
+        future = Future()
+        self.lock.acquire()
+        try:
+            self.unfinished += 1
+            if self.unfinished > len(self.threads) and len(self.threads) < self.size:
+                thread = threading.Thread(target=self._work, name='%s-%i' % (self.name, len(self.threads) + 1))
+                thread.setDaemon(True)
+                self.threads.append(thread)
+                thread.start()
+        finally:
+            self.lock.release()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            work = self.queue.get()
+            if work is None:
+                return
+            future, func, args, kwargs = work
+            value = exc_info = None
+            try:
+                if self.limiter is not None:
+                    self.limiter.wait()
+                value = func(*args, **kwargs)
+            except:
+                exc_info = sys.exc_info()
+            # count the thread as free before anyone waiting on the future can submit more
+            self.lock.acquire()
+            self.unfinished -= 1
+            self.lock.release()
+            if exc_info is not None:
+                future.set_exception(exc_info)
+            else:
+                future.set_result(value)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(name, size=10):
+    """Return the shared pool with this name, creating it with `size` threads."""
+    pool = _pools.get(name, None)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(name, None)
+            if pool is None:
+                pool = WorkerPool(size=size, name=name)
+                _pools[name] = pool
+        finally:
+            _pools_lock.release()
+    return pool
@@ -0,0 +1,61 @@
+"""Time the gateway request builders against rendering their templates."""
+from bursar.gateway.builder import get_builder
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.template import Context, loader
+from optparse import make_option
+import timeit
+
+CONFIG = {'merchantID' : 'acme_store', 'password' : 'secret', 'transactionKey' : 'secret', 'shop_name' : 'Acme & Co'}
+
+REQUESTS = (
+    ('bursar/gateway/cybersource_gateway/request.xml', {
+        'config' : CONFIG,
+        'merchantReferenceCode' : '1042_1',
+        'billTo' : {'firstName' : 'Mister', 'lastName' : "O'Tester", 'street1' : '123 Test St.', 'city' : 'Testington',
+            'state' : 'TX', 'postalCode' : '55555', 'country' : 'US', 'email' : 'test@example.com'},
+        'purchaseTotals' : {'currency' : 'USD', 'grandTotalAmount' : Decimal('20.00')},
+        'card' : {'accountNumber' : '4111111111111111', 'expirationMonth' : '12', 'expirationYear' : '2012'},
+        'authorize' : True,
+        'capture' : True,
+    }),
+    ('bursar/gateway/authorizenet_gateway/arb_create_subscription.xml', {
+        'config' : CONFIG,
+        'purchase' : {'id' : 42, 'orderno' : 'A-1042', 'email' : 'test@example.com', 'phone' : '555-555-1234',
+            'first_name' : 'Mister', 'last_name' : "O'Tester"},
+        'card' : {'decryptedCC' : '4111111111111111'},
+        'card_expiration' : '2012-12',
+        'subscription' : {'pk' : 7, 'expire_length' : 1, 'expire_unit' : 'MONTH', 'trial' : True},
+        'product' : 'Gold Plan',
+        'occurrences' : 12,
+        'trial_occurrences' : 1,
+        'amount' : Decimal('9.99'),
+        'trial_amount' : Decimal('0.00'),
+    }),
+)
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--number', dest='number', type='int', default=2000,
+            help='Requests to build with each method'),
+    )
+    help = "Compare building gateway requests with the request builders and with Django templates."
+
+    def handle(self, *args, **options):
+        number = options['number']
+        verbosity = int(options.get('verbosity', 1))
+
+        for name, data in REQUESTS:
+            builder = get_builder(name)
+            template = loader.get_template(name)
+            timings = (
+                ('load and render template', lambda: loader.get_template(name).render(Context(data))),
+                ('render template', lambda: template.render(Context(data))),
+                ('request builder', lambda: builder.build(data)),
+            )
+            results = [(label, min(timeit.repeat(func, number=number, repeat=3)) / number) for label, func in timings]
+            if verbosity > 0:
+                print name
+                fastest = results[-1][1]
+                for label, seconds in results:
+                    print "  %-26s %8.1f usec  %5.1fx" % (label, seconds * 1000000, seconds / fastest)
@@ -0,0 +1,273 @@
+"""
+Time checkouts through each processor, end to end.
+
+Each operation runs one flow for a new purchase from make_test_purchase:
+capturing a payment, authorizing one, capturing or releasing an
+authorization, or accepting a queued PayPal IPN.  The gateways' posts are
+answered by a local SimulatorServer, see bursar/gateway/simulator, so the
+timings are of bursar's own work -- building requests, parsing replies and
+recording payments -- plus whatever --latency adds.
+
+For each processor and flow it reports operations a second, the 50th, 95th
+and 99th percentile times, the SQL queries run by each operation, and the
+objects each left allocated.  CPython 2 can't trace allocations, so that is
+the rise in the garbage collector's generation 0 count over the operation,
+with collection turned off: the container objects it created and didn't
+free.  --output saves the results as JSON, and --compare prints the change
+from an earlier run's.
+
+The purchases are made in a test database, created and destroyed around the
+run unless --no-test-db is given.
+"""
+from bursar.bursar_settings import get_bursar_setting, set_bursar_setting
+from bursar.gateway import registry
+from bursar.gateway.simulator.behaviour import Behaviour
+from bursar.gateway.simulator.server import GATEWAY_SETTINGS, SimulatorServer
+from bursar.models import Purchase
+from bursar.tests import make_test_purchase
+from datetime import datetime
+from decimal import Decimal
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.utils import simplejson
+from django.utils.http import urlencode
+from optparse import make_option
+import gc
+import math
+import sys
+import time
+
+PAYMENT = {
+    'card_holder' : 'Mister Tester',
+    'ccv' : '111',
+    'card_number' : '4111111111111111',
+    'expire_month' : 12,
+    'expire_year' : 2030,
+    'card_type' : 'visa',
+}
+
+# the processors timed, with the settings each needs beyond the simulator's
+PROCESSORS = (
+    ('dummy', {}),
+    ('cod', {}),
+    ('autosuccess', {}),
+    ('authorizenet', {'LOGIN' : 'bench', 'TRANKEY' : 'bench', 'STORE_NAME' : 'bench'}),
+    ('cybersource', {'MERCHANT_ID' : 'bench', 'TRANKEY' : 'bench'}),
+    ('protx', {'VENDOR' : 'bench'}),
+    ('paypal', {'BUSINESS' : 'shop@example.com', 'IPN_RETRY_DELAY' : 0}),
+)
+
+def _purchase(payment=True):
+    if payment:
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment=PAYMENT)
+    else:
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+    return Purchase.objects.for_processing(purchase.pk)
+
+def _authorized(gateway):
+    purchase = _purchase()
+    result = gateway.authorize_payment(purchase=purchase)
+    if not result.success:
+        raise CommandError('Could not authorize a payment with %s: %s' % (gateway.key, result.message))
+    return Purchase.objects.for_processing(purchase.pk), result.payment
+
+def _capture(gateway, purchase):
+    return gateway.capture_payment(purchase=purchase).success
+
+def _authorize(gateway, purchase):
+    return gateway.authorize_payment(purchase=purchase).success
+
+def _capture_authorized(gateway, (purchase, authorization)):
+    return gateway.capture_authorized_payment(authorization, purchase=purchase).success
+
+def _release(gateway, (purchase, authorization)):
+    return gateway.release_authorized_payment(purchase=purchase, auth=authorization).success
+
+def _queue_ipn(gateway):
+    from bursar.gateway.paypal_gateway.models import IpnMessage
+    purchase = _purchase(payment=False)
+    return IpnMessage.objects.create(raw=urlencode([('mc_gross', purchase.total), ('invoice', purchase.id),
+        ('payment_status', 'Completed'), ('txn_id', 'BENCH%i' % purchase.id), ('charset', 'utf-8')]))
+
+def _ipn(gateway, message):
+    from bursar.gateway.paypal_gateway.ipn import process_queue
+    from bursar.gateway.paypal_gateway.models import IPN_DONE
+    return process_queue(gateway, batch_size=1).counts[IPN_DONE] == 1
+
+def _authorizes(gateway):
+    return gateway.can_authorize()
+
+# name: (untimed setup, timed operation, whether a processor has the flow)
+FLOWS = (
+    ('capture', lambda gateway: _purchase(), _capture, lambda gateway: gateway.key != 'paypal'),
+    ('authorize', lambda gateway: _purchase(), _authorize, _authorizes),
+    ('capture authorized', _authorized, _capture_authorized, _authorizes),
+    ('release', _authorized, _release, _authorizes),
+    ('ipn', _queue_ipn, _ipn, lambda gateway: gateway.key == 'paypal'),
+)
+
+def percentile(timings, percent):
+    """The `percent` percentile of the sorted `timings`, by nearest rank."""
+    rank = int(math.ceil(percent / 100.0 * len(timings)))
+    return timings[max(rank, 1) - 1]
+
+def time_operation(operation, gateway, args):
+    """Run `operation`, returning whether it succeeded, its seconds, queries and objects left allocated."""
+    gc.collect()
+    gc.disable()
+    try:
+        reset_queries()
+        objects = gc.get_count()[0]
+        start = time.time()
+        success = operation(gateway, args)
+        seconds = time.time() - start
+        objects = gc.get_count()[0] - objects
+        queries = len(connection.queries)
+    finally:
+        gc.enable()
+    return success, seconds, queries, objects
+
+def run_flow(gateway, flow, number):
+    """Time `number` operations of `flow` with `gateway`, after one to warm up."""
+    name, setup, operation, applies = flow
+    operation(gateway, setup(gateway))
+    timings = []
+    queries = objects = failures = 0
+    for i in range(number):
+        args = setup(gateway)
+        success, seconds, op_queries, op_objects = time_operation(operation, gateway, args)
+        timings.append(seconds)
+        queries += op_queries
+        objects += op_objects
+        if not success:
+            failures += 1
+    timings.sort()
+    return {
+        'processor' : gateway.key,
+        'flow' : name,
+        'operations' : number,
+        'failures' : failures,
+        'ops_per_sec' : number / (sum(timings) or 1e-9),
+        'p50_ms' : percentile(timings, 50) * 1000,
+        'p95_ms' : percentile(timings, 95) * 1000,
+        'p99_ms' : percentile(timings, 99) * 1000,
+        'queries_per_op' : float(queries) / number,
+        'objects_per_op' : float(objects) / number,
+    }
+
+def run_benchmarks(server, processors, flows, number):
+    """The results of timing each of `flows` with each of `processors` which has it."""
+    results = []
+    for key, extra in processors:
+        if key == 'paypal' and key not in registry.installed_gateways():
+            # the IPN queue's table is only there when the app is installed
+            continue
+        gateway_settings = dict(extra)
+        if key in GATEWAY_SETTINGS:
+            gateway_settings.update(server.gateway_settings(key))
+        gateway = registry.build_processor(key, gateway_settings)
+        for flow in flows:
+            if flow[3](gateway):
+                results.append(run_flow(gateway, flow, number))
+        # hang up, so the simulator's threads aren't left waiting for another post
+        gateway.transport.get_pool('http', server.server_address[0], server.server_address[1]).close()
+    return results
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--number', dest='number', type='int', default=200,
+            help='Operations to time for each processor and flow'),
+        make_option('--processor', action='append', dest='processors', default=[],
+            help='Only time this processor, may be repeated'),
+        make_option('--flow', action='append', dest='flows', default=[],
+            help='Only time this flow, may be repeated: %s' % ', '.join([flow[0] for flow in FLOWS])),
+        make_option('--latency', dest='latency', default=None,
+            help='Simulated gateway delay, as for run_gateway_simulator'),
+        make_option('--output', dest='output', default=None,
+            help='Save the results as JSON to this file'),
+        make_option('--compare', dest='compare', default=None,
+            help='Show the change from the results saved in this file'),
+        make_option('--no-test-db', action='store_false', dest='test_db', default=True,
+            help='Make the purchases in the configured database rather than a test database'),
+    )
+    help = "Time authorizing, capturing and releasing payments and accepting IPNs through each processor."
+
+    def handle(self, *args, **options):
+        number = options['number']
+        verbosity = int(options.get('verbosity', 1))
+        if number < 1:
+            raise CommandError('--number must be at least 1')
+
+        processors = PROCESSORS
+        if options['processors']:
+            known = dict(PROCESSORS)
+            for key in options['processors']:
+                if key not in known:
+                    raise CommandError('Unknown processor %s' % key)
+            processors = [(key, known[key]) for key in options['processors']]
+        flows = FLOWS
+        if options['flows']:
+            known = dict([(flow[0], flow) for flow in FLOWS])
+            for name in options['flows']:
+                if name not in known:
+                    raise CommandError('Unknown flow %s' % name)
+            flows = [known[name] for name in options['flows']]
+        previous = {}
+        if options['compare']:
+            try:
+                saved = simplejson.load(open(options['compare']))
+            except (IOError, ValueError), e:
+                raise CommandError('Cannot read %s: %s' % (options['compare'], e))
+            for result in saved['results']:
+                previous[(result['processor'], result['flow'])] = result
+        try:
+            behaviour = Behaviour(latency=options['latency'], seed=0)
+        except ValueError, e:
+            raise CommandError(e)
+
+        debug = settings.DEBUG
+        store_numbers = get_bursar_setting('STORE_CREDIT_NUMBERS')
+        old_name = settings.DATABASE_NAME
+        if options['test_db']:
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        server = SimulatorServer(behaviour=behaviour)
+        # queries are only recorded when debugging
+        settings.DEBUG = True
+        # otherwise the numbers are only kept in the cache, which may drop them part way
+        set_bursar_setting('STORE_CREDIT_NUMBERS', True)
+        try:
+            results = run_benchmarks(server, processors, flows, number)
+        finally:
+            settings.DEBUG = debug
+            set_bursar_setting('STORE_CREDIT_NUMBERS', store_numbers)
+            server.stop()
+            if options['test_db']:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            report = {
+                'started' : datetime.now().isoformat(),
+                'python' : sys.version.split()[0],
+                'number' : number,
+                'latency' : options['latency'],
+                'results' : results,
+            }
+            out = open(options['output'], 'w')
+            try:
+                simplejson.dump(report, out, indent=2, sort_keys=True)
+            finally:
+                out.close()
+
+        if verbosity > 0:
+            print "%-12s %-18s %9s %8s %8s %8s %8s %8s %6s" % ('processor', 'flow', 'ops/sec',
+                'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'objects', 'failed')
+            for result in results:
+                line = "%(processor)-12s %(flow)-18s %(ops_per_sec)9.1f %(p50_ms)8.2f %(p95_ms)8.2f " \
+                    "%(p99_ms)8.2f %(queries_per_op)8.1f %(objects_per_op)8.1f %(failures)6i" % result
+                old = previous.get((result['processor'], result['flow']), None)
+                if old:
+                    line += "  %+6.1f%% ops/sec, %+6.1f%% p95" % (
+                        (result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100,
+                        (result['p95_ms'] / (old['p95_ms'] or 1e-9) - 1) * 100)
+                print line
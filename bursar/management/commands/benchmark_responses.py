@@ -0,0 +1,52 @@
+"""Time parsing Authorize.net AIM responses, see bursar/gateway/authorizenet_gateway/aim.py."""
+from bursar.gateway.authorizenet_gateway.aim import AimResponse
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import timeit
+
+# an approved AUTH_CAPTURE, as the gateway echoes it back with all 68 fields
+APPROVED = ['1', '1', '1', 'This transaction has been approved.', 'QWE123', 'Y', '2149186848', '1042_1', '',
+    '20.00', 'CC', 'auth_capture', '', 'Mister', "O'Tester", '', '123 Test St., Suite 4', 'Testington', 'TX',
+    '55555', 'US', '555-555-1234', '', 'test@example.com', '', '', '', '', '', '', '', '', '0.00', '0.00', '0.00',
+    'FALSE', '', '5F8C5A0A40D4A6F2D3B6E1C7E0A3B2C1', 'M', '2'] + [''] * 10 + ['XXXX1111', 'Visa'] + [''] * 16
+
+DECLINED = ['2', '1', '2', 'This transaction has been declined.', '', 'N', '2149186849'] + APPROVED[7:38] + ['N'] + APPROVED[39:]
+
+RESPONSES = (
+    ('approved', '|'.join(APPROVED), '|', ''),
+    ('declined', '|'.join(DECLINED), '|', ''),
+    ('encapsulated', '"%s"' % '","'.join(APPROVED), ',', '"'),
+    ('merchant fields', '|'.join(APPROVED + ['gift wrap', 'ref 99881']), '|', ''),
+)
+
+def _capture_fields(response):
+    return response.response_code, response.reason_code, response.reason_text, response.transaction_id
+
+def _split_capture_fields(body, delimiter, encapsulator):
+    # how send_post read responses before AimResponse, which can't cope with encapsulation
+    fields = body.split(encapsulator + delimiter + encapsulator)
+    return fields[0], fields[2], fields[3], fields[6]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--number', dest='number', type='int', default=20000,
+            help='Responses to parse with each method'),
+    )
+    help = "Compare parsing Authorize.net AIM responses with AimResponse and with a plain split."
+
+    def handle(self, *args, **options):
+        number = options['number']
+        verbosity = int(options.get('verbosity', 1))
+
+        for label, body, delimiter, encapsulator in RESPONSES:
+            timings = (
+                ('split, capture fields', lambda: _split_capture_fields(body, delimiter, encapsulator)),
+                ('AimResponse, every field', lambda: AimResponse(body, delimiter, encapsulator).as_dict()),
+                ('AimResponse, capture fields', lambda: _capture_fields(AimResponse(body, delimiter, encapsulator))),
+            )
+            results = [(name, min(timeit.repeat(func, number=number, repeat=3)) / number) for name, func in timings]
+            if verbosity > 0:
+                print label
+                fastest = min([seconds for name, seconds in results])
+                for name, seconds in results:
+                    print "  %-28s %8.2f usec  %5.1fx" % (name, seconds * 1000000, seconds / fastest)
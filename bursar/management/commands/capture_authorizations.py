@@ -0,0 +1,70 @@
+"""Capture the open authorizations of many purchases, see bursar/gateway/bulk.py."""
+from bursar.errors import GatewayError
+from bursar.gateway.bulk import capture_purchases
+from bursar.gateway.registry import get_processor
+from bursar.models import Authorization, Purchase
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging
+
+log = logging.getLogger('bursar.capture_authorizations')
+
+def load_processor(key, test_settings=False):
+    """The processor for a payment method from its BURSAR_SETTINGS entry,
+    "AUTHORIZENET" for "authorizenet", or else "AUTHORIZENET_TEST", or None
+    if it can't be loaded."""
+    name = key.upper()
+    if test_settings:
+        name += '_TEST'
+    try:
+        return get_processor(key, name)
+    except GatewayError, e:
+        log.warn('Skipping the %s authorizations: %s', key, e)
+        return None
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--method', action='append', dest='methods', default=[],
+            help='Only capture authorizations for this payment method, may be repeated'),
+        make_option('--workers', dest='workers', type='int', default=None,
+            help='Captures posted at once to each gateway, defaults to BULK_CAPTURE_WORKERS'),
+        make_option('--rate', dest='rate', type='float', default=None,
+            help='Most captures a second sent to each gateway, defaults to BULK_CAPTURE_RATE'),
+        make_option('--batch', dest='batch', type='int', default=None,
+            help='Purchases loaded at a time, defaults to BULK_CAPTURE_BATCH'),
+        make_option('--test-settings', action='store_true', dest='test_settings', default=False,
+            help='Use the gateways\' _TEST settings'),
+    )
+    help = "Capture the open authorizations of the given purchases, or of every purchase."
+    args = '[purchase_id ...]'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        auths = Authorization.objects.filter(complete=False)
+        if args:
+            auths = auths.filter(purchase__in=[int(arg) for arg in args])
+        methods = options['methods']
+        if not methods:
+            methods = sorted(set(auths.values_list('method', flat=True)))
+
+        # methods which can't be loaded are left out, so their authorizations are reported as skipped
+        processors = {}
+        for method in methods:
+            processor = load_processor(method, test_settings=options['test_settings'])
+            if processor is not None:
+                processors[method] = processor
+
+        if args:
+            purchases = [int(arg) for arg in args]
+        else:
+            purchases = Purchase.objects.filter(pk__in=auths.values('purchase')).order_by('pk')
+
+        report = capture_purchases(purchases, processors, workers=options['workers'],
+            rate=options['rate'], batch_size=options['batch'])
+
+        if verbosity > 0:
+            print report
+        if verbosity > 1:
+            for auth, outcome, message in report.failures:
+                print "Authorization #%i on purchase #%i %s: %s" % (auth.id, auth.purchase_id, outcome, message)
@@ -0,0 +1,18 @@
+"""Build the configured processors, see bursar/gateway/registry.py."""
+from bursar.gateway.registry import check_processors
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = "Check that the processors for the installed gateways, or the given ones, can be built from BURSAR_SETTINGS."
+    args = '[gateway ...]'
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        errors = check_processors(args or None)
+        for name, error in errors:
+            print "%s: %s" % (name, error)
+        if errors:
+            raise CommandError('%i processors could not be built' % len(errors))
+        if verbosity > 0:
+            print "The processors were built"
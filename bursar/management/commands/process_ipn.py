@@ -0,0 +1,40 @@
+"""Confirm and record the queued PayPal IPNs, see bursar/gateway/paypal_gateway/ipn.py."""
+from bursar.errors import GatewayError
+from bursar.gateway.paypal_gateway.ipn import process_queue, retry_failed
+from bursar.gateway.registry import get_processor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', dest='batch', type='int', default=None,
+            help='IPNs confirmed with PayPal together, defaults to the IPN_BATCH setting'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+            help='Queue the IPNs which have failed again first'),
+        make_option('--test-settings', action='store_true', dest='test_settings', default=False,
+            help='Use the PAYPAL_TEST settings, as the ipn view does with DEBUG on'),
+    )
+    help = "Confirm the queued PayPal IPNs with PayPal and record their payments."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        # the same settings as the ipn view in paypal_gateway/urls.py
+        if options['test_settings'] or settings.DEBUG:
+            key = 'PAYPAL_TEST'
+        else:
+            key = 'PAYPAL'
+        try:
+            gateway = get_processor('paypal', key)
+        except GatewayError, e:
+            raise CommandError(e)
+
+        if options['retry_failed']:
+            count = retry_failed()
+            if verbosity > 0:
+                print "Queued %i failed IPNs again" % count
+
+        report = process_queue(gateway, batch_size=options['batch'])
+        if verbosity > 0:
+            print report
@@ -0,0 +1,53 @@
+"""Rebuild the Purchase running balances from the payment tables."""
+from bursar.models import Purchase, _to_currency
+from django.core.management.base import BaseCommand
+from optparse import make_option
+import logging
+
+log = logging.getLogger('bursar.rebuild_purchase_balances')
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', dest='chunk', type='int', default=500,
+            help='Number of purchases to check per query'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Report purchases with wrong balances without fixing them'),
+    )
+    help = "Recompute Purchase.paid_total and Purchase.authorized_total from the payment tables."
+    args = '[purchase_id ...]'
+
+    def handle(self, *args, **options):
+        chunk = options['chunk']
+        dry_run = options['dry_run']
+        verbosity = int(options.get('verbosity', 1))
+
+        purchases = Purchase.objects.with_balances().order_by('pk')
+        if args:
+            purchases = purchases.filter(pk__in=[int(arg) for arg in args])
+
+        checked = fixed = 0
+        last_pk = 0
+        while True:
+            batch = list(purchases.filter(pk__gt=last_pk)[:chunk])
+            if not batch:
+                break
+            for purchase in batch:
+                checked += 1
+                paid = _to_currency(purchase.balance_paid)
+                authorized = _to_currency(purchase.balance_authorized)
+                if paid != _to_currency(purchase.paid_total) or authorized != _to_currency(purchase.authorized_total):
+                    fixed += 1
+                    if verbosity > 1:
+                        print "%s: paid %s -> %s, authorized %s -> %s" % (purchase,
+                            purchase.paid_total, paid, purchase.authorized_total, authorized)
+                    if not dry_run:
+                        Purchase.objects.filter(pk=purchase.pk).update(paid_total=paid, authorized_total=authorized)
+            last_pk = batch[-1].pk
+
+        if dry_run:
+            action = 'need fixing'
+        else:
+            action = 'fixed'
+        log.info('Checked %i purchases, %i %s', checked, fixed, action)
+        if verbosity > 0:
+            print "Checked %i purchases, %i %s" % (checked, fixed, action)
@@ -0,0 +1,178 @@
+"""
+Re-encrypt stored card numbers under a new cipher key version.
+
+Add the new key to CIPHER_KEYS and make it the CIPHER_KEY_VERSION, so new
+cards are written with it, then run this command.  The old key must stay in
+CIPHER_KEYS until the command has finished.
+"""
+from bursar import cipher
+from bursar.bursar_settings import get_bursar_setting
+from bursar.errors import CipherError
+from bursar.models import CreditCardDetail
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from optparse import make_option
+import keyedcache
+import logging
+import multiprocessing
+import os
+import time
+
+log = logging.getLogger('bursar.rotate_cipher_keys')
+
+def rotate_rows(args):
+    """Re-encrypt a chunk of (pk, encrypted_cc) rows, run in the worker processes.
+
+    Returns (pk, old value, new value, old card cache key, new card cache key)
+    for each row, the cache keys are None when card numbers are stored.
+    """
+    name, version, rows = args
+    engine = cipher.get_engine(name, version)
+    store = get_bursar_setting('STORE_CREDIT_NUMBERS')
+    plain = cipher.decrypt_many([row[1] for row in rows])
+    rotated = engine.encrypt_many(plain)
+    results = []
+    for (pk, old), value, new in zip(rows, plain, rotated):
+        if store:
+            results.append((pk, old, new, None, None))
+        else:
+            results.append((pk, old, new, cipher.digest(value + '-card', old), cipher.digest(value + '-card', new)))
+    return results
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk', dest='chunk', type='int', default=1000,
+            help='Number of cards to read, re-encrypt and write per batch'),
+        make_option('--processes', dest='processes', type='int', default=0,
+            help='Number of worker processes, defaults to the number of CPUs.  Use 1 to run in this process'),
+        make_option('--checkpoint', dest='checkpoint', default='',
+            help='File recording the last rotated card, an interrupted run resumes from it'),
+        make_option('--key-version', dest='key_version', type='int', default=None,
+            help='Key version to rotate to, defaults to CIPHER_KEY_VERSION'),
+    )
+    help = "Re-encrypt every stored card number with the current cipher and key version."
+
+    def handle(self, *args, **options):
+        chunk = options['chunk']
+        processes = options['processes'] or multiprocessing.cpu_count()
+        checkpoint = options['checkpoint']
+        verbosity = int(options.get('verbosity', 1))
+
+        name = get_bursar_setting('CIPHER')
+        version = options['key_version']
+        if version is None:
+            version = cipher.current_version()
+        try:
+            engine = cipher.get_engine(name, version)
+        except CipherError, e:
+            raise CommandError(e)
+
+        last_pk = 0
+        if checkpoint and os.path.exists(checkpoint):
+            last_pk = self.read_checkpoint(checkpoint, name, version)
+            if verbosity > 0:
+                print "Resuming after card #%i" % last_pk
+
+        cards = CreditCardDetail.objects.exclude(encrypted_cc=None).exclude(encrypted_cc='').order_by('pk')
+        if engine.prefix:
+            # values already under the target key are skipped by the database
+            cards = cards.exclude(encrypted_cc__startswith=engine.prefix)
+        total = cards.filter(pk__gt=last_pk).count()
+        if verbosity > 0:
+            print "Rotating %i cards to %s key version %i" % (total, name, version)
+
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            run = lambda job: pool.apply_async(rotate_rows, (job,))
+        else:
+            pool = None
+            run = lambda job: _Done(rotate_rows(job))
+
+        # keep a few chunks in flight, finished in the order they were read
+        # so that the checkpoint only moves past fully written rows
+        pending = []
+        done = 0
+        started = time.time()
+        try:
+            while True:
+                rows = list(cards.filter(pk__gt=last_pk).values_list('pk', 'encrypted_cc')[:chunk])
+                if rows:
+                    last_pk = rows[-1][0]
+                    pending.append((last_pk, run((name, version, rows))))
+                if pending and (not rows or len(pending) > processes):
+                    chunk_pk, result = pending.pop(0)
+                    done += self.write_chunk(result.get(), engine)
+                    if checkpoint:
+                        self.write_checkpoint(checkpoint, name, version, chunk_pk)
+                    if verbosity > 0:
+                        elapsed = time.time() - started
+                        print "%i/%i cards rotated (%i/s)" % (done, total, done / max(elapsed, 0.001))
+                if not rows and not pending:
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        log.info('Rotated %i cards to %s key version %i', done, name, version)
+
+    def read_checkpoint(self, path, name, version):
+        try:
+            saved_name, saved_version, last_pk = open(path).read().split()
+            saved_version, last_pk = int(saved_version), int(last_pk)
+        except ValueError:
+            raise CommandError('Cannot read checkpoint file %s' % path)
+        if (saved_name, saved_version) != (name, version):
+            raise CommandError('Checkpoint %s is for %s key version %i, remove it to start over' % (
+                path, saved_name, saved_version))
+        return last_pk
+
+    def write_checkpoint(self, path, name, version, last_pk):
+        tmp = path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write('%s %i %i\n' % (name, version, last_pk))
+        finally:
+            f.close()
+        os.rename(tmp, path)
+
+    def write_chunk(self, results, engine):
+        """Write a re-encrypted chunk back in one statement batch, and move its cache entries."""
+        table = connection.ops.quote_name(CreditCardDetail._meta.db_table)
+        column = connection.ops.quote_name('encrypted_cc')
+        pk = connection.ops.quote_name(CreditCardDetail._meta.pk.column)
+        # rows changed since they were read keep their new value
+        sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s' % (table, column, pk, column)
+        cursor = connection.cursor()
+        cursor.executemany(sql, [(new, row_pk, old) for row_pk, old, new, oldkey, newkey in results])
+        transaction.commit_unless_managed()
+
+        if keyedcache.cache_enabled():
+            moves = []
+            for row_pk, old, new, oldkey, newkey in results:
+                moves.append((old, new, False))
+                if oldkey:
+                    moves.append((oldkey, newkey, True))
+            self.move_cached(moves, engine)
+        return len(results)
+
+    def move_cached(self, moves, engine):
+        """Copy cached CCVs and card numbers to their new keys, with one read for the chunk."""
+        keys = dict((keyedcache.cache_key(old), (old, new, reencrypt)) for old, new, reencrypt in moves)
+        for key, wrapper in cache.get_many(keys.keys()).items():
+            old, new, reencrypt = keys[key]
+            value = getattr(wrapper, 'val', wrapper)
+            if reencrypt:
+                value = engine.encrypt(cipher.decrypt(value))
+            keyedcache.cache_set(new, skiplog=True, length=60*60, value=value)
+
+class _Done(object):
+    """An already computed result, standing in for an AsyncResult."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
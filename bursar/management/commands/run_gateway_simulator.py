@@ -0,0 +1,47 @@
+"""Run the gateway simulator, see bursar/gateway/simulator."""
+from bursar.gateway.simulator.behaviour import Behaviour, DECLINE_CARDS
+from bursar.gateway.simulator.server import GATEWAY_SETTINGS, SimulatorServer
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--host', dest='host', default='127.0.0.1',
+            help='Address to listen on'),
+        make_option('--port', dest='port', type='int', default=8090,
+            help='Port to listen on'),
+        make_option('--latency', dest='latency', default=None,
+            help='Delay before each reply, such as 0.1, uniform:0.05,0.2, normal:0.1,0.02 or exponential:0.1'),
+        make_option('--error-rate', dest='error_rate', type='float', default=0,
+            help='Fraction of posts answered with a server error'),
+        make_option('--decline-card', action='append', dest='decline_cards', default=[],
+            help='Card number to decline, may be repeated, defaults to %s' % ', '.join(DECLINE_CARDS)),
+        make_option('--seed', dest='seed', type='int', default=None,
+            help='Seed for the delays and errors, to repeat a run'),
+    )
+    help = "Answer posts like Authorize.net, CyberSource, Prot/X and PayPal, for load and latency testing."
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        try:
+            behaviour = Behaviour(latency=options['latency'], error_rate=options['error_rate'],
+                decline_cards=options['decline_cards'] or DECLINE_CARDS, seed=options['seed'])
+        except ValueError, e:
+            raise CommandError(e)
+        server = SimulatorServer(options['host'], options['port'], behaviour=behaviour, background=False)
+
+        if verbosity > 0:
+            print "Simulating the gateways at %s, add these to their BURSAR_SETTINGS:" % server.url
+            for key in sorted(GATEWAY_SETTINGS):
+                print "  %s:" % key
+                for name, url in sorted(server.gateway_settings(key).items()):
+                    print "    '%s' : '%s'," % (name, url)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        if verbosity > 0:
+            for path, count in sorted(server.counts.items()):
+                print "%8i %s" % (count, path)
@@ -0,0 +1,276 @@
+"""
+Metrics for graphing what the processors are doing.
+
+Counters:
+    attempts: processor operations started
+    successes: processor operations which succeeded
+    declines: payment failures recorded, also labelled with their reason_code
+    transport_errors: gateway posts which got no answer, or an HTTP error
+
+Histograms, in seconds:
+    build: building a gateway request, up to its first post
+    round_trip: each gateway post, retries included
+    record: recording a payment, authorization or failure
+
+Everything is labelled with the processor's key and the operation, such as
+capture_payment, which the processor was running.
+
+Each metric goes to every sink named in the METRICS bursar setting:
+    'memory' (the default): kept in this process, for the metrics view, which
+        serves them in the Prometheus text format::
+
+            (r'^metrics/$', 'bursar.views.metrics_view'),
+
+        Only let the scraper reach it.  The numbers are per process, so
+        every process serving the view is scraped separately.
+    'statsd': sent over UDP to the METRICS_STATSD (host, port), by default
+        ('127.0.0.1', 8125), as "<prefix>.<name>.<processor>.<operation>",
+        with the METRICS_STATSD_PREFIX, by default 'bursar'.
+
+METRICS_BUCKETS holds the upper bounds, in seconds, of the memory sink's
+histogram buckets.  Set METRICS to () to record nothing.  More sinks can be
+added with register_sink.
+
+Recording takes a dictionary update under a lock for the memory sink, and a
+UDP send which never waits for the statsd one, so it is left on all the time.
+"""
+from bursar.bursar_settings import get_bursar_setting
+import bisect
+import logging
+import socket
+import threading
+
+log = logging.getLogger('bursar.metrics')
+
+COUNTERS = {
+    'attempts' : 'Processor operations started.',
+    'successes' : 'Processor operations which succeeded.',
+    'declines' : 'Payment failures recorded, by reason code.',
+    'transport_errors' : 'Gateway posts which got no answer, or an HTTP error.',
+}
+
+HISTOGRAMS = {
+    'build' : 'Seconds building a gateway request.',
+    'round_trip' : 'Seconds waiting on a gateway post.',
+    'record' : 'Seconds recording a payment, authorization or failure.',
+}
+
+class MetricsSink(object):
+    """Base class for sinks.  Subclasses must set `name` and implement
+    `increment` and `observe`.  `labels` is a tuple of (label, value) pairs."""
+
+    name = None
+
+    def increment(self, name, labels, value=1):
+        raise NotImplementedError
+
+    def observe(self, name, labels, seconds):
+        raise NotImplementedError
+
+class MemorySink(MetricsSink):
+    """Keeps the counters and histograms in this process."""
+
+    name = 'memory'
+
+    def __init__(self, buckets=None):
+        if buckets is None:
+            buckets = get_bursar_setting('METRICS_BUCKETS')
+        self.buckets = tuple(sorted(buckets))
+        # (name, labels): count
+        self.counters = {}
+        # (name, labels): [count in each bucket, then above them all, sum of the values]
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.counters.clear()
+            self.histograms.clear()
+        finally:
+            self.lock.release()
+
+    def increment(self, name, labels, value=1):
+        key = (name, labels)
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(key, None)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += seconds
+        finally:
+            self.lock.release()
+
+    def get_count(self, name, **labels):
+        """The total of the `name` counter over those with the given labels."""
+        return sum([count for (counter, counted), count in self.counters.items()
+            if counter == name and _matches(counted, labels)])
+
+    def get_observations(self, name, **labels):
+        """The number of values observed by the `name` histogram with the given labels."""
+        return sum([sum(histogram[:-1]) for (observed, counted), histogram in self.histograms.items()
+            if observed == name and _matches(counted, labels)])
+
+    def snapshot(self):
+        """Copies of the counters and histograms, taken together."""
+        self.lock.acquire()
+        try:
+            histograms = dict([(key, list(histogram)) for key, histogram in self.histograms.items()])
+            return dict(self.counters), histograms
+        finally:
+            self.lock.release()
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+        counters, histograms = self.snapshot()
+        lines = []
+        for name in sorted(COUNTERS):
+            metric = 'bursar_%s_total' % name
+            lines.append('# HELP %s %s' % (metric, COUNTERS[name]))
+            lines.append('# TYPE %s counter' % metric)
+            for (counter, labels), count in sorted(counters.items()):
+                if counter == name:
+                    lines.append('%s%s %i' % (metric, _format_labels(labels), count))
+        bounds = ['%g' % bound for bound in self.buckets] + ['+Inf']
+        for name in sorted(HISTOGRAMS):
+            metric = 'bursar_%s_seconds' % name
+            lines.append('# HELP %s %s' % (metric, HISTOGRAMS[name]))
+            lines.append('# TYPE %s histogram' % metric)
+            for (observed, labels), histogram in sorted(histograms.items()):
+                if observed != name:
+                    continue
+                total = 0
+                for bound, count in zip(bounds, histogram[:-1]):
+                    total += count
+                    lines.append('%s_bucket%s %i' % (metric, _format_labels(labels + (('le', bound),)), total))
+                lines.append('%s_sum%s %r' % (metric, _format_labels(labels), histogram[-1]))
+                lines.append('%s_count%s %i' % (metric, _format_labels(labels), total))
+        return '\n'.join(lines) + '\n'
+
+class StatsdSink(MetricsSink):
+    """Sends each metric to a StatsD server over UDP, dropping it if the socket is busy."""
+
+    name = 'statsd'
+
+    def __init__(self, address=None, prefix=None):
+        if address is None:
+            address = get_bursar_setting('METRICS_STATSD')
+        if prefix is None:
+            prefix = get_bursar_setting('METRICS_STATSD_PREFIX')
+        host, port = address
+        # looked up once, not on every send
+        self.address = (socket.gethostbyname(host), port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+    def increment(self, name, labels, value=1):
+        self._send('%s:%i|c' % (self._path(name, labels), value))
+
+    def observe(self, name, labels, seconds):
+        self._send('%s:%.3f|ms' % (self._path(name, labels), seconds * 1000))
+
+    def _path(self, name, labels):
+        parts = [self.prefix, name] + [_statsd_safe(value) for label, value in labels]
+        return '.'.join(parts)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line, self.address)
+        except socket.error, e:
+            log.debug('Dropped metric %s: %s', line, e)
+
+SINKS = {}
+
+def register_sink(cls):
+    """Make a MetricsSink subclass available to the METRICS setting by its name."""
+    SINKS[cls.name] = cls
+    return cls
+
+register_sink(MemorySink)
+register_sink(StatsdSink)
+
+# (names, sinks) for the METRICS setting they were built for
+_active = ((), [])
+_lock = threading.Lock()
+
+def get_sinks():
+    """The sinks named in the METRICS setting, built the first time they are needed."""
+    global _active
+    names = tuple(get_bursar_setting('METRICS'))
+    active = _active
+    if active[0] != names:
+        _lock.acquire()
+        try:
+            active = _active
+            if active[0] != names:
+                sinks = []
+                for name in names:
+                    try:
+                        cls = SINKS[name]
+                    except KeyError:
+                        log.error('Unknown metrics sink %r in the METRICS setting', name)
+                        continue
+                    sinks.append(cls())
+                active = _active = (names, sinks)
+        finally:
+            _lock.release()
+    return active[1]
+
+def get_sink(name):
+    """The active sink called `name`, or None."""
+    for sink in get_sinks():
+        if sink.name == name:
+            return sink
+    return None
+
+def increment(name, processor, operation, value=1, **labels):
+    """Add `value` to the `name` counter."""
+    sinks = get_sinks()
+    if sinks:
+        labels = _labels(processor, operation, labels)
+        for sink in sinks:
+            sink.increment(name, labels, value)
+
+def observe(name, processor, operation, seconds):
+    """Add a value, in seconds, to the `name` histogram."""
+    sinks = get_sinks()
+    if sinks:
+        labels = (('processor', processor), ('operation', operation))
+        for sink in sinks:
+            sink.observe(name, labels, seconds)
+
+def _labels(processor, operation, extra):
+    labels = (('processor', processor), ('operation', operation))
+    if extra:
+        labels += tuple(sorted(extra.items()))
+    return labels
+
+def _matches(labels, wanted):
+    labels = dict(labels)
+    for label, value in wanted.items():
+        if labels.get(label, None) != value:
+            return False
+    return True
+
+def _format_labels(labels):
+    return '{%s}' % ','.join(['%s="%s"' % (label, _prometheus_escape(value)) for label, value in labels])
+
+def _prometheus_escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf-8')
+
+def _statsd_safe(value):
+    value = unicode(value).encode('utf-8')
+    for c in '.:|@ \t\n':
+        value = value.replace(c, '_')
+    return value or '_'
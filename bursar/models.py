@@ -3,25 +3,30 @@ Stores details about the available payment options.
 Also stores credit card info in an encrypted format.
 """
 
-from bursar.fields import CurrencyField
+from bursar import cipher
+from bursar.errors import CipherError
+from bursar.fields import BalanceField, CurrencyField
 from bursar.bursar_settings import get_bursar_setting
-from Crypto.Cipher import Blowfish
 from datetime import datetime
 from decimal import Decimal, ROUND_UP
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.db import models
+from django.db import connection, models
+from django.db.models import F
+from django.db.models.query import QuerySet
+from django.utils.datastructures import SortedDict
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
-import base64
 import logging
-import operator
+import uuid
 
 import keyedcache
 
 log = logging.getLogger('bursar.models')
 
+NOTLOADED = object()
+
 # ----------------------
 # Abstract Base Models
 # ----------------------
@@ -96,7 +101,7 @@ class CreditCardDetail(models.Model):
     display_cc = models.CharField(_("CC Number (Last 4 digits)"),
                                   max_length=4, )
     encrypted_cc = models.CharField(_("Encrypted Credit Card"),
-                                    max_length=40, blank=True, null=True, editable=False)
+                                    max_length=255, blank=True, null=True, editable=False)
     expire_month = models.IntegerField(_("Expiration Month"))
     expire_year = models.IntegerField(_("Expiration Year"))
     card_holder = models.CharField(_("card_holder Name"), max_length=60, blank=True)
@@ -104,10 +109,31 @@ class CreditCardDetail(models.Model):
     start_year = models.IntegerField(_("Start Year"), blank=True, null=True)
     issue_num = models.CharField(blank=True, null=True, max_length=2)
 
+    # decrypted values, only remembered inside a Purchase.processing() scope
+    _secrets = None
+
+    def _remembered(self, name, lookup):
+        if self._secrets is None:
+            return lookup()
+        if name not in self._secrets:
+            self._secrets[name] = lookup()
+        return self._secrets[name]
+
+    def remember_secrets(self):
+        """Start remembering the decrypted number and CCV, instead of decrypting them on every read."""
+        if self._secrets is None:
+            self._secrets = {}
+
+    def forget_secrets(self):
+        """Drop any remembered decrypted number and CCV."""
+        self._secrets = None
+
     def storeCC(self, ccnum):
         """
         Take as input a valid cc, encrypt it and store the last 4 digits in a visible form
         """
+        if self._secrets is not None:
+            self._secrets.clear()
         self.display_cc = ccnum[-4:]
         encrypted_cc = _encrypt_code(ccnum)
         if get_bursar_setting('STORE_CREDIT_NUMBERS'):
@@ -116,7 +142,7 @@ class CreditCardDetail(models.Model):
             log.debug('standin=%s', (self.display_cc, self.expire_month, self.expire_year, self.payment.id))
             standin = "%s%i%i%i" % (self.display_cc, self.expire_month, self.expire_year, self.payment.id)
             self.encrypted_cc = _encrypt_code(standin)
-            key = _encrypt_code(standin + '-card')
+            key = cipher.digest(standin + '-card', self.encrypted_cc)
             keyedcache.cache_set(key, skiplog=True, length=60*60, value=encrypted_cc)
 
     def setCCV(self, ccv):
@@ -127,9 +153,14 @@ class CreditCardDetail(models.Model):
             raise ValueError('CreditCardDetail expecting a credit card number to be stored before storing CCV')
 
         keyedcache.cache_set(self.encrypted_cc, skiplog=True, length=60*60, value=ccv)
+        if self._secrets is not None:
+            self._secrets['ccv'] = ccv
 
     def getCCV(self):
         """Get the CCV from cache"""
+        return self._remembered('ccv', self._lookup_ccv)
+
+    def _lookup_ccv(self):
         try:
             ccv = keyedcache.cache_get(self.encrypted_cc)
         except keyedcache.NotCachedError:
@@ -141,10 +172,13 @@ class CreditCardDetail(models.Model):
 
     @property
     def decryptedCC(self):
+        return self._remembered('ccnum', self._decrypt_ccnum)
+
+    def _decrypt_ccnum(self):
         ccnum = _decrypt_code(self.encrypted_cc)
         if not get_bursar_setting('STORE_CREDIT_NUMBERS'):
             try:
-                key = _encrypt_code(ccnum + '-card')
+                key = cipher.digest(ccnum + '-card', self.encrypted_cc)
                 encrypted_ccnum = keyedcache.cache_get(key)
                 ccnum = _decrypt_code(encrypted_ccnum)
             except keyedcache.NotCachedError:
@@ -155,6 +189,48 @@ class CreditCardDetail(models.Model):
     def expirationDate(self):
         return(str(self.expire_month) + "/" + str(self.expire_year))
 
+    @property
+    def needs_reencryption(self):
+        """True if the stored number was encrypted with an old cipher or key."""
+        return bool(self.encrypted_cc) and not cipher.is_current(self.encrypted_cc)
+
+    def reencrypt(self):
+        """
+        Re-encrypt the stored number with the current cipher and key, moving
+        any cached card number and CCV along with it.  Does not save.
+        """
+        if not self.encrypted_cc:
+            return
+        old = self.encrypted_cc
+        ccv = self._lookup_ccv()
+        plain = _decrypt_code(old)
+        self.encrypted_cc = _encrypt_code(plain)
+
+        if not get_bursar_setting('STORE_CREDIT_NUMBERS'):
+            try:
+                encrypted_ccnum = keyedcache.cache_get(cipher.digest(plain + '-card', old))
+                key = cipher.digest(plain + '-card', self.encrypted_cc)
+                keyedcache.cache_set(key, skiplog=True, length=60*60,
+                    value=_encrypt_code(_decrypt_code(encrypted_ccnum)))
+            except keyedcache.NotCachedError:
+                pass
+
+        if ccv:
+            keyedcache.cache_set(self.encrypted_cc, skiplog=True, length=60*60, value=ccv)
+
+    def save(self, **kwargs):
+        # old rows are moved to the current cipher as they are touched
+        if self.needs_reencryption:
+            self.reencrypt()
+        if self.encrypted_cc:
+            limit = column_length(self._meta.db_table, 'encrypted_cc')
+            if limit is not None and len(self.encrypted_cc) > limit:
+                # the database would truncate it, or refuse it
+                raise CipherError('The encrypted card number is %i characters, but %s.encrypted_cc '
+                    'only holds %i.  Alter it to varchar(255), or set CIPHER back to blowfish.'
+                    % (len(self.encrypted_cc), self._meta.db_table, limit))
+        super(CreditCardDetail, self).save(**kwargs)
+
     class Meta:
         verbose_name = _("Credit Card")
         verbose_name_plural = _("Credit Cards")
@@ -165,7 +241,7 @@ class PaymentManager(models.Manager):
             purchase = other.purchase,
             method = other.method,
             amount=Decimal('0.00'),
-            transaction_id="LINKED",
+            transaction_id="LINKED-%s" % uuid.uuid4().hex,
             details=other.details,
             reason_code="")
         linked.save(**kwargs)
@@ -231,8 +307,80 @@ class PaymentPending(PaymentBase):
         verbose_name_plural = _("Pending Payments")
 
 
+class PurchaseQuerySet(QuerySet):
+
+    def with_balances(self):
+        """Annotate each purchase with its paid, authorized and remaining amounts.
+
+        The amounts are computed by the database from the payment tables as
+        correlated subqueries, so a purchase and its balances come back in a
+        single query.  This is the authoritative source for the `paid_total`
+        and `authorized_total` running balances, and is used to rebuild them.
+        """
+        qn = connection.ops.quote_name
+        purchase_id = '%s.%s' % (qn(Purchase._meta.db_table), qn('id'))
+        paid = 'SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s = %s AND %s = %%s' % (
+            qn('amount'), qn(Payment._meta.db_table), qn('purchase_id'), purchase_id, qn('success'))
+        authorized = 'SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s = %s AND %s = %%s' % (
+            qn('amount'), qn(Authorization._meta.db_table), qn('purchase_id'), purchase_id, qn('complete'))
+        remaining = '%s.%s - (%s) - (%s)' % (
+            qn(Purchase._meta.db_table), qn('total'), paid, authorized)
+
+        select = SortedDict()
+        select['balance_paid'] = paid
+        select['balance_authorized'] = authorized
+        select['balance_remaining'] = remaining
+        return self.extra(select=select, select_params=(True, False, True, False))
+
+    def for_processing(self, pk):
+        """Load a purchase with everything a gateway needs to build its requests.
+
+        The purchase with its failure count, its most recent credit card and
+        that card's payment, its pending payments, and its line items with
+        their recurring details are fetched in five queries, no matter how
+        many payments or line items there are.  `credit_card`,
+        `failure_count`, `get_pending` and `recurring_lineitems` then answer
+        from the loaded values.
+        """
+        qn = connection.ops.quote_name
+        failures = 'SELECT COUNT(*) FROM %s WHERE %s = %s.%s' % (
+            qn(PaymentFailure._meta.db_table), qn('purchase_id'),
+            qn(Purchase._meta.db_table), qn('id'))
+        purchase = self.extra(select={'failure_count_loaded' : failures}).get(pk=pk)
+
+        cache = {}
+        cache['failure_count'] = int(purchase.failure_count_loaded)
+
+        cards = CreditCardDetail.objects.filter(payment__purchase=purchase) \
+            .select_related('payment').order_by('-payment__time_stamp')[:1]
+        cache['credit_card'] = (list(cards) or [None])[0]
+
+        cache['pending'] = list(PaymentPending.objects.filter(purchase=purchase).order_by('id'))
+
+        lineitems = list(purchase.lineitems.all())
+        details = dict([(recur.lineitem_id, recur)
+            for recur in RecurringLineItem.objects.filter(lineitem__purchase=purchase)])
+        recurring = []
+        for item in lineitems:
+            item._purchase_cache = purchase
+            if item.id in details:
+                item._recurdetails_cache = details[item.id]
+                recurring.append(item)
+        cache['recurring'] = recurring
+
+        purchase._processing_cache = cache
+        return purchase
+
 class PurchaseManager(models.Manager):
-    pass
+
+    def get_query_set(self):
+        return PurchaseQuerySet(self.model)
+
+    def for_processing(self, pk):
+        return self.get_query_set().for_processing(pk)
+
+    def with_balances(self):
+        return self.get_query_set().with_balances()
 
 class Purchase(models.Model):
     """
@@ -266,33 +414,61 @@ class Purchase(models.Model):
     total = CurrencyField(_("Total"),
                           max_digits=18, decimal_places=2, display_decimal=4)
     time_stamp = models.DateTimeField(_("Timestamp"), blank=True, null=True)
+    paid_total = BalanceField(_("Paid"),
+                              max_digits=18, decimal_places=2, default=Decimal('0.00'), editable=False)
+    authorized_total = BalanceField(_("Authorized"),
+                                    max_digits=18, decimal_places=2, default=Decimal('0.00'), editable=False)
 
     objects = PurchaseManager()
 
     def __unicode__(self):
         return u"Purchase #%s on Order #%s" % (self.id, self.orderno)
 
+    def adjust_balances(self, paid=None, authorized=None):
+        """Add to the running balances.
+
+        The columns are updated in the database with a single atomic UPDATE,
+        so concurrent recorders cannot lose each other's changes, and this
+        instance is moved by the same amounts.
+        """
+        updates = {}
+        if paid:
+            updates['paid_total'] = F('paid_total') + paid
+            self.paid_total = _to_currency(self.paid_total) + paid
+        if authorized:
+            updates['authorized_total'] = F('authorized_total') + authorized
+            self.authorized_total = _to_currency(self.authorized_total) + authorized
+        if updates:
+            Purchase.objects.filter(pk=self.pk).update(**updates)
+            log.debug('Adjusted balances for %s: %s', self, updates)
+
     @property
     def authorized_remaining(self):
         """Returns the total value of all un-captured authorizations"""
-        auths = [p.amount for p in self.authorizations.filter(complete=False)]
-        if auths:
-            amount = reduce(operator.add, auths)
-        else:
-            amount = Decimal('0.00')
+        return _to_currency(self.authorized_total)
 
-        return amount
+    def _processing_cached(self, key):
+        """Return a value loaded by `PurchaseQuerySet.for_processing`, or NOTLOADED."""
+        return self.__dict__.get('_processing_cache', {}).get(key, NOTLOADED)
 
     @property
     def credit_card(self):
-        """Return the credit card associated with this payment.
+        """Return the credit card associated with the most recent payment.
         """
-        for payment in self.payments.order_by('-time_stamp'):
-            try:
-                return payment.creditcard
-            except CreditCardDetail.DoesNotExist:
-                pass
-        return None
+        card = self._processing_cached('credit_card')
+        if card is NOTLOADED:
+            cards = CreditCardDetail.objects.filter(payment__purchase=self) \
+                .select_related('payment').order_by('-payment__time_stamp')[:1]
+            card = (list(cards) or [None])[0]
+        return card
+
+    @property
+    def failure_count(self):
+        """Return the number of failed payment attempts."""
+        count = self._processing_cached('failure_count')
+        if count is NOTLOADED:
+            count = self.paymentfailures.count()
+        return count
 
     @property
     def full_bill_street(self, delim="\n"):
@@ -307,8 +483,12 @@ class Purchase(models.Model):
         return mark_safe(address)
 
     def get_pending(self, method, raises=True):
-        pending = self.paymentspending.filter(method__exact=method)
-        if pending.count() > 0:
+        pendings = self._processing_cached('pending')
+        if pendings is NOTLOADED:
+            pending = list(self.paymentspending.filter(method__exact=method)[:1])
+        else:
+            pending = [p for p in pendings if p.method == method]
+        if pending:
             return pending[0]
         elif raises:
             raise PaymentPending.DoesNotExist(method)
@@ -319,6 +499,23 @@ class Purchase(models.Model):
         remaining = self.remaining
         return remaining > 0 and remaining < self.total
 
+    def processing(self):
+        """Return a scope for processing this purchase, for use in a `with` block.
+
+        Inside the scope the purchase remembers its credit card, and the card
+        remembers its decrypted number and CCV, so building a request reads
+        each of them once.  The decrypted values are dropped when the scope
+        ends.
+        """
+        return ProcessingScope(self)
+
+    def invalidate_processing_cache(self, *keys):
+        """Forget values loaded by `for_processing` which have been changed in the database."""
+        cache = self.__dict__.get('_processing_cache', None)
+        if cache:
+            for key in keys:
+                cache.pop(key, None)
+
     def recalc(self):
         if self.lineitems.count() > 0:
             subtotal = Decimal('0.00')
@@ -345,7 +542,9 @@ class Purchase(models.Model):
 
     def recurring_lineitems(self):
         """Get all recurring lineitems"""
-        subscriptions = [item for item in self.lineitems.all() if item.is_recurring]
+        subscriptions = self._processing_cached('recurring')
+        if subscriptions is NOTLOADED:
+            subscriptions = [item for item in self.lineitems.all() if item.is_recurring]
         return subscriptions
 
     @property
@@ -372,13 +571,42 @@ class Purchase(models.Model):
     @property
     def total_payments(self):
         """Returns the total value of all completed payments"""
-        payments = [p.amount for p in self.payments.filter(success=True)]
-        if payments:
-            amount = reduce(operator.add, payments)
-        else:
-            amount = Decimal('0.00')
-        log.debug("total payments for %s=%s", self, amount)
-        return amount
+        return _to_currency(self.paid_total)
+
+
+class ProcessingScope(object):
+    """Remembers a purchase's credit card and its decrypted values for the duration of a `with` block.
+
+    Scopes may be nested, everything is forgotten when the outermost one exits.
+    """
+
+    def __init__(self, purchase):
+        self.purchase = purchase
+
+    def __enter__(self):
+        purchase = self.purchase
+        depth = purchase.__dict__.get('_processing_depth', 0)
+        purchase._processing_depth = depth + 1
+        if depth == 0:
+            cache = purchase.__dict__.setdefault('_processing_cache', {})
+            purchase._processing_loaded_card = 'credit_card' in cache
+            card = purchase.credit_card
+            cache['credit_card'] = card
+            if card:
+                card.remember_secrets()
+        return purchase
+
+    def __exit__(self, *exc_info):
+        purchase = self.purchase
+        purchase._processing_depth -= 1
+        if purchase._processing_depth == 0:
+            cache = purchase._processing_cache
+            card = cache.get('credit_card', None)
+            if card:
+                card.forget_secrets()
+            if not purchase._processing_loaded_card:
+                cache.pop('credit_card', None)
+        return False
 
 
 class LineItem(models.Model):
@@ -484,19 +712,45 @@ class RecurringLineItem(models.Model):
 # Helper methods
 # --------------------
 
+def _to_currency(value):
+    """Normalize a database aggregate, which may be None, an int or a float, to a Decimal."""
+    if value is None:
+        return Decimal('0.00')
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    return value.quantize(Decimal('0.01'))
+
+# (table, column): length in the database, looked up once per process
+_column_lengths = {}
+
+def column_length(table, column):
+    """The length of a character column as the database has it, which may be
+    less than its field says on a site created before the field was widened.
+    None if the database doesn't say."""
+    key = (table, column)
+    if key not in _column_lengths:
+        if settings.DATABASE_ENGINE == 'mysql':
+            schema = 'DATABASE()'
+        elif settings.DATABASE_ENGINE in ('postgresql', 'postgresql_psycopg2'):
+            schema = 'current_schema()'
+        else:
+            # sqlite doesn't enforce lengths
+            schema = None
+        length = None
+        if schema:
+            cursor = connection.cursor()
+            cursor.execute('SELECT character_maximum_length FROM information_schema.columns '
+                'WHERE table_schema = %s AND table_name = %%s AND column_name = %%s' % schema, [table, column])
+            row = cursor.fetchone()
+            if row:
+                length = row[0]
+        _column_lengths[key] = length
+    return _column_lengths[key]
+
 def _decrypt_code(code):
-    """Decrypt code encrypted by _encrypt_code"""
-    secret_key = settings.SECRET_KEY
-    encryption_object = Blowfish.new(secret_key)
-    # strip padding from decrypted credit card number
-    return encryption_object.decrypt(base64.b64decode(code)).rstrip('X')
+    """Decrypt code encrypted by _encrypt_code, or by any older cipher or key"""
+    return cipher.decrypt(code)
 
 def _encrypt_code(code):
     """Quick encrypter for CC codes or code fragments"""
-    secret_key = settings.SECRET_KEY
-    encryption_object = Blowfish.new(secret_key)
-    # block cipher length must be a multiple of 8
-    padding = ''
-    if (len(code) % 8) <> 0:
-        padding = 'X' * (8 - (len(code) % 8))
-    return base64.b64encode(encryption_object.encrypt(code + padding))
+    return cipher.encrypt(code)
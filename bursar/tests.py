@@ -1,13 +1,44 @@
 # -*- coding: UTF-8 -*-
-from bursar.models import Authorization, Payment, Purchase, CreditCardDetail
+from __future__ import with_statement
+from bursar import cipher
+from bursar import bursar_settings
+from bursar import metrics
+from bursar.bursar_settings import set_bursar_setting
+from bursar.errors import CipherError, CircuitOpenError, GatewayError, TransportError
+from bursar.gateway import registry, resilience, stats
+from bursar.gateway.dummy_gateway.processor import PaymentProcessor as DummyProcessor
+from bursar.gateway.builder import RequestBuilder
+from bursar.gateway.bulk import capture_purchases
+from bursar.gateway.resilience import CircuitBreaker
+from bursar.gateway.simulator.behaviour import Behaviour, parse_latency
+from bursar.gateway.simulator.server import SimulatorServer
+from bursar.gateway.base import NOTSET, ProcessorResult
+from bursar.gateway.steps import Post, Return
+from bursar.gateway.transport import Transport
+from bursar.gateway.workers import RateLimiter
+from bursar.utils import FileCache, LRUCache
+from bursar.models import Authorization, Payment, Purchase, CreditCardDetail, \
+                          LineItem, PaymentFailure, RecurringLineItem
 from decimal import Decimal
 from django.conf import settings
+from django.db import connection
 from django.contrib.sites.models import Site
 from django.core import urlresolvers
+from django.core.management import call_command
 from django.core.urlresolvers import reverse as url
-from django.test import TestCase
+from django.template import Context, Template, TemplateSyntaxError
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.utils import simplejson
+from django.utils.safestring import mark_safe
+import BaseHTTPServer
+import cgi
+import os
 import random
+import SocketServer
+import tempfile
+import threading
+import time
 
 alphabet = 'abcdefghijklmnopqrstuvwxyz'
 
@@ -38,7 +69,7 @@ def make_test_purchase(payment={}, **kwargs):
     if payment:
         for f in ('card_type', 'expire_month', 'expire_year', 'card_number', 'ccv'):
             assert(f in payment)
-        p = Payment(purchase = purchase, amount = purchase.total)
+        p = Payment(purchase = purchase, amount = purchase.total, transaction_id = "card%i" % purchase.pk)
         p.save()
         c = CreditCardDetail(
             payment=p, 
@@ -54,6 +85,46 @@ def make_test_purchase(payment={}, **kwargs):
         
     return purchase
 
+def read_golden(test_module, name):
+    """Read a golden request from the testdata directory beside a test module."""
+    path = os.path.join(os.path.dirname(test_module), 'testdata', name)
+    return open(path).read().decode('utf-8')
+
+class QueryCounter(object):
+    """Count the SQL queries run inside a `with` block, used to enforce query budgets."""
+
+    def __enter__(self):
+        self.debug = settings.DEBUG
+        settings.DEBUG = True
+        self.start = len(connection.queries)
+        self.count = 0
+        return self
+
+    def __exit__(self, *exc_info):
+        self.count = len(connection.queries) - self.start
+        settings.DEBUG = self.debug
+        return False
+
+    @property
+    def queries(self):
+        return connection.queries[self.start:self.start + self.count]
+
+def run_within_budget(testcase, budgets, operation, *args, **kwargs):
+    """Run a processor operation with its queries recorded, failing `testcase` if it, or
+    an operation inside it, runs more SQL queries than `budgets` allows for its name."""
+    with QueryCounter():
+        result = operation(*args, **kwargs)
+    operation = stats.last()
+    pending = [operation]
+    while pending:
+        inner = pending.pop()
+        budget = budgets.get(inner.operation, None)
+        if budget is not None and inner.queries > budget:
+            testcase.fail('%s %s ran %i queries, over its budget of %i:\n%s\n%s' % (inner.processor,
+                inner.operation, inner.queries, budget, operation.report(), '\n'.join(inner.sql)))
+        pending.extend(inner.children)
+    return result
+
 class TestBase(TestCase):
     def setUp(self):
         self.client = Client()
@@ -64,4 +135,975 @@ class TestBase(TestCase):
     def test_authorize(self):
         """Test making an authorization using DUMMY."""
         purchase = make_test_purchase(sub_total=Decimal('10.00'))
-        self.assertEqual(purchase.total, Decimal('10.00'))
\ No newline at end of file
+        self.assertEqual(purchase.total, Decimal('10.00'))
+    def test_with_balances(self):
+        """Test that annotated balances match the computed ones."""
+        from bursar.gateway.dummy_gateway import processor
+        gateway = processor.PaymentProcessor()
+        purchase = make_test_purchase(sub_total=Decimal('100.00'))
+        gateway.create_pending_payment(purchase=purchase, amount=Decimal('25.00'))
+        gateway.authorize_payment(purchase=purchase)
+        gateway.capture_payment(purchase=purchase, amount=Decimal('30.00'))
+
+        self.assertEqual(purchase.total_payments, Decimal('30.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('25.00'))
+        self.assertEqual(purchase.remaining, Decimal('45.00'))
+
+        annotated = Purchase.objects.with_balances().get(pk=purchase.pk)
+        self.assertEqual(Decimal(str(annotated.balance_paid)), Decimal('30.00'))
+        self.assertEqual(Decimal(str(annotated.balance_authorized)), Decimal('25.00'))
+        self.assertEqual(Decimal(str(annotated.balance_remaining)), Decimal('45.00'))
+        self.assert_(annotated.partially_paid)
+
+        gateway.record_payment(purchase=annotated, amount=Decimal('45.00'), transaction_id='test2')
+        self.assertEqual(annotated.total_payments, Decimal('75.00'))
+        self.assertEqual(annotated.remaining, Decimal('0.00'))
+
+    def test_running_balances(self):
+        """Test that the running balances follow authorizations, captures and releases."""
+        from bursar.gateway.dummy_gateway import processor
+        gateway = processor.PaymentProcessor()
+        purchase = make_test_purchase(sub_total=Decimal('50.00'))
+        result = gateway.authorize_payment(purchase=purchase, amount=Decimal('20.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('20.00'))
+
+        gateway.capture_authorized_payment(result.payment, purchase=purchase)
+        self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+        self.assertEqual(purchase.total_payments, Decimal('20.00'))
+
+        auth = gateway.record_authorization(amount=Decimal('30.00'), transaction_id='auth2', purchase=purchase)
+        self.assertEqual(purchase.remaining, Decimal('0.00'))
+        gateway.release_authorized_payment(purchase=purchase, auth=auth)
+        self.assertEqual(purchase.remaining, Decimal('30.00'))
+
+        # a fresh instance sees the same values, and saving it keeps them
+        fresh = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(fresh.total_payments, Decimal('20.00'))
+        self.assertEqual(fresh.authorized_remaining, Decimal('0.00'))
+        stale = Purchase.objects.get(pk=purchase.pk)
+        gateway.record_payment(purchase=fresh, amount=Decimal('5.00'), transaction_id='test3')
+        with QueryCounter() as counter:
+            stale.save()
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).total_payments, Decimal('25.00'))
+        # without reading the balances back first
+        self.assertEqual([q['sql'] for q in counter.queries
+            if q['sql'].startswith('SELECT') and 'paid_total' in q['sql']], [])
+
+    def test_rebuild_balances(self):
+        """Test rebuilding the running balances from the payment tables."""
+        from bursar.gateway.dummy_gateway import processor
+        gateway = processor.PaymentProcessor()
+        purchase = make_test_purchase(sub_total=Decimal('40.00'))
+        gateway.capture_payment(purchase=purchase, amount=Decimal('15.00'))
+        gateway.authorize_payment(purchase=purchase, amount=Decimal('10.00'))
+
+        Purchase.objects.filter(pk=purchase.pk).update(paid_total=Decimal('0.00'), authorized_total=Decimal('99.00'))
+        call_command('rebuild_purchase_balances', verbosity=0)
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.total_payments, Decimal('15.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('10.00'))
+        self.assertEqual(purchase.remaining, Decimal('15.00'))
+
+    def test_for_processing(self):
+        """Test that the processing loader stays within its query budget."""
+        payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+        purchase = make_test_purchase(sub_total=Decimal('30.00'), payment=payment)
+        for i in range(5):
+            Payment.objects.create(purchase=purchase, amount=Decimal('1.00'), transaction_id='attempt%i' % i)
+            PaymentFailure.objects.create(purchase=purchase, amount=Decimal('1.00'), transaction_id='fail%i' % i)
+        for i in range(3):
+            item = LineItem.objects.create(purchase=purchase, name='item%i' % i,
+                unit_price=Decimal('10.00'), sub_total=Decimal('10.00'))
+        RecurringLineItem.objects.create(lineitem=item, recurring=True)
+        from bursar.gateway.dummy_gateway import processor
+        processor.PaymentProcessor().create_pending_payment(purchase=purchase, amount=Decimal('30.00'))
+
+        with QueryCounter() as counter:
+            loaded = Purchase.objects.for_processing(purchase.pk)
+        self.assert_(counter.count <= 5, counter.queries)
+
+        with QueryCounter() as counter:
+            card = loaded.credit_card
+            self.assertEqual(loaded.failure_count, 5)
+            self.assertEqual(loaded.get_pending('dummy').amount, Decimal('30.00'))
+            self.assertEqual(loaded.get_pending('other', raises=False), None)
+            self.assertEqual(loaded.recurring_lineitems(), [item])
+            self.assert_(loaded.recurring_lineitems()[0].is_recurring)
+            self.assertEqual(card.payment.purchase_id, purchase.pk)
+        self.assertEqual(counter.count, 0, counter.queries)
+
+        self.assertEqual(card, purchase.credit_card)
+        self.assertEqual(loaded.failure_count, purchase.failure_count)
+
+    def test_processing_scope(self):
+        """Test that the card and its secrets are read once per processing scope."""
+        import bursar.models
+        payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+        purchase = make_test_purchase(sub_total=Decimal('30.00'), payment=payment)
+        calls = []
+        decrypt = bursar.models._decrypt_code
+        def counting_decrypt(code):
+            calls.append(code)
+            return decrypt(code)
+        bursar.models._decrypt_code = counting_decrypt
+        try:
+            with QueryCounter() as counter:
+                with purchase.processing():
+                    card = purchase.credit_card
+                    with purchase.processing():
+                        for i in range(3):
+                            self.assertEqual(purchase.credit_card.decryptedCC, '4111111111111111')
+                            self.assertEqual(purchase.credit_card.ccv, '111')
+                    self.assert_(card._secrets)
+            self.assertEqual(counter.count, 1, counter.queries)
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(card._secrets, None)
+            self.assertEqual(card.decryptedCC, '4111111111111111')
+            self.assertEqual(len(calls), 4)
+        finally:
+            bursar.models._decrypt_code = decrypt
+
+        with QueryCounter() as counter:
+            purchase.credit_card
+        self.assertEqual(counter.count, 1)
+
+class TestCipher(TestCase):
+    def setUp(self):
+        self.saved = bursar_settings.working_bursar_settings.copy()
+        set_bursar_setting('CIPHER', 'aes')
+
+    def tearDown(self):
+        bursar_settings.working_bursar_settings.clear()
+        bursar_settings.working_bursar_settings.update(self.saved)
+
+    def test_roundtrip(self):
+        """Test that values are tagged, authenticated and decrypt back."""
+        token = cipher.encrypt('4111111111111111')
+        self.assert_(token.startswith('$aes$1$'))
+        self.assertNotEqual(token, cipher.encrypt('4111111111111111'))
+        self.assertEqual(cipher.decrypt(token), '4111111111111111')
+        tampered = token[:-4] + (token[-4:] == 'AAAA' and 'BBBB' or 'AAAA')
+        self.assertRaises(CipherError, cipher.decrypt, tampered)
+        self.assert_(cipher.get_engine() is cipher.get_engine('aes', 1))
+
+    def test_empty_key(self):
+        """Test that an empty or missing key is refused rather than used."""
+        set_bursar_setting('CIPHER_KEYS', {1 : settings.SECRET_KEY, 2 : ''})
+        self.assertRaises(CipherError, cipher.encrypt, '4111111111111111')
+        self.assertRaises(CipherError, cipher.get_engine, 'aes', 3)
+
+    def test_many(self):
+        """Test batch encryption, and batch decryption across engines and key versions."""
+        legacy = cipher.get_engine('blowfish', cipher.LEGACY_VERSION).encrypt('4007000000027')
+        self.failIf(legacy.startswith(cipher.TAG))
+        tokens = cipher.encrypt_many(['4111111111111111', '5424000000000015'])
+        set_bursar_setting('CIPHER_KEYS', {1 : settings.SECRET_KEY, 2 : 'rotated'})
+        tokens.append(cipher.encrypt('370000000000002'))
+        self.assert_(tokens[-1].startswith('$aes$2$'))
+        self.assertEqual(cipher.decrypt_many(tokens + [legacy]),
+            ['4111111111111111', '5424000000000015', '370000000000002', '4007000000027'])
+        self.failIf(cipher.is_current(tokens[0]))
+        self.assert_(cipher.is_current(tokens[-1]))
+
+    def test_default(self):
+        """Test that by default cards are stored as the original code stored them."""
+        set_bursar_setting('CIPHER', 'blowfish')
+        token = cipher.encrypt('4111111111111111')
+        self.failIf(token.startswith(cipher.TAG))
+        self.assertEqual(len(token), 24)
+        self.assert_(cipher.is_current(token))
+
+    def test_narrow_column(self):
+        """Test that a card too long for the database's column is refused rather than truncated."""
+        import bursar.models
+        key = (CreditCardDetail._meta.db_table, 'encrypted_cc')
+        saved = bursar.models._column_lengths.get(key, None)
+        bursar.models._column_lengths[key] = 40
+        try:
+            purchase = make_test_purchase(sub_total=Decimal('10.00'))
+            payment = Payment.objects.create(purchase=purchase, amount=purchase.total, transaction_id='narrow')
+            card = CreditCardDetail(payment=payment, credit_type='visa', expire_month=12, expire_year=2012)
+            card.storeCC('4111111111111111')
+            self.assertRaises(CipherError, card.save)
+            set_bursar_setting('CIPHER', 'blowfish')
+            card.storeCC('4111111111111111')
+            card.save()
+        finally:
+            bursar.models._column_lengths[key] = saved
+        self.failIf(CreditCardDetail.objects.get(pk=card.pk).encrypted_cc.startswith(cipher.TAG))
+
+    def test_legacy_card(self):
+        """Test that a card stored by the Blowfish code is read, and re-encrypted when saved."""
+        set_bursar_setting('CIPHER', 'blowfish')
+        set_bursar_setting('CIPHER_KEY_VERSION', cipher.LEGACY_VERSION)
+        payment = {
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+        purchase = make_test_purchase(sub_total=Decimal('10.00'), payment=payment)
+        card = purchase.credit_card
+        self.failIf(card.encrypted_cc.startswith(cipher.TAG))
+        self.assertEqual(card.decryptedCC, '4111111111111111')
+
+        set_bursar_setting('CIPHER', 'aes')
+        set_bursar_setting('CIPHER_KEY_VERSION', None)
+        card = purchase.credit_card
+        self.assert_(card.needs_reencryption)
+        self.assertEqual(card.decryptedCC, '4111111111111111')
+        card.save()
+        card = purchase.credit_card
+        self.failIf(card.needs_reencryption)
+        self.assert_(card.encrypted_cc.startswith('$aes$1$'))
+        self.assertEqual(card.decryptedCC, '4111111111111111')
+        self.assertEqual(card.ccv, '111')
+
+    def test_rotate_keys(self):
+        """Test re-encrypting stored cards under a new key, resuming from a checkpoint."""
+        import tempfile
+        purchase = make_test_purchase(sub_total=Decimal('10.00'))
+        cards = []
+        for i in range(5):
+            payment = Payment.objects.create(purchase=purchase, amount=purchase.total, transaction_id='rotate%i' % i)
+            card = CreditCardDetail(payment=payment, credit_type='visa', expire_month=12, expire_year=2012)
+            card.storeCC('4111111111111111')
+            card.ccv = '111'
+            card.save()
+            cards.append(card)
+        set_bursar_setting('CIPHER_KEYS', {1 : settings.SECRET_KEY, 2 : 'rotated'})
+
+        fd, checkpoint = tempfile.mkstemp()
+        os.write(fd, 'aes 2 %i\n' % cards[0].pk)
+        os.close(fd)
+        call_command('rotate_cipher_keys', chunk=2, processes=1, checkpoint=checkpoint, verbosity=0)
+        self.failIf(os.path.exists(checkpoint))
+
+        self.assertEqual(CreditCardDetail.objects.get(pk=cards[0].pk).encrypted_cc, cards[0].encrypted_cc)
+        for card in cards[1:]:
+            card = CreditCardDetail.objects.get(pk=card.pk)
+            self.assert_(card.encrypted_cc.startswith('$aes$2$'))
+            self.assertEqual(card.decryptedCC, '4111111111111111')
+            self.assertEqual(card.ccv, '111')
+
+        call_command('rotate_cipher_keys', chunk=2, processes=2, verbosity=0)
+        card = CreditCardDetail.objects.get(pk=cards[0].pk)
+        self.assert_(card.encrypted_cc.startswith('$aes$2$'))
+        self.assertEqual(card.decryptedCC, '4111111111111111')
+
+class GatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers posts for a GatewayServer over keep-alive connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self.server.posts.append((self.path, body))
+        if self.path == '/slow' or self.server.delay:
+            time.sleep(self.server.delay or 0.5)
+        if self.path == '/missing':
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        if callable(self.server.reply):
+            body = self.server.reply(self.path, body)
+        elif self.server.reply is not None:
+            body = self.server.reply
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class GatewayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A local server standing in for a payment gateway, in a background thread.
+
+    Answers every post with `reply`, or `reply(path, body)` if it is callable,
+    or else echoes it back, after `delay` seconds.  Posts are recorded in `posts`."""
+
+    daemon_threads = True
+
+    def __init__(self, reply=None, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), GatewayHandler)
+        self.reply = reply
+        self.delay = delay
+        self.connections = 0
+        self.posts = []
+        self.url = 'http://127.0.0.1:%i' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestResilience(TestCase):
+    def test_breaker(self):
+        """Test that a breaker opens on failures, probes once when half-open, and closes again."""
+        clock = FakeClock()
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=30, clock=clock)
+        for i in range(2):
+            breaker.before_call()
+            breaker.record(False)
+        self.assertEqual(breaker.state, resilience.OPEN)
+        self.failIf(breaker.available())
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+
+        clock.now += 30
+        self.assert_(breaker.available())
+        breaker.before_call()
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+        self.assertRaises(CircuitOpenError, breaker.before_call)
+        breaker.record(False)
+        self.assertEqual(breaker.state, resilience.OPEN)
+
+        clock.now += 30
+        breaker.before_call()
+        breaker.record(True)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+        slow = CircuitBreaker('slow', failure_threshold=1, slow_call=2)
+        slow.before_call()
+        slow.record(True, elapsed=3)
+        self.assertEqual(slow.state, resilience.OPEN)
+
+    def test_retry(self):
+        """Test that only retryable errors are retried, with growing backoff."""
+        breaker = CircuitBreaker('retry', failure_threshold=10)
+        errors = [TransportError('down'), TransportError('HTTP Error 503', status=503)]
+        def flaky():
+            if errors:
+                raise errors.pop(0)
+            return 'ok'
+        sleeps = []
+        self.assertEqual(resilience.call(breaker, flaky, retries=2, backoff=1, sleep=sleeps.append), 'ok')
+        self.assertEqual(len(sleeps), 2)
+        self.assert_(sleeps[0] <= 1 and sleeps[1] <= 2)
+
+        def missing():
+            raise TransportError('HTTP Error 404', status=404)
+        self.assertRaises(TransportError, resilience.call, breaker, missing, retries=2, sleep=sleeps.append)
+        self.assertEqual(len(sleeps), 2)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_unexpected_error(self):
+        """Test that an unexpected error ends a half-open probe as a failure, rather than leaving it outstanding."""
+        clock = FakeClock()
+        breaker = CircuitBreaker('unexpected', failure_threshold=1, reset_timeout=30, clock=clock)
+        breaker.before_call()
+        breaker.record(False)
+        clock.now += 30
+        def broken():
+            raise ValueError('Unexpected')
+        self.assertRaises(ValueError, resilience.call, breaker, broken, retries=2)
+        self.assertEqual(breaker.state, resilience.OPEN)
+        self.failIf(breaker.probing)
+        clock.now += 30
+        self.assertEqual(resilience.call(breaker, lambda: 'ok'), 'ok')
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    def test_processor_fails_fast(self):
+        """Test that a processor refuses to post while its breaker is open."""
+        processor = DummyProcessor({'BREAKER_FAILURES' : 1, 'HTTP_RETRIES' : 0})
+        processor.breaker.reset()
+        self.assert_(processor.is_available())
+        self.assertRaises(TransportError, processor.http_post, 'http://127.0.0.1:1/', 'x')
+        self.failIf(processor.is_available())
+        self.assertRaises(CircuitOpenError, processor.http_post, 'http://127.0.0.1:1/', 'x')
+        processor.breaker.reset()
+
+    def test_rate_limiter(self):
+        """Test that calls are spaced evenly, without waiting after a quiet spell."""
+        clock = FakeClock()
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock.now += seconds
+        limiter = RateLimiter(4, clock=clock, sleep=sleep)
+        for i in range(3):
+            limiter.wait()
+        self.assertEqual(sleeps, [0.25, 0.25])
+        clock.now += 10
+        limiter.wait()
+        self.assertEqual(len(sleeps), 2)
+
+class TestTransport(TestCase):
+    def setUp(self):
+        self.server = GatewayServer()
+        self.url = self.server.url
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_keepalive(self):
+        """Test that posts to one host share a connection."""
+        t = Transport(maxsize=2, connect_timeout=2, read_timeout=2)
+        for i in range(3):
+            response = t.post(self.url + '/echo', 'x_amount=%i' % i)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, 'x_amount=%i' % i)
+        self.assertEqual(self.server.connections, 1)
+        t.close()
+
+    def test_errors(self):
+        """Test that error statuses and read timeouts raise TransportError."""
+        t = Transport(maxsize=1, connect_timeout=2, read_timeout=0.1)
+        try:
+            t.post(self.url + '/missing', 'x')
+            self.fail('Expected a TransportError')
+        except TransportError, e:
+            self.assertEqual(e.status, 404)
+        self.assertRaises(TransportError, t.post, self.url + '/slow', 'x')
+        self.assertEqual(t.post(self.url + '/echo', 'ok').body, 'ok')
+        t.close()
+
+class Card(object):
+    number = '4111 & <1111>'
+    def masked(self):
+        return 'XXXX1111'
+    def delete(self):
+        return 'deleted'
+    delete.alters_data = True
+
+class TestBulkCapture(TransactionTestCase):
+    def test_capture_rolled_back_alone(self):
+        """Test that a capture whose recording fails is rolled back without the others."""
+        class FailingProcessor(DummyProcessor):
+            def capture_authorized_payment(self, authorization, **kwargs):
+                result = super(FailingProcessor, self).capture_authorized_payment(authorization, **kwargs)
+                if authorization.amount == Decimal('15.00'):
+                    raise ValueError('Lost the database')
+                return result
+        gateway = FailingProcessor()
+        purchase = make_test_purchase(sub_total=Decimal('25.00'))
+        for amount in (Decimal('10.00'), Decimal('15.00')):
+            self.assert_(gateway.authorize_payment(purchase=purchase, amount=amount).success)
+        report = capture_purchases([purchase.pk], {'dummy' : gateway})
+        self.assertEqual((report.count('captured'), report.count('error')), (1, 1))
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.total_payments, Decimal('10.00'))
+        self.assertEqual([auth.amount for auth in Authorization.objects.filter(purchase=purchase, complete=False)],
+            [Decimal('15.00')])
+
+class PostingProcessor(DummyProcessor):
+    """The dummy processor, posting its captures and releases to a GatewayServer first,
+    which approves anything it doesn't answer 'declined'."""
+
+    def __init__(self, url, settings={}):
+        super(PostingProcessor, self).__init__(settings)
+        self.url = url
+
+    def capture_authorized_payment(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        return self.run_steps(self.capture_authorized_payment_steps(authorization, testing=testing,
+            purchase=purchase, amount=amount))
+
+    def capture_authorized_payment_steps(self, authorization, testing=False, purchase=None, amount=NOTSET):
+        assert(purchase)
+        if amount == NOTSET:
+            amount = authorization.remaining
+        response = yield Post(self.url, 'capture=%i&amount=%s' % (authorization.id, amount))
+        if response.body == 'declined':
+            raise Return(ProcessorResult(self.key, False, 'Declined'))
+        payment = self.record_payment(amount=amount, authorization=authorization, purchase=purchase)
+        raise Return(ProcessorResult(self.key, True, 'Success', payment))
+
+    def release_authorized_payment(self, purchase=None, auth=None, testing=False):
+        return self.run_steps(self.release_authorized_payment_steps(purchase=purchase, auth=auth, testing=testing))
+
+    def release_authorized_payment_steps(self, purchase=None, auth=None, testing=False):
+        assert(purchase)
+        yield Post(self.url, 'release=%i' % auth.id, idempotent=True)
+        self.record_release(auth, purchase=purchase)
+        raise Return(ProcessorResult(self.key, True, 'Success'))
+
+class TestCapture(TestCase):
+    """Captures of several authorizations at once, posted together and recorded in order."""
+    def setUp(self):
+        self.server = GatewayServer(reply='approved')
+        self.gateway = PostingProcessor(self.server.url + '/gateway')
+
+    def tearDown(self):
+        self.server.stop()
+
+    def authorize(self, purchase, *amounts):
+        for amount in amounts:
+            self.assert_(self.gateway.authorize_payment(purchase=purchase, amount=amount).success)
+        del self.server.posts[:]
+
+    def posted(self, name):
+        """The values posted for `name`, in order of size."""
+        values = [cgi.parse_qs(body).get(name, None) for path, body in self.server.posts]
+        return sorted([Decimal(value[0]) for value in values if value])
+
+    def test_concurrent(self):
+        """Test capturing several authorizations of a purchase at once."""
+        purchase = make_test_purchase(sub_total=Decimal('100.00'))
+        self.authorize(purchase, Decimal('25.00'), Decimal('40.00'), Decimal('35.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('100.00'))
+
+        self.server.delay = 0.4
+        started = time.time()
+        results = self.gateway.capture_authorized_payments(purchase, concurrent=True, max_workers=3)
+        self.assert_(time.time() - started < 1.0)
+        self.assertEqual([r.success for r in results], [True, True, True])
+        self.assertEqual([r.payment.amount for r in results], [Decimal('25.00'), Decimal('40.00'), Decimal('35.00')])
+        self.assertEqual(purchase.total_payments, Decimal('100.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+        purchase = Purchase.objects.get(pk=purchase.pk)
+        self.assertEqual(purchase.total_payments, Decimal('100.00'))
+        self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+
+    def test_concurrent_over_authorized(self):
+        """Test that concurrent captures stop at the purchase's total, as sequential ones do."""
+        purchase = make_test_purchase(sub_total=Decimal('50.00'))
+        self.authorize(purchase, Decimal('25.00'), Decimal('40.00'), Decimal('10.00'))
+        results = self.gateway.capture_authorized_payments(purchase, concurrent=True, max_workers=3)
+        self.assertEqual([r.payment.amount for r in results], [Decimal('25.00'), Decimal('25.00'), Decimal('0.00')])
+        self.assertEqual(self.posted('amount'), [Decimal('0.00'), Decimal('25.00'), Decimal('25.00')])
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).total_payments, Decimal('50.00'))
+
+    def test_concurrent_partly_paid(self):
+        """Test that concurrent captures take what is already paid into account."""
+        purchase = make_test_purchase(sub_total=Decimal('50.00'))
+        self.gateway.record_payment(purchase=purchase, amount=Decimal('20.00'), transaction_id='paid')
+        self.authorize(purchase, Decimal('20.00'), Decimal('20.00'))
+        self.gateway.capture_authorized_payments(purchase, concurrent=True, max_workers=2)
+        self.assertEqual(self.posted('amount'), [Decimal('10.00'), Decimal('20.00')])
+        self.assertEqual(Purchase.objects.get(pk=purchase.pk).total_payments, Decimal('50.00'))
+
+    def test_bulk(self):
+        """Test capturing the authorizations of several purchases, skipping unknown methods."""
+        def reply(path, body):
+            if Decimal(cgi.parse_qs(body)['amount'][0]) == Decimal('40.00'):
+                return 'declined'
+            return 'approved'
+        self.server.reply = reply
+        first = make_test_purchase(sub_total=Decimal('60.00'))
+        self.authorize(first, Decimal('25.00'), Decimal('35.00'))
+        second = make_test_purchase(sub_total=Decimal('40.00'))
+        self.authorize(second, Decimal('40.00'))
+        third = make_test_purchase(sub_total=Decimal('10.00'))
+        Authorization(purchase=third, method='other', amount=Decimal('10.00')).save()
+
+        self.server.delay = 0.3
+        report = capture_purchases(Purchase.objects.filter(pk__in=[first.pk, second.pk, third.pk]),
+            {'dummy' : self.gateway}, workers=3, batch_size=2)
+        self.assert_(report.elapsed < 0.9)
+        self.assertEqual(report.methods['dummy']['captured'], 2)
+        self.assertEqual(report.methods['dummy']['declined'], 1)
+        self.assertEqual(report.methods['dummy']['amount'], Decimal('60.00'))
+        self.assertEqual(report.methods['other']['skipped'], 1)
+        self.assertEqual([outcome for auth, outcome, message in report.failures], ['declined'])
+        self.assertEqual(Purchase.objects.get(pk=first.pk).total_payments, Decimal('60.00'))
+        self.assertEqual(Purchase.objects.get(pk=second.pk).authorized_remaining, Decimal('40.00'))
+        self.assertEqual(Authorization.objects.filter(purchase=third, complete=False).count(), 1)
+
+    def test_bulk_over_authorized(self):
+        """Test that bulk captures stop at each purchase's total, releasing what is left over."""
+        over = make_test_purchase(sub_total=Decimal('50.00'))
+        self.authorize(over, Decimal('25.00'), Decimal('40.00'), Decimal('10.00'))
+        paid = make_test_purchase(sub_total=Decimal('30.00'))
+        self.gateway.record_payment(purchase=paid, amount=Decimal('10.00'), transaction_id='paid')
+        self.authorize(paid, Decimal('15.00'), Decimal('15.00'))
+
+        report = capture_purchases([over.pk, paid.pk], {'dummy' : self.gateway}, workers=3)
+        self.assertEqual(report.methods['dummy']['captured'], 4)
+        self.assertEqual(report.methods['dummy']['released'], 1)
+        self.assertEqual(report.methods['dummy']['amount'], Decimal('70.00'))
+        self.assertEqual(report.failures, [])
+        self.assert_(report.summary()[0].startswith('dummy: 4 captured (70.00), 1 released,'))
+        self.assertEqual(self.posted('amount'), [Decimal('5.00'), Decimal('15.00'), Decimal('25.00'), Decimal('25.00')])
+        self.assertEqual(len(self.posted('release')), 1)
+        for purchase, paid_total in ((over, Decimal('50.00')), (paid, Decimal('30.00'))):
+            purchase = Purchase.objects.get(pk=purchase.pk)
+            self.assertEqual(purchase.paid_total, paid_total)
+            self.assertEqual(purchase.authorized_remaining, Decimal('0.00'))
+            self.assertEqual(Authorization.objects.filter(purchase=purchase, complete=False).count(), 0)
+
+class TestRegistry(TestCase):
+    def tearDown(self):
+        registry.clear()
+
+    def test_shared(self):
+        """Test that a processor is built once for its settings, and again when they change."""
+        gateway_settings = {'VENDOR' : 'test'}
+        set_bursar_setting('DUMMY_REGISTRY', gateway_settings)
+        gateway = registry.get_processor('dummy', 'DUMMY_REGISTRY')
+        self.assert_(registry.get_processor('dummy', 'DUMMY_REGISTRY') is gateway)
+        gateway_settings['EXTRA_LOGGING'] = True
+        changed = registry.get_processor('dummy', 'DUMMY_REGISTRY')
+        self.failIf(changed is gateway)
+        self.assert_(changed.settings['EXTRA_LOGGING'])
+        self.assert_(registry.get_processor('dummy', settings=gateway_settings) is not changed)
+
+    def test_per_thread(self):
+        """Test that a processor which isn't thread safe is built for each thread."""
+        gateway_settings = {'PER_THREAD' : True}
+        DummyProcessor.thread_safe = False
+        try:
+            gateway = registry.get_processor('dummy', settings=gateway_settings)
+            self.assert_(registry.get_processor('dummy', settings=gateway_settings) is gateway)
+            others = []
+            thread = threading.Thread(target=lambda: others.append(registry.get_processor('dummy', settings=gateway_settings)))
+            thread.start()
+            thread.join()
+        finally:
+            del DummyProcessor.thread_safe
+        self.failIf(others[0] is gateway)
+        self.assert_(others[0].settings['PER_THREAD'])
+
+    def test_errors(self):
+        self.assertRaises(GatewayError, registry.get_processor, 'dummy', 'DUMMY_MISSING')
+        self.assertRaises(GatewayError, registry.get_processor, 'nonesuch', settings={})
+        set_bursar_setting('PROTX_TEST', {})
+        try:
+            errors = registry.check_processors(['dummy', 'protx'])
+        finally:
+            set_bursar_setting('PROTX_TEST', None)
+        self.assertEqual([name for name, error in errors], ['PROTX_TEST'])
+
+class TestStats(TestCase):
+    def setUp(self):
+        self.gateway = DummyProcessor()
+
+    def test_operations(self):
+        """Test that operations are measured, with those they run inside them."""
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        result = self.gateway.capture_payment(purchase=purchase)
+        self.assertEqual((result.stats.processor, result.stats.operation), ('dummy', 'capture_payment'))
+        # not recorded without DEBUG
+        self.assertEqual(result.stats.queries, None)
+        self.assert_(result.stats.wall_time > 0)
+        self.assert_(stats.last() is result.stats)
+
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        with QueryCounter() as counter:
+            result = self.gateway.authorize_payment(purchase=purchase)
+        self.assertEqual(result.stats.queries, counter.count)
+        self.assertEqual(len(result.stats.sql), counter.count)
+        child = result.stats.children[0]
+        self.assertEqual(child.operation, 'record_authorization')
+        self.assert_(0 < child.queries <= result.stats.queries)
+        self.assert_(child.wall_time <= result.stats.wall_time)
+        self.assertEqual(result.stats.report().split('\n')[1].split(':')[0], '  record_authorization')
+
+        # record_payment returns a Payment, so its stats are only in last()
+        with QueryCounter() as counter:
+            self.gateway.record_payment(purchase=purchase, authorization=result.payment)
+        self.assertEqual((stats.last().operation, stats.last().queries), ('record_payment', counter.count))
+
+    def test_budget(self):
+        """Test that run_within_budget fails an operation running too many queries."""
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        self.assertRaises(AssertionError, run_within_budget, self, {'record_payment' : 0},
+            self.gateway.capture_payment, purchase=purchase)
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        result = run_within_budget(self, {'record_payment' : 10}, self.gateway.capture_payment, purchase=purchase)
+        self.assert_(result.success)
+
+    def test_http(self):
+        """Test that gateway posts are timed, those made together once."""
+        server = SimulatorServer()
+        try:
+            url = server.url + '/paypal/cgi-bin/webscr'
+            measured = stats.start('dummy', 'test')
+            self.gateway.http_post(url, 'cmd=_notify-validate&')
+            self.gateway.http_post_all([Post(url, 'a'), Post(url, 'b')])
+            stats.finish(measured)
+        finally:
+            server.stop()
+        self.assertEqual(measured.http_posts, 3)
+        self.assert_(0 < measured.http_time <= measured.wall_time)
+
+class TestMetrics(TestCase):
+    def setUp(self):
+        self.gateway = DummyProcessor()
+        self.sink = metrics.get_sink('memory')
+        self.sink.clear()
+
+    def tearDown(self):
+        set_bursar_setting('METRICS', ('memory',))
+
+    def test_counters(self):
+        """Test that attempts, successes and declines are counted by processor and operation."""
+        purchase = make_test_purchase(sub_total=Decimal('20.00'))
+        self.gateway.capture_payment(purchase=purchase)
+        purchase = make_test_purchase(sub_total=Decimal('20.00'), payment={'card_number' : '4222222222222',
+            'ccv' : '111', 'expire_month' : 12, 'expire_year' : 2030, 'card_type' : 'visa'})
+        self.gateway.authorize_payment(purchase=purchase)
+        self.assertEqual(self.sink.get_count('attempts', processor='dummy'), 2)
+        self.assertEqual(self.sink.get_count('successes', processor='dummy', operation='capture_payment'), 1)
+        self.assertEqual(self.sink.get_count('successes', operation='authorize_payment'), 0)
+        self.assertEqual(self.sink.get_count('declines', operation='authorize_payment', reason_code='2'), 1)
+        # the record_* operations run inside are not attempts of their own
+        self.assertEqual(self.sink.get_observations('record', processor='dummy', operation='capture_payment'), 1)
+        self.assertEqual(self.sink.get_observations('record', operation='authorize_payment'), 1)
+
+    def test_posts(self):
+        """Test that gateway posts are timed, and their transport errors counted."""
+        server = GatewayServer()
+        try:
+            self.gateway.http_post(server.url + '/echo', 'x')
+            self.gateway.http_post_all([Post(server.url + '/echo', 'a'), Post(server.url + '/echo', 'b')])
+            self.assertRaises(TransportError, self.gateway.http_post, server.url + '/missing', 'x')
+        finally:
+            server.stop()
+        self.assertEqual(self.sink.get_observations('round_trip', processor='dummy', operation='post'), 4)
+        self.assertEqual(self.sink.get_count('transport_errors', processor='dummy'), 1)
+
+    def test_steps(self):
+        """Test that the build time and round trip of a gateway using steps are recorded."""
+        from bursar.gateway.protx_gateway.processor import PaymentProcessor
+        server = SimulatorServer()
+        try:
+            settings = dict(server.gateway_settings('protx'), VENDOR='test')
+            gateway = PaymentProcessor(settings)
+            purchase = make_test_purchase(sub_total=Decimal('20.00'), payment={'card_number' : '4111111111111111',
+                'ccv' : '111', 'expire_month' : 12, 'expire_year' : 2030, 'card_type' : 'visa'})
+            self.assert_(gateway.capture_payment(purchase=purchase).success)
+        finally:
+            server.stop()
+        labels = {'processor' : 'protx', 'operation' : 'capture_payment'}
+        self.assertEqual(self.sink.get_observations('build', **labels), 1)
+        self.assertEqual(self.sink.get_observations('round_trip', **labels), 1)
+        self.assertEqual(self.sink.get_count('successes', **labels), 1)
+
+    def test_exposition(self):
+        """Test the Prometheus text format, and its view."""
+        sink = metrics.MemorySink(buckets=(0.1, 1))
+        sink.increment('declines', (('processor', 'dummy'), ('operation', 'capture_payment'), ('reason_code', '"2"')))
+        labels = (('processor', 'dummy'), ('operation', 'capture_payment'))
+        sink.observe('record', labels, 0.05)
+        sink.observe('record', labels, 0.5)
+        sink.observe('record', labels, 5)
+        lines = sink.exposition().split('\n')
+        self.assert_('# TYPE bursar_declines_total counter' in lines)
+        self.assert_('bursar_declines_total{processor="dummy",operation="capture_payment",reason_code="\\"2\\""} 1' in lines)
+        self.assert_('# TYPE bursar_record_seconds histogram' in lines)
+        for bound, count in (('0.1', 1), ('1', 2), ('+Inf', 3)):
+            self.assert_('bursar_record_seconds_bucket{processor="dummy",operation="capture_payment",le="%s"} %i'
+                % (bound, count) in lines)
+        self.assert_('bursar_record_seconds_count{processor="dummy",operation="capture_payment"} 3' in lines)
+        self.assert_('bursar_record_seconds_sum{processor="dummy",operation="capture_payment"} 5.55' in lines)
+
+        from bursar.views import metrics_view
+        self.gateway.capture_payment(purchase=make_test_purchase(sub_total=Decimal('20.00')))
+        response = metrics_view(None)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4')
+        self.assert_('bursar_attempts_total{processor="dummy",operation="capture_payment"} 1' in response.content)
+
+    def test_sinks(self):
+        """Test sending to StatsD, and turning the metrics off."""
+        import socket
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(2)
+        try:
+            sink = metrics.StatsdSink(address=receiver.getsockname(), prefix='shop')
+            sink.increment('attempts', (('processor', 'dummy'), ('operation', 'capture_payment')))
+            self.assertEqual(receiver.recv(512), 'shop.attempts.dummy.capture_payment:1|c')
+            sink.observe('round_trip', (('processor', 'protx'), ('operation', 'post')), 0.25)
+            self.assertEqual(receiver.recv(512), 'shop.round_trip.protx.post:250.000|ms')
+        finally:
+            receiver.close()
+
+        set_bursar_setting('METRICS', ())
+        self.assertEqual(metrics.get_sinks(), [])
+        self.gateway.capture_payment(purchase=make_test_purchase(sub_total=Decimal('20.00')))
+        self.assertEqual(self.sink.get_count('attempts'), 0)
+
+class TestSimulator(TestCase):
+    def setUp(self):
+        self.server = SimulatorServer()
+        self.payment = {
+            'card_holder' : 'Cave Man',
+            'ccv' : '111',
+            'card_number' : '4111111111111111',
+            'expire_month' : 12,
+            'expire_year' : 2012,
+            'card_type' : 'visa'
+        }
+
+    def tearDown(self):
+        self.server.stop()
+
+    def purchase(self, card_number='4111111111111111'):
+        return make_test_purchase(sub_total=Decimal('20.00'), payment=dict(self.payment, card_number=card_number))
+
+    def test_latency(self):
+        rng = random.Random(1)
+        self.assertEqual(parse_latency(None)(rng), 0)
+        self.assertEqual(parse_latency('0.25')(rng), 0.25)
+        self.assert_(0.05 <= parse_latency('uniform:0.05,0.2')(rng) <= 0.2)
+        self.assert_(parse_latency('normal:0.1,0.5')(rng) >= 0)
+        self.assertRaises(ValueError, parse_latency, 'sometimes')
+
+    def test_authorizenet(self):
+        from bursar.gateway.authorizenet_gateway.processor import PaymentProcessor
+        gateway = PaymentProcessor(dict(self.server.gateway_settings('authorizenet'),
+            LOGIN='test', TRANKEY='test', STORE_NAME='test'))
+        purchase = self.purchase()
+        result = gateway.authorize_payment(purchase=purchase)
+        self.assert_(result.success, result.message)
+        self.assertEqual(result.response.card_type, 'Visa')
+        results = gateway.capture_authorized_payments(purchase=purchase)
+        self.assert_(results[0].success)
+        self.assertEqual(results[0].payment.transaction_id, result.payment.transaction_id)
+
+        result = gateway.capture_payment(purchase=self.purchase('4000000000000002'))
+        self.failIf(result.success)
+        self.assertEqual(result.response.reason_code, '2')
+        # which the processor sends as an invalid number in test mode
+        result = gateway.capture_payment(purchase=self.purchase('4222222222222'))
+        self.assertEqual((result.response.response_code, result.response.reason_code), ('3', '6'))
+
+    def test_cybersource(self):
+        from bursar.gateway.cybersource_gateway.processor import PaymentProcessor
+        gateway = PaymentProcessor(dict(self.server.gateway_settings('cybersource'),
+            MERCHANT_ID='test', TRANKEY='test'))
+        purchase = self.purchase()
+        result = gateway.authorize_payment(purchase=purchase)
+        self.assert_(result.success, result.message)
+        self.assertEqual(result.response['ccAuthReply.avsCode'], 'Y')
+        result = gateway.capture_authorized_payment(result.payment, purchase=purchase)
+        self.assert_(result.success, result.message)
+        self.assert_('ccCaptureReply.reconciliationID' in result.response)
+
+        result = gateway.capture_payment(purchase=self.purchase('4000000000000002'))
+        self.failIf(result.success)
+        self.assertEqual(result.response['reasonCode'], '203')
+
+    def test_protx(self):
+        from bursar.gateway.protx_gateway.processor import PaymentProcessor
+        gateway = PaymentProcessor(dict(self.server.gateway_settings('protx'), VENDOR='test'))
+        result = gateway.capture_payment(purchase=self.purchase())
+        self.assert_(result.success, result.message)
+        self.assert_(result.payment.transaction_id.startswith('{SIM'))
+        result = gateway.capture_payment(purchase=self.purchase('4222222222222'))
+        self.failIf(result.success)
+        self.assertEqual(result.response['Status'], 'NOTAUTHED')
+
+    def test_paypal(self):
+        from bursar.gateway.paypal_gateway.processor import PaymentProcessor
+        gateway = PaymentProcessor(dict(self.server.gateway_settings('paypal'), BUSINESS='shop@example.com'))
+        self.assert_(gateway.confirm_ipn_data({'txn_id' : 'SIM1', 'payment_status' : 'Completed'}))
+
+    def test_errors(self):
+        """Test that posts fail at the error rate, and unknown paths get a 404."""
+        self.server.behaviour = Behaviour(error_rate=1)
+        from bursar.gateway.protx_gateway.processor import PaymentProcessor
+        gateway = PaymentProcessor(dict(self.server.gateway_settings('protx'), VENDOR='test'))
+        result = gateway.capture_payment(purchase=self.purchase())
+        self.failIf(result.success)
+        self.assertEqual(self.server.counts.values(), [1])
+        self.server.behaviour = Behaviour()
+        self.assertEqual(self.server.answer('/nowhere', '')[0], 404)
+
+    def test_benchmark(self):
+        """Test the benchmark_checkout command runs, and saves its results."""
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            call_command('benchmark_checkout', number=2, processors=['dummy', 'protx'], output=output,
+                test_db=False, verbosity=0)
+            results = simplejson.load(open(output))['results']
+        finally:
+            os.remove(output)
+        self.assertEqual([(result['processor'], result['flow']) for result in results], [('dummy', 'capture'),
+            ('dummy', 'authorize'), ('dummy', 'capture authorized'), ('dummy', 'release'), ('protx', 'capture')])
+        for result in results:
+            self.assertEqual(result['failures'], 0)
+            self.assert_(result['p50_ms'] <= result['p95_ms'] <= result['p99_ms'])
+            self.assert_(result['queries_per_op'] > 0)
+
+class TestRequestBuilder(TestCase):
+    def assertBuilds(self, source, data):
+        self.assertEqual(RequestBuilder(source).build(data), Template(source).render(Context(data)))
+
+    def test_fields(self):
+        """Test that fields are looked up and escaped just as a template does."""
+        data = {'card' : Card(), 'name' : u"O'Brien \xe9", 'items' : ['a<b', 'c'], 'amount' : Decimal('9.90'),
+            'nested' : {'key' : '"quoted"'}, 'none' : None, 'safe' : mark_safe('<b>')}
+        self.assertBuilds('<a>{{ card.number }}|{{ card.masked }}|{{ card.delete }}|{{ card.missing }}</a>', data)
+        self.assertBuilds('{{ name }} {{ items.0 }} {{ items.5 }} {{ amount }} {{ nested.key }} {{ none }} {{ safe }}', data)
+        self.assertBuilds('{{ missing }}{{ missing.deeper }} {{ "literal" }} {{ 12 }}{# comment #}', data)
+
+    def test_conditions(self):
+        source = ('{% if card %}card{% else %}none{% endif %}|{% if not missing %}no{% endif %}|'
+            '{% ifequal unit "DAY" %}days{% else %}months{% endifequal %}|'
+            '{% ifnotequal card.number unit %}differ{% endifnotequal %}|'
+            '{% if empty %}{% ifequal a b %}x{% endifequal %}{% endif %}')
+        for data in ({'card' : Card(), 'unit' : 'DAY'}, {'unit' : 'MONTH', 'empty' : [1], 'a' : 1, 'b' : 1}, {}):
+            self.assertBuilds(source, data)
+
+    def test_unsupported(self):
+        """Test that syntax the builders don't understand fails when compiling."""
+        for source in ('{{ name|upper }}', '{% for x in items %}{{ x }}{% endfor %}',
+                '{% if a and b %}x{% endif %}', '{% if a %}x', '{% endif %}'):
+            self.assertRaises(TemplateSyntaxError, RequestBuilder, source)
+
+    def test_benchmark(self):
+        """Test the benchmark_builders command runs."""
+        call_command('benchmark_builders', number=2, verbosity=0)
+
+class TestUtils(TestCase):
+    def test_lru_cache(self):
+        cache = LRUCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used
+        cache.set('c', 3)
+        self.failIf('b' in cache)
+        self.assertEqual((cache.get('a'), cache.get('c'), len(cache)), (1, 3, 2))
+        cache.set('a', 4)
+        cache.set('d', 5)
+        self.assertEqual((cache.get('a'), cache.get('c', 'gone')), (4, 'gone'))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_file_cache(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        loads = []
+        def loader(name):
+            loads.append(name)
+            return open(name).read()
+        try:
+            open(path, 'w').write('first')
+            cache = FileCache(loader)
+            self.assertEqual((cache.get(path), cache.get(path)), ('first', 'first'))
+            self.assertEqual(len(loads), 1)
+            open(path, 'w').write('second')
+            # in case the file system's times are too coarse to notice
+            os.utime(path, (0, 0))
+            self.assertEqual(cache.get(path), 'second')
+            self.assertEqual(len(loads), 2)
+        finally:
+            os.remove(path)
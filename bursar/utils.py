@@ -0,0 +1,110 @@
+import os
+import threading
+
+class LRUCache(object):
+    """A thread-safe mapping of up to `size` items, dropping the least recently used."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.items = {}
+        # a circular list of [previous, next, key, value] links, most recently used first
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return self.items.has_key(key)
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.items.clear()
+            self.root[:] = [self.root, self.root, None, None]
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.items.get(key, None)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._push(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            link = self.items.get(key, None)
+            if link is not None:
+                self._unlink(link)
+                link[3] = value
+            else:
+                if len(self.items) >= self.size:
+                    oldest = self.root[0]
+                    self._unlink(oldest)
+                    del self.items[oldest[2]]
+                link = [None, None, key, value]
+                self.items[key] = link
+            self._push(link)
+        finally:
+            self.lock.release()
+
+    def _push(self, link):
+        root = self.root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = link
+        root[1] = link
+
+    def _unlink(self, link):
+        previous, following = link[0], link[1]
+        previous[1] = following
+        following[0] = previous
+
+class FileCache(object):
+    """Values loaded from files by `loader`, loaded again when one of the files changes."""
+
+    def __init__(self, loader):
+        self.loader = loader
+        # paths: (stamp, value)
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+    def get(self, *paths):
+        """`loader(*paths)`, as last loaded unless a file's size or modification time has changed."""
+        stamp = self._stamp(paths)
+        entry = self.entries.get(paths, None)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        self.lock.acquire()
+        try:
+            # another thread may have loaded it while this one waited
+            entry = self.entries.get(paths, None)
+            if entry is None or entry[0] != stamp:
+                entry = (stamp, self.loader(*paths))
+                self.entries[paths] = entry
+            return entry[1]
+        finally:
+            self.lock.release()
+
+    def _stamp(self, paths):
+        stamp = []
+        for path in paths:
+            info = os.stat(path)
+            stamp.append((info.st_mtime, info.st_size))
+        return tuple(stamp)
@@ -0,0 +1,11 @@
+from bursar import metrics
+from django.http import Http404, HttpResponse
+from django.views.decorators.cache import never_cache
+
+@never_cache
+def metrics_view(request):
+    """The metrics kept by the memory sink, in the Prometheus text format, see bursar/metrics.py."""
+    sink = metrics.get_sink('memory')
+    if sink is None:
+        raise Http404('The memory metrics sink is not in the METRICS setting.')
+    return HttpResponse(sink.exposition(), mimetype='text/plain; version=0.0.4')